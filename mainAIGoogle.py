@@ -3,16 +3,46 @@
 #email: mquevedo@unicauca.edu.co
 
 import os
+import sys
+import csv
+import argparse
 import logging
 import sqlite3
 import json
+import base64
+import tempfile
+import hashlib
+import re
+import unicodedata
 import requests
 import pytz
 import asyncio
-from datetime import datetime, timedelta
+import random
+import threading
+import time
+import heapq
+import functools
+import io
+import itertools
+import math
+import hmac
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta, time as dt_time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram.error import Forbidden, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ConversationHandler, JobQueue
 
+# Formato columnar opcional para las exportaciones
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 # Configuración de logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -22,77 +52,616 @@ logger = logging.getLogger(__name__)
 
 # Configuración de variables de entorno para Google AI Studio
 API_KEY = 'API_KEY'  #API de Google AI Studio
-ENDPOINT = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key=API_KEY'
+GEMINI_MODEL = 'gemini-2.0-flash'
+GEMINI_ENDPOINT_TEMPLATE = 'https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key=API_KEY'
+ENDPOINT = GEMINI_ENDPOINT_TEMPLATE.format(model=GEMINI_MODEL)
+
+# Configuración del envío de fotos a Gemini
+GEMINI_UPLOAD_URL = 'https://generativelanguage.googleapis.com/upload/v1beta/files?key=API_KEY'
+INLINE_IMAGE_MAX_BYTES = 512 * 1024   # Fotos mayores se suben con la API de archivos en lugar de base64
+IMAGE_SPOOL_MAX_BYTES = 1024 * 1024   # Descargas mayores se guardan en disco temporal en lugar de memoria
+GEMINI_FILE_TTL_SECONDS = 47 * 3600   # Gemini conserva los archivos subidos 48 horas
+IMAGE_PART_CACHE_SIZE = 256           # URIs de fotos subidas que se recuerdan
+FOLLOWUP_IMAGE_SECONDS = 30 * 60      # Ventana en la que las preguntas de texto reutilizan la última foto subida
+ALBUM_COLLECT_SECONDS = 1.5           # Espera para reunir las fotos de un álbum (media_group_id) antes de analizarlas
+ALBUM_MAX_PHOTOS = 10                 # Máximo de fotos por álbum en Telegram
+
+# Enrutamiento de modelos por clase de solicitud (en orden de preferencia; los siguientes son respaldo)
+MODEL_ROUTES = {
+    'classify': ['gemini-2.0-flash-lite', 'gemini-2.0-flash'],    # Filtro SÍ/NO de fotos
+    'short_text': ['gemini-2.0-flash-lite', 'gemini-2.0-flash'],  # Preguntas cortas
+    'text': ['gemini-2.0-flash', 'gemini-2.0-flash-lite'],
+    'image': ['gemini-2.0-flash', 'gemini-2.0-flash-lite'],       # Diagnóstico de fotos
+    'digest': ['gemini-2.0-flash-lite', 'gemini-2.0-flash'],      # Resúmenes diarios fuera de pico
+}
+SHORT_TEXT_MAX_CHARS = 300       # Longitud máxima de la pregunta del usuario para considerarla corta
+MODEL_STATS_WINDOW = 50          # Llamadas recientes por modelo usadas para p95 y tasa de error
+MODEL_MIN_SAMPLES = 10           # Muestras mínimas antes de marcar un modelo como degradado
+MODEL_MAX_P95_MS = 15000
+MODEL_MAX_ERROR_RATE = 0.3
+
+# Administración y presupuestos de uso de la IA
+ADMIN_USER_IDS = set()            # IDs de Telegram con acceso a los comandos de administración
+USER_DAILY_TOKEN_BUDGET = 50000   # Tokens de Gemini por usuario y día (0 = sin límite)
+BUDGET_EXCEEDED_MESSAGE = "Lo siento, alcanzaste el límite diario de consultas a la IA. Inténtalo de nuevo mañana."
+USAGE_FLUSH_INTERVAL_SECONDS = 30
 
 # Configuración para SheetDB
 SHEETDB_API_URL = 'https://sheetdb.io/api/v1/API-KEY'  # API-KEY es la clave de SheetDB
 
+# Configuración de resiliencia de las dependencias externas
+DEPENDENCY_TIMEOUTS = {          # (conexión, lectura) en segundos
+    'gemini': (5, 30),
+    'sheetdb': (5, 10),
+    'gemini_upload': (5, 60),
+}
+RETRY_MAX_ATTEMPTS = 3           # Intentos totales para llamadas idempotentes
+RETRY_BASE_DELAY = 0.5           # Segundos; se duplica en cada intento (con jitter)
+RETRY_MAX_DELAY = 8
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+MODEL_FALLBACK_STATUS_CODES = RETRYABLE_STATUS_CODES | {404}  # Respuestas que hacen probar otro modelo
+BREAKER_FAILURE_THRESHOLD = 5    # Fallos seguidos que abren el circuito
+BREAKER_RESET_SECONDS = 30       # Tiempo con el circuito abierto antes de probar de nuevo
+GEMINI_HEDGE_AFTER_SECONDS = None  # Segundos antes de enviar una solicitud de respaldo a Gemini (None = desactivado)
+
+# Control de sobrecarga: modos degradados según el trabajo pendiente y la latencia de Gemini
+OVERLOAD_MODES = ['normal', 'sin_filtro_imagen', 'respuestas_cortas', 'cache_primero', 'rechazo']
+OVERLOAD_THRESHOLDS = {           # Nivel: (trabajo pendiente, p95 en ms) a partir de los que se activa
+    1: (8, 8000),                 # Trabajo pendiente = updates en cola de PTB + llamadas a Gemini en curso
+    2: (15, 12000),               # (álbumes, resúmenes) + consultas SQLite en cola
+    3: (30, 20000),
+    4: (60, 30000),
+}
+OVERLOAD_WINDOW_SECONDS = 60      # Ventana de latencias recientes
+OVERLOAD_MIN_SAMPLES = 5          # Muestras mínimas para usar el p95
+OVERLOAD_RECOVERY_FACTOR = 0.7    # Para bajar de nivel las señales deben quedar bajo este factor del umbral
+OVERLOAD_RECOVERY_SECONDS = 30    # Tiempo tranquilo antes de bajar cada nivel
+OVERLOAD_REDUCED_OUTPUT_TOKENS = 384
+OVERLOAD_REDUCED_CONTEXT_MESSAGES = 2
+OVERLOAD_RETRY_AFTER_SECONDS = 60
+OVERLOAD_REJECT_FLOWS = {'text', 'photo'}   # Flujos interactivos que se rechazan en el último nivel
+AI_RESPONSE_CACHE_SIZE = 500      # Respuestas de texto recordadas para servirlas bajo sobrecarga
+AI_RESPONSE_CACHE_TTL_SECONDS = 6 * 3600
+
+# Configuración de la base de datos local
+DB_PATH = 'hydroponic_bot.db'    # Tablas globales (y las tablas por usuario cuando SHARD_COUNT = 1)
+
+# Acceso a SQLite fuera del event loop
+DB_EXECUTOR_WORKERS = 4          # Hilos dedicados a las consultas SQLite de los handlers
+LOOP_LAG_INTERVAL_SECONDS = 0.5  # Periodo de muestreo del retraso del event loop
+LOOP_LAG_WINDOW = 600            # Muestras usadas para p50/p95
+LOOP_LAG_WARN_MS = 200           # Retraso a partir del cual se registra una advertencia
+LOOP_LAG_REPORT_SECONDS = 300    # Frecuencia del resumen de retraso en el log
+
+# Instrumentación de handlers y profiler de muestreo
+HANDLER_STATS_WINDOW = 200       # Ejecuciones recientes por handler usadas para p95
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL = 0.005  # Segundos entre muestras de las pilas de todos los hilos
+
+# Recordatorios
+USER_DEFAULT_TIMEZONE = 'America/Bogota'   # Zona horaria de los usuarios que no configuraron /zona
+REMINDER_PAGE_SIZE = 5           # Recordatorios por página en el listado
+REMINDER_SEND_BATCH = 500        # Recordatorios vencidos leídos por shard en cada ejecución del job
+
+# Búsqueda en el historial de consultas (/historial)
+HISTORY_PAGE_SIZE = 5            # Resultados por página
+HISTORY_SNIPPET_TOKENS = 12      # Palabras de contexto alrededor de cada coincidencia
+HISTORY_STOPWORDS = {            # Palabras demasiado frecuentes para acotar la búsqueda
+    'que', 'por', 'para', 'con', 'las', 'los', 'del', 'una', 'uno', 'unos', 'unas', 'como', 'mas',
+    'pero', 'sus', 'mis', 'esta', 'este', 'esto', 'estan', 'son', 'hay', 'muy', 'cuando', 'donde',
+    'sobre', 'porque', 'cual', 'tiene', 'tengo', 'puedo', 'debo', 'hace',
+}
+
+# Campañas de difusión a todos los usuarios (/difusion)
+BROADCAST_RATE_PER_SECOND = 25   # Por debajo del límite global de Telegram (~30 mensajes por segundo)
+BROADCAST_PAGE_SIZE = 100        # Usuarios leídos por página; el progreso se guarda tras cada página
+BROADCAST_MAX_ATTEMPTS = 3       # Intentos por usuario cuando Telegram responde RetryAfter
+
+# Sesiones de usuario en memoria (estado de la conversación entre mensajes)
+SESSION_MAX_USERS = 20000        # Tope duro de sesiones en memoria; las menos recientes se guardan en SQLite
+SESSION_IDLE_SECONDS = 30 * 60   # Inactividad tras la que se descarga la sesión y termina la conversación
+SESSION_EVICT_INTERVAL_SECONDS = 60
+
+# Solicitudes duplicadas (doble toque, reenvíos mientras el bot está lento)
+SINGLE_FLIGHT_RECENT_SECONDS = 30   # Ventana en la que una pregunta, foto o callback con efectos repetidos reutilizan el resultado
+SINGLE_FLIGHT_REMEMBER_PREFIXES = (  # Callbacks con efectos; la navegación entre menús solo se agrupa mientras está en curso
+    'plant_', 'cancel_planting', 'cancel_reminder_', 'time_',
+)
+
+# Estadísticas en vivo (/stats)
+STATS_ACTIVE_MINUTES = 15        # Ventana por defecto para contar usuarios activos
+STATS_ACTIVITY_MAX_MINUTES = 24 * 60  # Ventana máxima que se guarda en memoria
+STATS_LATENCY_WINDOW = 500       # Escrituras recientes usadas para los percentiles de latencia
+
+# Reparto de las tablas por usuario entre varios archivos SQLite (un escritor por archivo)
+SHARD_COUNT = 1                              # Cambiarlo requiere 'python mainAIGoogle.py reshard --to N' con el bot detenido
+SHARD_DB_TEMPLATE = 'hydroponic_bot_shard{shard}.db'
+SHARDED_TABLES = [                           # Tablas con columna user_id que viven en el shard del usuario
+    'users', 'interactions', 'plant_selections', 'reminders',
+    'care_digests', 'interaction_stats', 'sheetdb_outbox', 'user_sessions',
+]
+
+# Configuración de retención del historial de interacciones
+ARCHIVE_DB_PATH = 'hydroponic_bot_archive.db'  # Base de datos adjunta donde se archivan las interacciones antiguas
+RETENTION_DAYS = 90                # Antigüedad a partir de la cual se archiva una interacción
+RETENTION_BATCH_SIZE = 500         # Filas movidas por transacción
+RETENTION_MAX_BATCHES = 20         # Lotes máximos por ejecución del job
+RETENTION_QUIET_MINUTES = 10       # Minutos sin interacciones para considerar un periodo tranquilo
+RETENTION_VACUUM_PAGES = 1000      # Páginas liberadas por cada PRAGMA incremental_vacuum
+RETENTION_INTERVAL_SECONDS = 1800  # Frecuencia del job de mantenimiento
+
+# Compresión de users.context e interactions.response
+COMPRESSION_VERSION = 1            # Formato con el que se escriben los valores nuevos (primer byte del BLOB)
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_BYTES = 64         # Los textos más cortos se guardan sin comprimir
+RECOMPRESS_BATCH_SIZE = 500        # Filas recomprimidas por transacción
+RECOMPRESS_MAX_BATCHES = 20        # Lotes máximos por tabla en cada ejecución del mantenimiento
+COMPRESSED_COLUMNS = {             # Tabla: (columna de paginación, columna comprimida)
+    'interactions': ('id', 'response'),
+    'users': ('user_id', 'context'),
+}
+
+# Configuración del outbox hacia SheetDB
+OUTBOX_DRAIN_INTERVAL_SECONDS = 15
+OUTBOX_BATCH_SIZE = 50           # Operaciones reenviadas por ejecución del drenador
+OUTBOX_KEEP_DAYS = 7             # Días que se conservan las operaciones ya enviadas
+OUTBOX_MAX_ATTEMPTS = 10         # Intentos fallidos tras los que una operación se descarta (dead_at)
+
+# Configuración del espejo local de la hoja de SheetDB
+SHEET_SYNC_INTERVAL_SECONDS = 300
+SHEET_SYNC_PAGE_SIZE = 500
+SHEET_MIRROR_MAX_AGE_SECONDS = 900  # Antigüedad máxima del espejo para responder consultas sin ir a SheetDB
+
+# Configuración de exportación para analítica
+EXPORT_DIR = 'exports'
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_TABLES = {
+    'interactions': ['id', 'user_id', 'message', 'response', 'timestamp'],
+    'plant_selections': ['id', 'user_id', 'plant_type', 'timestamp'],
+}
+
+# Configuración de los resúmenes diarios de cuidado
+DIGEST_TIMEZONE = 'America/Bogota'
+DIGEST_BUILD_HOUR = 3            # Hora (fuera de pico) en la que se generan los resúmenes
+DIGEST_CONCURRENCY = 4           # Llamadas simultáneas a Gemini durante la generación
+DIGEST_BATCH_SIZE = 50           # Plantaciones procesadas por lote
+DIGEST_RECENT_INTERACTIONS = 3   # Interacciones recientes incluidas en el prompt
+
+# Configuración de la ingesta de telemetría de los dispositivos
+TELEMETRY_HOST = '127.0.0.1'          # Escuchar fuera de localhost exige TELEMETRY_TOKEN
+TELEMETRY_PORT = 8080                 # Puerto del endpoint HTTP de ingesta (None = desactivado)
+TELEMETRY_TOKEN = None                # Token esperado en la cabecera X-Telemetry-Token (None = solo localhost)
+TELEMETRY_FLUSH_INTERVAL_SECONDS = 5
+TELEMETRY_BUFFER_MAX = 50000          # Lecturas en memoria antes de rechazar con 503
+TELEMETRY_MAX_BODY_BYTES = 256 * 1024
+TELEMETRY_RAW_KEEP_DAYS = 7           # Lecturas crudas conservadas
+TELEMETRY_MINUTE_KEEP_DAYS = 30       # Agregados por minuto conservados (los horarios y diarios no se purgan)
+TELEMETRY_PRUNE_BATCH_SIZE = 5000     # Filas borradas por transacción al purgar
+TELEMETRY_PRUNE_INTERVAL_SECONDS = 3600
+# Métricas aceptadas: nombre y unidad
+SENSOR_METRICS = {
+    'ph': ('pH', ''),
+    'ec': ('Conductividad', ' mS/cm'),
+    'temp_agua': ('Temperatura del agua', ' °C'),
+    'nivel': ('Nivel del depósito', ' %'),
+}
+# Resoluciones de los agregados (segundos por intervalo)
+SENSOR_ROLLUPS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+# Configuración de las alertas sobre las lecturas de los dispositivos
+ALERT_CONFIRM_READINGS = 3            # Lecturas seguidas fuera de rango antes de alertar
+ALERT_REPEAT_SECONDS = 6 * 3600       # Tiempo antes de repetir una alerta que sigue activa
+ALERT_STALE_SECONDS = 30 * 60         # Sin lecturas durante este tiempo se avisa al usuario
+ALERT_CHECK_INTERVAL_SECONDS = 60     # Frecuencia de la revisión de dispositivos sin datos y del envío de alertas
+ALERT_CONTEXT_TTL_SECONDS = 300       # Vigencia en memoria de la relación dispositivo -> usuarios y cultivo
+ALERT_RATE_WINDOW_SECONDS = 600       # Ventana mínima para calcular la velocidad de cambio
+ALERT_MIN_LEVEL = 20                  # Nivel mínimo del depósito (%)
+# Métrica -> clave de rango en PLANT_KNOWLEDGE
+ALERT_KNOWLEDGE_KEYS = {
+    'ph': 'ph',
+    'ec': 'ec',
+    'temp_agua': 'temp_solucion',
+}
+# Margen para dar por resuelta una alerta de rango (evita alertas intermitentes en el límite)
+ALERT_HYSTERESIS = {
+    'ph': 0.1,
+    'ec': 0.1,
+    'temp_agua': 0.5,
+    'nivel': 2,
+}
+# Cambio máximo por hora antes de alertar
+ALERT_RATE_LIMITS = {
+    'ph': 0.5,
+    'ec': 0.5,
+    'temp_agua': 3.0,
+    'nivel': 25,
+}
+
 # Estados para el ConversationHandler
 DEVICE_ID = 1
 AI_CONSULTATION = 2
 REMINDER_MESSAGE = 3
 REMINDER_TIME = 4
 
+# Catálogo de cultivos disponibles (callback_data 'plant_<clave>')
+PLANT_OPTIONS = [
+    ('lechuga', "🥬 Lechuga"),
+    ('acelga', "🌿 Acelga"),
+    ('espinaca', "🍃 Espinaca"),
+    ('aromaticas', "🌿 Aromáticas"),
+    ('chile', "🌶️ Chile/Pimiento"),
+    ('jitomate', "🍅 Jitomate"),
+    ('ornamentales', "🌸 Ornamentales"),
+]
+
+# Opciones de tiempo para los recordatorios (callback_data 'time_<clave>'): minutos y etiqueta
+REMINDER_TIME_OPTIONS = {
+    '15m': (15, '15 minutos'),
+    '30m': (30, '30 minutos'),
+    '1h': (60, '1 hora'),
+    '2h': (120, '2 horas'),
+    '6h': (360, '6 horas'),
+    '12h': (720, '12 horas'),
+    '1d': (1440, '1 día'),
+    '3d': (4320, '3 días'),
+}
+
+# Teclados prearmados: InlineKeyboardMarkup es inmutable, así que se comparten entre mensajes
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🌱 Cultivos", callback_data='menu_plants')],
+    [InlineKeyboardButton("🤖 Consultar IA", callback_data='menu_ai')],
+    [InlineKeyboardButton("💧 Recordatorios", callback_data='menu_reminders')],
+    [InlineKeyboardButton("ℹ️ Ayuda", callback_data='menu_help')]
+])
+
+BACK_TO_MAIN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Regresar al menú principal", callback_data='menu_main')]
+])
+
+REMINDER_NOTIFICATION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Menú principal", callback_data='menu_main')]
+])
+
+HELP_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Reiniciar bot", callback_data='help_start')],
+    [InlineKeyboardButton("🗑️ Limpiar conversación", callback_data='help_clear')],
+    [InlineKeyboardButton("📱 Cambiar dispositivo", callback_data='help_device')],
+    [InlineKeyboardButton("↩️ Volver al menú", callback_data='menu_main')]
+])
+
+PLANTS_MENU_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(label, callback_data=f'plant_{key}')] for key, label in PLANT_OPTIONS]
+    + [[InlineKeyboardButton("↩️ Volver", callback_data='menu_main')]]
+)
+
+ACTIVE_PLANTING_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Cancelar plantación actual", callback_data='cancel_planting')],
+    [InlineKeyboardButton("↩️ Volver al menú", callback_data='menu_main')]
+])
+
+PLANT_REGISTERED_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("↩️ Volver", callback_data='menu_plants')]
+])
+
+REMINDERS_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⏰ Configurar recordatorio", callback_data='reminder_set')],
+    [InlineKeyboardButton("📝 Ver recordatorios", callback_data='reminder_list')],
+    [InlineKeyboardButton("↩️ Volver", callback_data='menu_main')]
+])
+
+NO_REMINDERS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Crear recordatorio", callback_data='reminder_set')],
+    [InlineKeyboardButton("↩️ Volver", callback_data='menu_main')]
+])
+
+REMINDER_CANCELLED_MARKUP = InlineKeyboardMarkup([[
+    InlineKeyboardButton("📝 Ver recordatorios", callback_data='reminder_list'),
+    InlineKeyboardButton("↩️ Menú", callback_data='menu_main')
+]])
+
+REMINDER_TIME_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(f"⏰ {label}", callback_data=f'time_{key}')] for key, (_, label) in REMINDER_TIME_OPTIONS.items()]
+    + [[InlineKeyboardButton("❌ Cancelar", callback_data='menu_main')]]
+)
+
+REMINDER_SAVED_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Ver recordatorios", callback_data='reminder_list')],
+    [InlineKeyboardButton("➕ Otro recordatorio", callback_data='reminder_set')],
+    [InlineKeyboardButton("🏠 Menú principal", callback_data='menu_main')]
+])
+
+# Enrutador declarativo de callback_data
+class CallbackRouter:
+    """Resuelve callback_data a su handler con búsquedas en diccionario.
+
+    Las rutas exactas ('menu_main') se buscan directamente. Las rutas con parámetro
+    ('plant_<tipo>', 'cancel_reminder_<id>') se buscan por el texto anterior al último '_'
+    y el parámetro se convierte una sola vez al tipo declarado.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixed = {}
+
+    def route(self, data):
+        """Registra un handler para un callback_data exacto"""
+        def decorator(handler):
+            self._exact[data] = handler
+            return handler
+        return decorator
+
+    def prefix(self, prefix, param_type=str):
+        """Registra un handler para '<prefix>_<parámetro>'"""
+        def decorator(handler):
+            self._prefixed[prefix] = (handler, param_type)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        """Devuelve (handler, argumentos) o None si el callback no tiene ruta"""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, ()
+        
+        prefix, _, raw_param = data.rpartition('_')
+        entry = self._prefixed.get(prefix)
+        if entry is None:
+            return None
+        
+        handler, param_type = entry
+        try:
+            return handler, (param_type(raw_param),)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def matcher(*keys):
+        """Filtro para CallbackQueryHandler que acepta solo las rutas (exactas o prefijos) indicadas"""
+        keys = frozenset(keys)
+        
+        def match(data):
+            return isinstance(data, str) and (data in keys or data.rpartition('_')[0] in keys)
+        
+        return match
+
+CALLBACK_ROUTER = CallbackRouter()
+
+# Callbacks que inician o reanudan el ConversationHandler
+CONVERSATION_ENTRY_CALLBACKS = CallbackRouter.matcher(
+    'menu_ai', 'reminder_set', 'cancel_planting', 'help_start', 'help_clear', 'help_device'
+)
+CONVERSATION_FALLBACK_CALLBACKS = CallbackRouter.matcher(
+    'menu_main', 'cancel_planting', 'help_start', 'help_clear', 'help_device'
+)
+
 # Configuración del ConversationHandler corregida
 def setup_conversation_handler():
     conv_handler = ConversationHandler(
         entry_points=[
-            CommandHandler("start", start), 
-            CommandHandler("device", device_command),
-            CallbackQueryHandler(handle_menu, pattern='^menu_ai$'),
-            CallbackQueryHandler(handle_reminder_menu, pattern='^reminder_set$'),
-            CallbackQueryHandler(cancel_planting_handler, pattern='^cancel_planting$'),  # Entry point para cancelación
-            CallbackQueryHandler(handle_help_actions, pattern='^help_')  # Entry point para acciones de ayuda
+            CommandHandler("start", instrument_handler(start)), 
+            CommandHandler("device", instrument_handler(device_command)),
+            CallbackQueryHandler(route_callback, pattern=CONVERSATION_ENTRY_CALLBACKS)
         ],
         states={
             DEVICE_ID: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, save_device_id_handler)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler(save_device_id_handler))
             ],
             AI_CONSULTATION: [
-                MessageHandler(filters.TEXT | filters.PHOTO, handle_ai_consultation),
-                CallbackQueryHandler(handle_menu, pattern='^menu_main$')
+                MessageHandler(filters.TEXT | filters.PHOTO, instrument_handler(handle_ai_consultation)),
+                CallbackQueryHandler(route_callback, pattern=CallbackRouter.matcher('menu_main'))
             ],
             REMINDER_MESSAGE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_reminder_message)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler(handle_reminder_message))
             ],
             REMINDER_TIME: [
-                CallbackQueryHandler(handle_reminder_time, pattern='^(time_|menu_main)')
+                CallbackQueryHandler(route_callback, pattern=CallbackRouter.matcher('time', 'menu_main'))
             ]
         },
         fallbacks=[
-            CommandHandler("start", start),
-            CallbackQueryHandler(handle_menu, pattern='^menu_main$'),
-            CallbackQueryHandler(cancel_planting_handler, pattern='^cancel_planting$'),  # También como fallback
-            CallbackQueryHandler(handle_help_actions, pattern='^help_')  # También como fallback
+            CommandHandler("start", instrument_handler(start)),
+            CallbackQueryHandler(route_callback, pattern=CONVERSATION_FALLBACK_CALLBACKS)
         ],
-        allow_reentry=True
+        allow_reentry=True,
+        conversation_timeout=SESSION_IDLE_SECONDS
     )
     return conv_handler
 
-# Función para registrar selección de planta en SheetDB
-def registrar_seleccion_planta(user_id, username, first_name, planta, device_id):
+# Punto único de despacho para todos los callbacks
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    
+    resolved = CALLBACK_ROUTER.resolve(query.data)
+    if resolved is None:
+        await query.answer()
+        logger.warning(f"Callback sin ruta: {query.data}")
+        return None
+    
+    # Los toques repetidos de un mismo botón esperan al primero; si el botón tiene efectos
+    # y ya terminó, se responden sin repetirlos (los menús editan el mismo mensaje y se pueden volver a pulsar)
+    key = ('callback', query.from_user.id, query.message.message_id if query.message else None, query.data)
+    remember = query.data.startswith(SINGLE_FLIGHT_REMEMBER_PREFIXES)
+    if remember and SINGLE_FLIGHT.is_recent(key):
+        await query.answer("✔️ Ya procesado")
+        logger.info(f"Callback duplicado ignorado: {query.data} de {query.from_user.id}")
+        return None
+    await query.answer("⏳ Procesando..." if key in SINGLE_FLIGHT.in_flight else None)
+    
+    handler, args = resolved
+    result, _ = await SINGLE_FLIGHT.run(
+        key, lambda: TimedCoroutine(handler(update, context, *args), get_handler_stats(handler.__name__)), remember=remember
+    )
+    return result
+
+# Capa de resiliencia para dependencias externas (Gemini, SheetDB)
+class DependencyUnavailable(Exception):
+    """El circuito de la dependencia está abierto: se falla de inmediato sin llamarla"""
+
+class SheetDBRejected(Exception):
+    """SheetDB rechazó la operación con un 4xx no reintentable: repetirla no cambiará el resultado"""
+
+class CircuitBreaker:
+    """Circuit breaker por dependencia: se abre tras varios fallos seguidos y deja pasar
+    una solicitud de prueba cuando vence el tiempo de espera."""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return 'half_open'
+        return 'open'
+
+    def is_open(self):
+        return self.state == 'open'
+
+    def allow(self):
+        """Indica si se puede llamar a la dependencia; en half_open solo pasa una prueba a la vez"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuito de {self.name} cerrado: la dependencia respondió")
+            self.failures = 0
+            self.opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Circuito de {self.name} abierto tras {self.failures} fallos seguidos")
+                self.opened_at = time.monotonic()
+
+CIRCUIT_BREAKERS = {name: CircuitBreaker(name) for name in DEPENDENCY_TIMEOUTS}
+
+def get_circuit_breaker(dependency):
+    """Circuit breaker de una dependencia; 'gemini:<modelo>' tiene uno propio por modelo"""
+    breaker = CIRCUIT_BREAKERS.get(dependency)
+    if breaker is None:
+        breaker = CIRCUIT_BREAKERS.setdefault(dependency, CircuitBreaker(dependency))
+    return breaker
+
+# Pool para las solicitudes de respaldo (hedging) a Gemini
+_hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+def backoff_delay(attempt, retry_after=None):
+    """Backoff exponencial con jitter completo; respeta Retry-After si la dependencia lo envía"""
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+def parse_retry_after(response):
     try:
-        # Preparar los datos para SheetDB
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Asegurarse de que los valores son strings para evitar errores
-        user_id_str = str(user_id)
-        username = username if username else "Sin username"
-        first_name = first_name if first_name else "Sin nombre"
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def resilient_request(dependency, method, url, idempotent=False, **kwargs):
+    """requests.request con plazo por dependencia, reintentos (solo si es idempotente) y circuit breaker.
+
+    Devuelve la última respuesta HTTP obtenida; lanza DependencyUnavailable si el circuito está
+    abierto o la excepción de red del último intento.
+    """
+    breaker = get_circuit_breaker(dependency)
+    kwargs.setdefault('timeout', DEPENDENCY_TIMEOUTS[dependency.split(':')[0]])
+    attempts = RETRY_MAX_ATTEMPTS if idempotent else 1
+    
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise DependencyUnavailable(dependency)
         
-        data = {
-            "Fecha": now,
-            "UserID": user_id_str,
-            "Username": username,
-            "Nombre": first_name,
-            "Planta": planta,
-            "DispositivoID": device_id,
-            "Plantado": "true"  # Asignar true cuando selecciona una planta
-        }
+        retry_after = None
+        try:
+            response = requests.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            breaker.record_failure()
+            logger.warning(f"Fallo de red con {dependency} (intento {attempt + 1}/{attempts}): {e}")
+            if attempt + 1 == attempts:
+                raise
+        else:
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                # Los errores 4xx son del cliente, no de la dependencia
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            logger.warning(f"{dependency} respondió {response.status_code} (intento {attempt + 1}/{attempts})")
+            if attempt + 1 == attempts:
+                return response
+            retry_after = parse_retry_after(response)
         
+        time.sleep(backoff_delay(attempt, retry_after))
+
+def hedged_request(dependency, method, url, hedge_after, **kwargs):
+    """Lanza una segunda solicitud idéntica si la primera no responde en hedge_after segundos
+    y devuelve la primera que termine bien (solo para llamadas idempotentes)."""
+    first = _hedge_executor.submit(resilient_request, dependency, method, url, idempotent=True, **kwargs)
+    done, _ = wait([first], timeout=hedge_after)
+    if done:
+        return first.result()
+    
+    second = _hedge_executor.submit(resilient_request, dependency, method, url, idempotent=True, **kwargs)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+# Función para construir la fila de SheetDB de una selección de planta
+def build_sheet_row(user_id, username, first_name, planta, device_id):
+    # Preparar los datos para SheetDB
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    # Asegurarse de que los valores son strings para evitar errores
+    return {
+        "Fecha": now,
+        "UserID": str(user_id),
+        "Username": username if username else "Sin username",
+        "Nombre": first_name if first_name else "Sin nombre",
+        "Planta": planta,
+        "DispositivoID": device_id,
+        "Plantado": "true"  # Asignar true cuando selecciona una planta
+    }
+
+# Función para registrar selección de planta en SheetDB
+def registrar_seleccion_planta(user_id, username, first_name, planta, device_id):
+    return enviar_fila_sheetdb(build_sheet_row(user_id, username, first_name, planta, device_id))
+
+# Función para enviar una fila ya construida a SheetDB
+def enviar_fila_sheetdb(data):
+    try:
         # Hacer la solicitud POST a SheetDB
         headers = {'Content-Type': 'application/json'}
-        response = requests.post(
+        # POST no idempotente: un solo intento para no duplicar filas
+        response = resilient_request(
+            'sheetdb', 'POST',
             SHEETDB_API_URL,
             json=data,
             headers=headers
@@ -100,24 +669,80 @@ def registrar_seleccion_planta(user_id, username, first_name, planta, device_id)
         
         # Verificar si la solicitud fue exitosa
         if response.status_code == 201 or response.status_code == 200:
-            logger.info(f"Selección de planta registrada en SheetDB: {planta} por {username}")
+            logger.info(f"Selección de planta registrada en SheetDB: {data['Planta']} por {data['Username']}")
             return True
         else:
             logger.error(f"Error al registrar en SheetDB. Código: {response.status_code}, Respuesta: {response.text}")
+            if is_permanent_rejection(response):
+                raise SheetDBRejected(f"HTTP {response.status_code}: {response.text[:200]}")
             return False
             
+    except DependencyUnavailable:
+        logger.warning("SheetDB no disponible: circuito abierto")
+        return False
+    except SheetDBRejected:
+        raise
     except Exception as e:
         logger.error(f"Error al registrar selección en SheetDB: {e}")
         return False
 
+def is_permanent_rejection(response):
+    """Un 4xx que no sea de tiempo o límite de tasa no se arregla reintentando"""
+    return 400 <= response.status_code < 500 and response.status_code not in RETRYABLE_STATUS_CODES | {408}
+
+# Función para comprobar si una fila ya existe en SheetDB (para reenvíos idempotentes)
+def existe_fila_sheetdb(data):
+    busqueda_url = (
+        f"{SHEETDB_API_URL}/search?UserID={data['UserID']}&DispositivoID={data['DispositivoID']}"
+        f"&Fecha={requests.utils.quote(data['Fecha'])}"
+    )
+    respuesta = resilient_request('sheetdb', 'GET', busqueda_url, idempotent=True)
+    return respuesta.status_code == 200 and len(respuesta.json()) > 0
+
+# Función para eliminar el registro de un usuario y dispositivo en SheetDB
+def eliminar_registro_sheetdb(user_id, device_id):
+    try:
+        # Construir URL para eliminar por UserID y DispositivoID
+        delete_url = f"{SHEETDB_API_URL}/UserID/{user_id}/DispositivoID/{device_id}"
+        response = resilient_request('sheetdb', 'DELETE', delete_url, idempotent=True)
+        
+        # 404: no hay filas que borrar, el resultado es el mismo
+        if response.status_code in [200, 204, 404]:
+            logger.info(f"Registro eliminado de SheetDB para user_id {user_id} y device_id {device_id}")
+            return True
+        logger.warning(f"Respuesta inesperada al eliminar de SheetDB: {response.status_code}")
+        if is_permanent_rejection(response):
+            raise SheetDBRejected(f"HTTP {response.status_code}: {response.text[:200]}")
+        return False
+    except DependencyUnavailable:
+        logger.warning("SheetDB no disponible: circuito abierto")
+        return False
+    except SheetDBRejected:
+        raise
+    except Exception as e:
+        logger.error(f"Error al eliminar registro de SheetDB: {e}")
+        return False
+
 # Función para consultar si el usuario tiene una planta activa
 def consultar_estado_plantacion(user_id, device_id):
+    # Las operaciones aún pendientes en el outbox son más recientes que la hoja
+    pendiente = get_pending_sheet_state(user_id, device_id)
+    if pendiente is not None:
+        CACHE_COUNTERS['estado_plantacion'].record(True)
+        return pendiente
+    
+    # Con el espejo al día la consulta se responde localmente
+    if is_mirror_fresh():
+        CACHE_COUNTERS['estado_plantacion'].record(True)
+        return get_mirror_active_plant(user_id, device_id)
+    
+    CACHE_COUNTERS['estado_plantacion'].record(False)
     try:
         # Construir URL para buscar por UserID y DispositivoID
         busqueda_url = f"{SHEETDB_API_URL}/search?UserID={user_id}&DispositivoID={device_id}"
         
         # Realizar la solicitud GET
-        respuesta = requests.get(busqueda_url)
+        respuesta = resilient_request('sheetdb', 'GET', busqueda_url, idempotent=True)
         
         if respuesta.status_code == 200:
             resultados = respuesta.json()
@@ -138,11 +763,556 @@ def consultar_estado_plantacion(user_id, device_id):
         logger.error(f"Error al consultar estado de plantación: {e}")
         return False, ""
 
+# Contadores en memoria para /stats: baratos de actualizar y de leer bajo carga
+class Gauge:
+    """Valor entero compartido entre hilos (colas, solicitudes en curso)"""
+    
+    def __init__(self, value=0):
+        self.value = value
+        self._lock = threading.Lock()
+    
+    def add(self, delta):
+        with self._lock:
+            self.value += delta
+    
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+class CacheCounter:
+    """Aciertos y fallos de una caché"""
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+    
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+class LatencyWindow:
+    """Latencias recientes en ms para calcular percentiles"""
+    
+    def __init__(self, size=STATS_LATENCY_WINDOW):
+        self.samples = deque(maxlen=size)
+    
+    def record(self, latency_ms):
+        self.samples.append(latency_ms)
+    
+    def percentiles(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.95))], len(samples)
+
+GEMINI_IN_FLIGHT = Gauge()
+OUTBOX_DEPTH = Gauge()
+PENDING_REMINDERS = Gauge()
+DB_WRITE_LATENCY = LatencyWindow()
+CACHE_COUNTERS = {
+    'imagenes_gemini': CacheCounter(),      # URIs de fotos ya subidas
+    'base_conocimiento': CacheCounter(),    # Preguntas respondidas sin llamar a Gemini
+    'estado_plantacion': CacheCounter(),    # Consultas resueltas con el outbox o el espejo, sin SheetDB
+    'tokens_diarios': CacheCounter(),       # Presupuestos de tokens leídos de memoria
+    'suscriptores_alertas': CacheCounter(), # Dispositivos con usuarios ya en memoria
+    'respuestas_ia': CacheCounter(),        # Preguntas respondidas con una respuesta anterior bajo sobrecarga
+    'solicitudes_compartidas': CacheCounter(),  # Solicitudes idénticas atendidas por otra ya en curso
+}
+_recent_activity = {}   # user_id -> última actividad (epoch), espejo en memoria de users.last_activity
+
+def touch_user_activity(user_id, timestamp=None):
+    _recent_activity[user_id] = timestamp or time.time()
+
+def count_active_users(minutes):
+    """Usuarios con actividad en los últimos minutos; descarta lo que sale de la ventana máxima"""
+    now = time.time()
+    for user_id, last_seen in list(_recent_activity.items()):
+        if now - last_seen > STATS_ACTIVITY_MAX_MINUTES * 60:
+            _recent_activity.pop(user_id, None)
+    since = now - minutes * 60
+    return sum(1 for last_seen in list(_recent_activity.values()) if last_seen >= since)
+
+def timed_db_write(func):
+    """Registra en DB_WRITE_LATENCY la duración de un helper de escritura"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_WRITE_LATENCY.record((time.perf_counter() - started) * 1000)
+    return wrapper
+
+def load_runtime_stats():
+    """Inicializa los contadores al arrancar; es la única lectura en SQL de las estadísticas"""
+    since = datetime.now() - timedelta(minutes=STATS_ACTIVITY_MAX_MINUTES)
+    reminders = 0
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, last_activity FROM users WHERE last_activity >= ?", (since,))
+        for user_id, last_activity in cursor.fetchall():
+            try:
+                touch_user_activity(user_id, parse_datetime_flexible(last_activity).timestamp())
+            except (ValueError, TypeError):
+                continue
+        cursor.execute("SELECT COUNT(*) FROM reminders WHERE is_active = 1")
+        reminders += cursor.fetchone()[0]
+        conn.close()
+    PENDING_REMINDERS.set(reminders)
+    OUTBOX_DEPTH.set(get_outbox_depth())
+
+# Reparto de las tablas por usuario entre shards
+_row_id_lock = threading.Lock()
+_last_row_id = 0
+
+def get_shard(user_id, shard_count=None):
+    """Shard del usuario según un hash estable de su user_id"""
+    shard_count = shard_count or SHARD_COUNT
+    if shard_count == 1 or user_id is None:
+        return 0
+    digest = hashlib.md5(str(int(user_id)).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+def get_shard_path(shard, shard_count=None):
+    """Archivo SQLite de un shard; con un solo shard se usa DB_PATH"""
+    if (shard_count or SHARD_COUNT) == 1:
+        return DB_PATH
+    return SHARD_DB_TEMPLATE.format(shard=shard)
+
+def get_shard_paths(shard_count=None):
+    return [get_shard_path(shard, shard_count) for shard in range(shard_count or SHARD_COUNT)]
+
+def connect_user_db(user_id, timeout=5.0):
+    """Conexión al shard que guarda los datos del usuario"""
+    return sqlite3.connect(get_shard_path(get_shard(user_id)), timeout=timeout)
+
+def next_row_id():
+    """Id creciente y único entre shards (milisegundos << 20 + secuencia) para las tablas repartidas.
+    
+    Mantiene el orden por id entre shards (exportaciones, archivo) y permite mover filas
+    entre shards sin renumerarlas.
+    """
+    global _last_row_id
+    with _row_id_lock:
+        _last_row_id = max(_last_row_id + 1, int(time.time() * 1000) << 20)
+        return _last_row_id
+
+def group_by_shard(user_ids):
+    """Agrupa user_ids por shard: {shard: [user_id, ...]}"""
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(get_shard(user_id), []).append(user_id)
+    return groups
+
+def get_usernames(user_ids):
+    """Obtiene {user_id: username} consultando cada shard una sola vez"""
+    usernames = {}
+    for shard, shard_user_ids in group_by_shard(user_ids).items():
+        conn = sqlite3.connect(get_shard_path(shard))
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(shard_user_ids))
+        cursor.execute(f"SELECT user_id, username FROM users WHERE user_id IN ({placeholders})", shard_user_ids)
+        usernames.update(cursor.fetchall())
+        conn.close()
+    return usernames
+
+def reshard(new_count, chunk_size=EXPORT_CHUNK_SIZE):
+    """Redistribuye offline las tablas por usuario entre new_count shards; devuelve las filas movidas.
+    
+    Los destinos se escriben en archivos '.reshard' y solo se activan cuando los conteos
+    coinciden; los shards anteriores quedan como '.bak'. Con el bot detenido.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    old_count = get_stored_shard_count(cursor)
+    conn.commit()
+    conn.close()
+    if old_count == new_count:
+        logger.info(f"Los datos ya están repartidos en {new_count} shard(s)")
+        return 0
+    
+    old_paths = get_shard_paths(old_count)
+    new_paths = get_shard_paths(new_count)
+    # DB_PATH también guarda las tablas globales, así que se escribe directamente
+    staging = {path: path if path == DB_PATH else path + '.reshard' for path in new_paths}
+    for staged in staging.values():
+        if staged != DB_PATH and os.path.exists(staged):
+            os.remove(staged)
+        init_shard_db(staged)
+    init_reminders_table(list(staging.values()))
+    targets = [sqlite3.connect(staging[path]) for path in new_paths]
+    
+    moved = 0
+    for table in SHARDED_TABLES:
+        source_rows = 0
+        for source_path in old_paths:
+            if not os.path.exists(source_path):
+                continue
+            source = sqlite3.connect(source_path)
+            columns = [row[1] for row in source.execute(f"PRAGMA table_info({table})")]
+            if not columns:
+                source.close()
+                continue
+            user_index = columns.index('user_id')
+            insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            query = f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+            last_rowid = 0
+            while True:
+                rows = source.execute(query, (last_rowid, chunk_size)).fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                by_shard = {}
+                for row in rows:
+                    by_shard.setdefault(get_shard(row[1 + user_index], new_count), []).append(row[1:])
+                for shard, values in by_shard.items():
+                    targets[shard].executemany(insert, values)
+                source_rows += len(rows)
+            source.close()
+        
+        for target in targets:
+            target.commit()
+        target_rows = sum(target.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for target in targets)
+        if target_rows != source_rows:
+            for target in targets:
+                target.close()
+            raise RuntimeError(f"Reparto de {table} incompleto: {source_rows} filas origen, {target_rows} destino")
+        logger.info(f"Reparto de {table}: {source_rows} filas en {new_count} shard(s)")
+        moved += source_rows
+    for target in targets:
+        rebuild_interaction_index(target.cursor())
+        target.commit()
+        target.close()
+    
+    # Activar el nuevo reparto: retirar los shards anteriores y renombrar los nuevos
+    for source_path in old_paths:
+        if source_path == DB_PATH:
+            conn = sqlite3.connect(DB_PATH)
+            existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            for table in SHARDED_TABLES:
+                if table in existing:
+                    conn.execute(f"DELETE FROM {table}")
+            if 'interactions_fts' in existing:
+                conn.execute("INSERT INTO interactions_fts (interactions_fts) VALUES ('delete-all')")
+            conn.commit()
+            conn.close()
+        elif os.path.exists(source_path):
+            os.replace(source_path, source_path + '.bak')
+    for path, staged in staging.items():
+        if staged != path:
+            os.replace(staged, path)
+    
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("UPDATE shard_layout SET shard_count = ? WHERE id = 1", (new_count,))
+    conn.commit()
+    conn.close()
+    return moved
+
+def run_reshard(argv):
+    """Comando de reparto: python mainAIGoogle.py reshard --to N"""
+    parser = argparse.ArgumentParser(prog='mainAIGoogle.py reshard',
+                                     description="Redistribuye las tablas por usuario entre N archivos SQLite (con el bot detenido)")
+    parser.add_argument('--to', dest='shard_count', type=int, required=True, help="Número de shards de destino")
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    if args.shard_count < 1:
+        parser.error("--to debe ser al menos 1")
+    
+    moved = reshard(args.shard_count, args.chunk_size)
+    logger.info(f"Reparto terminado: {moved} filas movidas. Configura SHARD_COUNT = {args.shard_count} antes de iniciar el bot")
+
+def convert_to_incremental_vacuum(path):
+    """Conversión única de una base existente a auto_vacuum incremental; devuelve True si la convirtió"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] == 2:
+            return False
+        # Reescribe el archivo completo y bloquea la base mientras dura
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+    finally:
+        conn.close()
+    logger.info(f"auto_vacuum incremental activado en {path}")
+    return True
+
+def run_vacuum(argv):
+    """Comando de mantenimiento: python mainAIGoogle.py vacuum (con el bot detenido)"""
+    parser = argparse.ArgumentParser(prog='mainAIGoogle.py vacuum',
+                                     description="Convierte las bases existentes a auto_vacuum incremental con un VACUUM único")
+    parser.parse_args(argv)
+    
+    init_db()
+    converted = sum(convert_to_incremental_vacuum(path) for path in dict.fromkeys([DB_PATH, *get_shard_paths()]))
+    logger.info(f"Mantenimiento terminado: {converted} base(s) convertidas a auto_vacuum incremental")
+
 # Configuración de base de datos
+def enable_incremental_vacuum(cursor, path):
+    """Activa auto_vacuum incremental en bases nuevas; las existentes se convierten con el comando vacuum"""
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] == 2:
+        return
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master")
+    if cursor.fetchone()[0] == 0:
+        # Sin tablas todavía el modo se fija sin reescribir el archivo
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    else:
+        logger.warning(f"{path} no usa auto_vacuum incremental; ejecuta 'python mainAIGoogle.py vacuum' "
+                       "con el bot detenido para convertirla")
+
+def get_stored_shard_count(cursor):
+    """Número de shards con el que están repartidos los datos; lo registra en bases nuevas"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS shard_layout (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        shard_count INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute("SELECT shard_count FROM shard_layout WHERE id = 1")
+    result = cursor.fetchone()
+    if result:
+        return result[0]
+    
+    # Una base anterior al reparto tiene la tabla users en DB_PATH
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
+    shard_count = 1 if cursor.fetchone() else SHARD_COUNT
+    cursor.execute("INSERT INTO shard_layout (id, shard_count) VALUES (1, ?)", (shard_count,))
+    return shard_count
+
 def init_db():
-    conn = sqlite3.connect('hydroponic_bot.db')
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    enable_incremental_vacuum(cursor, DB_PATH)
+    
+    # Comprobar que SHARD_COUNT coincide con el reparto de los datos existentes
+    stored_shard_count = get_stored_shard_count(cursor)
+    conn.commit()
+    if stored_shard_count != SHARD_COUNT:
+        conn.close()
+        raise RuntimeError(
+            f"Los datos están repartidos en {stored_shard_count} shard(s) pero SHARD_COUNT = {SHARD_COUNT}; "
+            f"ejecuta 'python mainAIGoogle.py reshard --to {SHARD_COUNT}' con el bot detenido"
+        )
+    
+    # Consumo de Gemini: una fila compacta por llamada y agregados diarios por usuario y flujo
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ai_usage (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        flow TEXT,
+        model TEXT,
+        prompt_tokens INTEGER,
+        candidate_tokens INTEGER,
+        total_tokens INTEGER,
+        latency_ms INTEGER,
+        created_at INTEGER
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ai_usage_daily (
+        user_id INTEGER,
+        usage_date TEXT,
+        flow TEXT,
+        calls INTEGER DEFAULT 0,
+        prompt_tokens INTEGER DEFAULT 0,
+        candidate_tokens INTEGER DEFAULT 0,
+        total_tokens INTEGER DEFAULT 0,
+        latency_ms_total INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, usage_date, flow)
+    ) WITHOUT ROWID
+    ''')
+    
+    # Espejo local de la hoja de SheetDB
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sheet_mirror (
+        row_key TEXT PRIMARY KEY,
+        row_hash TEXT,
+        user_id TEXT,
+        device_id TEXT,
+        planta TEXT,
+        plantado TEXT,
+        data TEXT,
+        synced_at TIMESTAMP
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sheet_mirror_user ON sheet_mirror (user_id, device_id)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sheet_sync_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_sync TIMESTAMP,
+        row_count INTEGER
+    )
+    ''')
+    
+    # Telemetría de los dispositivos: lecturas crudas en orden de llegada y agregados por minuto, hora y día
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sensor_readings (
+        id INTEGER PRIMARY KEY,
+        device_id TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        value REAL NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sensor_rollups (
+        device_id TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        resolution TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        sum REAL NOT NULL,
+        min REAL NOT NULL,
+        max REAL NOT NULL,
+        last_ts INTEGER NOT NULL,
+        last_value REAL NOT NULL,
+        PRIMARY KEY (device_id, metric, resolution, bucket)
+    ) WITHOUT ROWID
+    ''')
+    
+    # Campañas de difusión: filtro, cursor de paginación (shard, último user_id) y contadores
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_campaigns (
+        id INTEGER PRIMARY KEY,
+        message TEXT NOT NULL,
+        plant_type TEXT,
+        active_days INTEGER,
+        status TEXT NOT NULL,
+        shard INTEGER DEFAULT 0,
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        created_by INTEGER,
+        created_at INTEGER,
+        finished_at INTEGER
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        campaign_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        error TEXT,
+        sent_at INTEGER,
+        PRIMARY KEY (campaign_id, user_id)
+    ) WITHOUT ROWID
+    ''')
+    
+    # Cambios de modo del control de sobrecarga
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS overload_events (
+        id INTEGER PRIMARY KEY,
+        previous_mode TEXT,
+        mode TEXT,
+        in_flight INTEGER,        -- Trabajo pendiente al cambiar de modo (ver OverloadController.pending_work)
+        p95_ms INTEGER,
+        created_at INTEGER
+    )
+    ''')
+    
+    # Estado de las alertas activas (sobrevive a reinicios para no repetir avisos)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sensor_alerts (
+        device_id TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        rule TEXT NOT NULL,
+        active INTEGER NOT NULL,
+        since INTEGER,
+        last_notified INTEGER,
+        PRIMARY KEY (device_id, metric, rule)
+    ) WITHOUT ROWID
+    ''')
+    
+    conn.commit()
+    conn.close()
+    
+    # Tablas por usuario en cada shard
+    for path in get_shard_paths():
+        init_shard_db(path)
+    logger.info("Base de datos inicializada correctamente")
+
+# Diccionarios compartidos por versión de formato. Nunca se modifican: las filas
+# ya escritas dependen de ellos; un diccionario nuevo requiere una versión nueva.
+COMPRESSION_DICTIONARIES = {
+    1: (
+        "deficiencia de nitrógeno, fósforo, potasio, calcio, magnesio o hierro. "
+        "Revisa el pH de la solución nutritiva (entre 5.5 y 6.5) y la conductividad eléctrica (EC). "
+        "La temperatura del agua debe mantenerse entre 18 y 22 °C para evitar la pudrición de raíces. "
+        "Las hojas amarillas, manchas marrones o puntas quemadas indican un problema de nutrientes. "
+        "Asegura una buena oxigenación, el flujo constante en los canales del sistema NFT, "
+        "la iluminación adecuada y la humedad relativa. Recomendaciones: "
+        "**Estado de la planta:** **Problemas visibles:** **Cuidados para hidroponía NFT:** "
+        "Como experto en hidroponía, responde brevemente (máximo 400 palabras): "
+        "soluci\\u00f3n nutritiva, hidropon\\u00eda NFT, ra\\u00edces, (m\\u00e1ximo 400 palabras): "
+        '"}]}, {"role": "model", "parts": [{"text": "'
+        '"}]}, {"role": "user", "parts": [{"text": "'
+    ).encode('utf-8'),
+}
+
+# Compresión transparente de textos almacenados (users.context, interactions.response)
+def compress_text(text):
+    """Codifica un texto para guardarlo: BLOB con byte de versión o el mismo texto si no compensa"""
+    if text is None:
+        return None
+    raw = text.encode('utf-8')
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return text
+    # Deflate sin cabecera: el byte de versión ya identifica el formato y el diccionario
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15,
+                                  zdict=COMPRESSION_DICTIONARIES[COMPRESSION_VERSION])
+    blob = bytes([COMPRESSION_VERSION]) + compressor.compress(raw) + compressor.flush()
+    return blob if len(blob) < len(raw) else text
+
+def decompress_text(value):
+    """Devuelve el texto original de un valor guardado (texto plano heredado o BLOB versionado)"""
+    if value is None or isinstance(value, str):
+        return value
+    version = value[0]
+    if version not in COMPRESSION_DICTIONARIES:
+        raise ValueError(f"Versión de compresión desconocida: {version}")
+    decompressor = zlib.decompressobj(-15, zdict=COMPRESSION_DICTIONARIES[version])
+    return (decompressor.decompress(value[1:]) + decompressor.flush()).decode('utf-8')
+
+def needs_recompression(value):
+    """Indica si un valor guardado no está en el formato actual y podría comprimirse"""
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) >= COMPRESSION_MIN_BYTES
+    return isinstance(value, bytes) and value[0] != COMPRESSION_VERSION
+
+def register_compression_functions(conn):
+    """Expone decompress_text a las consultas SQL de la conexión"""
+    conn.create_function('decompress_text', 1, decompress_text, deterministic=True)
+
+def rebuild_interaction_index(cursor):
+    """Regenera interactions_fts a partir de las interacciones del shard"""
+    register_compression_functions(cursor.connection)
+    cursor.execute("INSERT INTO interactions_fts (interactions_fts) VALUES ('delete-all')")
+    cursor.execute(
+        "INSERT INTO interactions_fts (rowid, user_key, message, response) "
+        "SELECT id, 'u' || user_id, message, decompress_text(response) FROM interactions"
+    )
+    if cursor.rowcount > 0:
+        logger.info(f"Índice de búsqueda regenerado con {cursor.rowcount} interacciones")
+
+def init_shard_db(path):
+    """Crea las tablas por usuario en un shard"""
+    conn = sqlite3.connect(path)
     cursor = conn.cursor()
     
+    enable_incremental_vacuum(cursor, path)
+    
     # Verificar si la tabla users existe
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
     table_exists = cursor.fetchone()
@@ -157,7 +1327,10 @@ def init_db():
             language TEXT DEFAULT 'es',
             last_activity TIMESTAMP,
             context TEXT,
-            device_id TEXT
+            device_id TEXT,
+            digest_hour INTEGER,
+            blocked_at TIMESTAMP,
+            timezone TEXT
         )
         ''')
     else:
@@ -170,6 +1343,21 @@ def init_db():
         if 'device_id' not in column_names:
             cursor.execute("ALTER TABLE users ADD COLUMN device_id TEXT")
             logger.info("Columna device_id añadida a la tabla users")
+        
+        # Si digest_hour no existe, añadirla (hora de entrega del resumen diario, NULL = desactivado)
+        if 'digest_hour' not in column_names:
+            cursor.execute("ALTER TABLE users ADD COLUMN digest_hour INTEGER")
+            logger.info("Columna digest_hour añadida a la tabla users")
+        
+        # Si blocked_at no existe, añadirla (el usuario bloqueó el bot; las difusiones lo omiten)
+        if 'blocked_at' not in column_names:
+            cursor.execute("ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP")
+            logger.info("Columna blocked_at añadida a la tabla users")
+        
+        # Si timezone no existe, añadirla (NULL = USER_DEFAULT_TIMEZONE)
+        if 'timezone' not in column_names:
+            cursor.execute("ALTER TABLE users ADD COLUMN timezone TEXT")
+            logger.info("Columna timezone añadida a la tabla users")
     
     # Crear otras tablas si no existen
     cursor.execute('''
@@ -183,6 +1371,26 @@ def init_db():
     )
     ''')
     
+    # Índice de texto completo de las interacciones (rowid = interactions.id); user_key ('u<user_id>')
+    # permite filtrar por usuario dentro del MATCH. Sin contenido propio (content=''): el texto
+    # ya está, comprimido, en interactions, y los fragmentos se construyen a partir de ahí
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='interactions_fts'")
+    fts_table = cursor.fetchone()
+    if fts_table and "content=''" not in fts_table[0]:
+        # Índice anterior que guardaba una copia del texto: se regenera sin ella
+        cursor.execute("DROP TABLE interactions_fts")
+        logger.info("Índice de búsqueda convertido a contentless")
+        fts_table = None
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS interactions_fts USING fts5(
+        user_key, message, response,
+        content='',
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    ''')
+    if not fts_table:
+        rebuild_interaction_index(cursor)
+    
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS plant_selections (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -193,121 +1401,253 @@ def init_db():
     )
     ''')
     
-    conn.commit()
-    conn.close()
-    logger.info("Base de datos inicializada correctamente")
-
-# Función para inicializar la tabla de recordatorios en la base de datos
-def init_reminders_table():
-    conn = sqlite3.connect('hydroponic_bot.db')
-    cursor = conn.cursor()
+    # Índices para las consultas por usuario (historial reciente y cultivo activo)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_interactions_user ON interactions (user_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_plant_selections_user ON plant_selections (user_id, id)")
     
+    # Resúmenes diarios de cuidado generados fuera de horas pico
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS reminders (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+    CREATE TABLE IF NOT EXISTS care_digests (
         user_id INTEGER,
-        message TEXT NOT NULL,
-        reminder_time TIMESTAMP NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        is_active BOOLEAN DEFAULT 1,
+        digest_date TEXT,
+        plant_type TEXT,
+        device_id TEXT,
+        content TEXT,
+        created_at TIMESTAMP,
+        delivered_at TIMESTAMP,
+        PRIMARY KEY (user_id, digest_date),
         FOREIGN KEY (user_id) REFERENCES users (user_id)
     )
     ''')
     
-    conn.commit()
-    conn.close()
-    logger.info("Tabla de recordatorios inicializada correctamente")
+    # Outbox de operaciones pendientes hacia SheetDB (se escribe en la misma transacción que el cambio local)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sheetdb_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        operation TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at TIMESTAMP,
+        attempts INTEGER DEFAULT 0,
+        last_error TEXT,
+        sent_at TIMESTAMP,
+        dead_at TIMESTAMP
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sheetdb_outbox_pending ON sheetdb_outbox (id) WHERE sent_at IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sheetdb_outbox_user ON sheetdb_outbox (user_id, id) WHERE sent_at IS NULL")
+    # Si dead_at no existe, añadirla (operación descartada tras OUTBOX_MAX_ATTEMPTS o un rechazo definitivo)
+    cursor.execute("PRAGMA table_info(sheetdb_outbox)")
+    if 'dead_at' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE sheetdb_outbox ADD COLUMN dead_at TIMESTAMP")
+        logger.info("Columna dead_at añadida a la tabla sheetdb_outbox")
+    
+    # Agregados por usuario de las interacciones ya archivadas
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS interaction_stats (
+        user_id INTEGER PRIMARY KEY,
+        archived_count INTEGER DEFAULT 0,
+        first_interaction TIMESTAMP,
+        last_archived TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+    
+    # Sesiones descargadas de memoria (solo las que tienen estado)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        user_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    ''')
+    
+    conn.commit()
+    conn.close()
+
+# Función para inicializar la tabla de recordatorios en la base de datos
+def init_reminders_table(paths=None):
+    for path in paths or get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        
+        # reminder_ts es la hora del recordatorio en segundos UTC desde epoch
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message TEXT NOT NULL,
+            reminder_ts INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''')
+        migrate_reminder_times(cursor)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders (reminder_ts) WHERE is_active = 1")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders (user_id, reminder_ts, id) WHERE is_active = 1")
+        
+        conn.commit()
+        conn.close()
+    logger.info("Tabla de recordatorios inicializada correctamente")
+
+def migrate_reminder_times(cursor):
+    """Convierte la antigua columna reminder_time (texto UTC sin zona) en reminder_ts reconstruyendo la tabla"""
+    cursor.execute("PRAGMA table_info(reminders)")
+    if 'reminder_time' not in [column[1] for column in cursor.fetchall()]:
+        return
+    
+    cursor.execute('''
+    CREATE TABLE reminders_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message TEXT NOT NULL,
+        reminder_ts INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_active BOOLEAN DEFAULT 1,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+    cursor.execute("SELECT id, user_id, message, reminder_time, created_at, is_active FROM reminders")
+    rows = []
+    for reminder_id, user_id, message, reminder_time, created_at, is_active in cursor.fetchall():
+        try:
+            reminder_ts = int(pytz.utc.localize(parse_datetime_flexible(reminder_time)).timestamp())
+        except (ValueError, TypeError):
+            logger.error(f"Recordatorio {reminder_id} con fecha inválida ({reminder_time}); se desactiva")
+            reminder_ts, is_active = 0, 0
+        rows.append((reminder_id, user_id, message, reminder_ts, created_at, is_active))
+    cursor.executemany(
+        "INSERT INTO reminders_new (id, user_id, message, reminder_ts, created_at, is_active) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    cursor.execute("DROP TABLE reminders")
+    cursor.execute("ALTER TABLE reminders_new RENAME TO reminders")
+    logger.info(f"{len(rows)} recordatorios migrados a reminder_ts")
 
 # Funciones para manejar recordatorios
-def save_reminder(user_id, message, reminder_time):
-    """Guarda un recordatorio en la base de datos"""
-    conn = sqlite3.connect('hydroponic_bot.db')
+@timed_db_write
+def save_reminder(user_id, message, reminder_ts):
+    """Guarda un recordatorio; reminder_ts en segundos UTC desde epoch"""
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
+    reminder_id = next_row_id()
     cursor.execute(
-        "INSERT INTO reminders (user_id, message, reminder_time) VALUES (?, ?, ?)",
-        (user_id, message, reminder_time)
+        "INSERT INTO reminders (id, user_id, message, reminder_ts) VALUES (?, ?, ?, ?)",
+        (reminder_id, user_id, message, int(reminder_ts))
     )
-    reminder_id = cursor.lastrowid
+    PENDING_REMINDERS.add(1)
     conn.commit()
     conn.close()
     return reminder_id
 
-def get_user_reminders(user_id):
-    """Obtiene todos los recordatorios activos de un usuario"""
-    conn = sqlite3.connect('hydroponic_bot.db')
+def get_user_reminders(user_id, after=(0, 0), limit=REMINDER_PAGE_SIZE):
+    """Una página de recordatorios activos del usuario a partir de la clave (reminder_ts, id).
+
+    Devuelve (recordatorios [(id, mensaje, reminder_ts)], hay más páginas).
+    """
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT id, message, reminder_time FROM reminders WHERE user_id = ? AND is_active = 1 ORDER BY reminder_time",
-        (user_id,)
+        "SELECT id, message, reminder_ts FROM reminders "
+        "WHERE user_id = ? AND is_active = 1 AND (reminder_ts, id) > (?, ?) "
+        "ORDER BY reminder_ts, id LIMIT ?",
+        (user_id, after[0], after[1], limit + 1)
     )
     reminders = cursor.fetchall()
     conn.close()
-    return reminders
+    return reminders[:limit], len(reminders) > limit
 
-def delete_reminder(reminder_id):
+def delete_reminder(user_id, reminder_id):
     """Elimina un recordatorio de la base de datos"""
-    conn = sqlite3.connect('hydroponic_bot.db')
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
-    cursor.execute("UPDATE reminders SET is_active = 0 WHERE id = ?", (reminder_id,))
+    cursor.execute("UPDATE reminders SET is_active = 0 WHERE id = ? AND user_id = ? AND is_active = 1", (reminder_id, user_id))
+    PENDING_REMINDERS.add(-cursor.rowcount)
     conn.commit()
     conn.close()
 
 def get_pending_reminders():
-    """Obtiene todos los recordatorios que deben ser enviados"""
-    conn = sqlite3.connect('hydroponic_bot.db')
-    cursor = conn.cursor()
-    now = datetime.now()
-    cursor.execute(
-        "SELECT id, user_id, message FROM reminders WHERE reminder_time <= ? AND is_active = 1",
-        (now,)
-    )
-    reminders = cursor.fetchall()
-    conn.close()
+    """Obtiene los recordatorios vencidos que deben ser enviados (recorre todos los shards)"""
+    now = int(time.time())
+    reminders = []
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, user_id, message FROM reminders WHERE reminder_ts <= ? AND is_active = 1 "
+            "ORDER BY reminder_ts LIMIT ?",
+            (now, REMINDER_SEND_BATCH)
+        )
+        reminders.extend(cursor.fetchall())
+        conn.close()
     return reminders
 
 # Funciones para interactuar con la base de datos
+@timed_db_write
 def register_user(user_id, username, first_name):
-    conn = sqlite3.connect('hydroponic_bot.db')
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute(
         "INSERT OR IGNORE INTO users (user_id, username, first_name, last_activity) VALUES (?, ?, ?, ?)",
         (user_id, username, first_name, datetime.now())
     )
+    touch_user_activity(user_id)
     conn.commit()
     conn.close()
 
-def update_user_activity(user_id):
-    conn = sqlite3.connect('hydroponic_bot.db')
-    cursor = conn.cursor()
+def write_user_activity(cursor, user_id):
+    # Si el usuario vuelve a escribir es que desbloqueó el bot
     cursor.execute(
-        "UPDATE users SET last_activity = ? WHERE user_id = ?",
+        "UPDATE users SET last_activity = ?, blocked_at = NULL WHERE user_id = ?",
         (datetime.now(), user_id)
     )
+    touch_user_activity(user_id)
+
+@timed_db_write
+def update_user_activity(user_id):
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    write_user_activity(cursor, user_id)
     conn.commit()
     conn.close()
 
-def save_interaction(user_id, message, response):
-    conn = sqlite3.connect('hydroponic_bot.db')
-    cursor = conn.cursor()
+def write_interaction(cursor, user_id, message, response):
+    interaction_id = next_row_id()
+    cursor.execute(
+        "INSERT INTO interactions (id, user_id, message, response, timestamp) VALUES (?, ?, ?, ?, ?)",
+        (interaction_id, user_id, message, compress_text(response), datetime.now())
+    )
+    # Mantener el índice de búsqueda en la misma transacción (indexa el texto sin comprimir)
     cursor.execute(
-        "INSERT INTO interactions (user_id, message, response, timestamp) VALUES (?, ?, ?, ?)",
-        (user_id, message, response, datetime.now())
+        "INSERT INTO interactions_fts (rowid, user_key, message, response) VALUES (?, ?, ?, ?)",
+        (interaction_id, f"u{user_id}", message, response)
     )
+
+@timed_db_write
+def save_interaction(user_id, message, response):
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    write_interaction(cursor, user_id, message, response)
     conn.commit()
     conn.close()
 
-def save_plant_selection(user_id, plant_type):
-    conn = sqlite3.connect('hydroponic_bot.db')
+@timed_db_write
+def save_plant_selection(user_id, plant_type, sheet_row=None):
+    """Guarda la selección y, si se indica, encola su fila de SheetDB en la misma transacción"""
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute(
-        "INSERT INTO plant_selections (user_id, plant_type, timestamp) VALUES (?, ?, ?)",
-        (user_id, plant_type, datetime.now())
+        "INSERT INTO plant_selections (id, user_id, plant_type, timestamp) VALUES (?, ?, ?, ?)",
+        (next_row_id(), user_id, plant_type, datetime.now())
     )
+    if sheet_row is not None:
+        enqueue_sheetdb_operation(cursor, user_id, 'insert', sheet_row)
     conn.commit()
     conn.close()
 
 def get_user_context(user_id):
-    conn = sqlite3.connect('hydroponic_bot.db')
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute("SELECT context FROM users WHERE user_id = ?", (user_id,))
     result = cursor.fetchone()
@@ -315,7 +1655,7 @@ def get_user_context(user_id):
     
     if result and result[0]:
         try:
-            context = json.loads(result[0])
+            context = json.loads(decompress_text(result[0]))
             # Validar y limpiar el contexto
             valid_context = []
             for item in context:
@@ -331,7 +1671,7 @@ def get_user_context(user_id):
                         valid_context.append(item)
             
             return valid_context
-        except json.JSONDecodeError:
+        except (ValueError, zlib.error):
             logger.error(f"Error decodificando contexto para usuario {user_id}")
             return []
     
@@ -386,51 +1726,2344 @@ def split_message(text, max_length=4000):
     if current_part.strip():
         parts.append(current_part.strip())
     
-    return parts
+    return parts
+
+
+def write_user_context(cursor, user_id, context):
+    cursor.execute("UPDATE users SET context = ? WHERE user_id = ?", (compress_text(json.dumps(context)), user_id))
+
+@timed_db_write
+def set_user_context(user_id, context):
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    write_user_context(cursor, user_id, context)
+    conn.commit()
+    conn.close()
+
+def load_user_session(user_id):
+    """Devuelve (estado JSON, updated_at) de la sesión guardada del usuario o None"""
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute("SELECT state, updated_at FROM user_sessions WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result
+
+@timed_db_write
+def save_user_sessions(sessions):
+    """Guarda [(user_id, estado JSON o None)] agrupados por shard; None borra la sesión guardada"""
+    states = dict(sessions)
+    now = int(time.time())
+    for shard, user_ids in group_by_shard(states).items():
+        conn = sqlite3.connect(get_shard_path(shard), timeout=10)
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO user_sessions (user_id, state, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+            [(user_id, states[user_id], now) for user_id in user_ids if states[user_id] is not None]
+        )
+        cursor.executemany(
+            "DELETE FROM user_sessions WHERE user_id = ?",
+            [(user_id,) for user_id in user_ids if states[user_id] is None]
+        )
+        conn.commit()
+        conn.close()
+
+@timed_db_write
+def run_user_transaction(user_id, *operations):
+    """Ejecuta operaciones (función(cursor, ...), args) en una sola transacción del shard del usuario"""
+    conn = connect_user_db(user_id)
+    try:
+        with conn:
+            cursor = conn.cursor()
+            return [operation(cursor, *args) for operation, args in operations]
+    finally:
+        conn.close()
+
+@timed_db_write
+def save_device_id(user_id, device_id, sheet_delete=None):
+    """Guarda el dispositivo; sheet_delete encola el borrado de la fila anterior en SheetDB en la misma transacción"""
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    if device_id is None:
+        cursor.execute("UPDATE users SET device_id = NULL WHERE user_id = ?", (user_id,))
+    else:
+        cursor.execute("UPDATE users SET device_id = ? WHERE user_id = ?", (device_id, user_id))
+    if sheet_delete is not None:
+        enqueue_sheetdb_operation(cursor, user_id, 'delete', sheet_delete)
+    conn.commit()
+    conn.close()
+
+def get_device_id(user_id):
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute("SELECT device_id FROM users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result[0] if result and result[0] else None
+
+# Outbox transaccional hacia SheetDB
+_outbox_lock = threading.Lock()
+
+def get_user_timezone(user_id):
+    """Zona horaria (pytz) configurada por el usuario o la predeterminada"""
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute("SELECT timezone FROM users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return pytz.timezone(result[0] if result and result[0] else USER_DEFAULT_TIMEZONE)
+
+@timed_db_write
+def set_user_timezone(user_id, timezone):
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET timezone = ? WHERE user_id = ?", (timezone, user_id))
+    conn.commit()
+    conn.close()
+
+def enqueue_sheetdb_operation(cursor, user_id, operation, payload):
+    """Encola una operación ('insert' o 'delete') dentro de la transacción del cursor recibido"""
+    cursor.execute(
+        "INSERT INTO sheetdb_outbox (id, user_id, operation, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+        (next_row_id(), user_id, operation, json.dumps(payload), datetime.now())
+    )
+    OUTBOX_DEPTH.add(1)
+
+def get_pending_sheet_state(user_id, device_id):
+    """Estado de plantación según la última operación pendiente del usuario, o None si no hay"""
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT operation, payload FROM sheetdb_outbox WHERE user_id = ? AND sent_at IS NULL AND dead_at IS NULL "
+        "ORDER BY id DESC LIMIT 1",
+        (user_id,)
+    )
+    result = cursor.fetchone()
+    conn.close()
+    
+    if not result:
+        return None
+    operation, payload = result
+    payload = json.loads(payload)
+    if payload.get("DispositivoID") != device_id:
+        return None
+    if operation == 'insert':
+        return True, payload.get("Planta", "desconocida")
+    return False, ""
+
+def apply_sheetdb_operation(operation, payload, attempts):
+    """Aplica una operación del outbox en SheetDB; devuelve True si quedó aplicada"""
+    if operation == 'insert':
+        # Si un intento anterior pudo haber llegado, comprobar antes de reenviar para no duplicar
+        if attempts > 0 and existe_fila_sheetdb(payload):
+            return True
+        return enviar_fila_sheetdb(payload)
+    if operation == 'delete':
+        return eliminar_registro_sheetdb(payload["UserID"], payload["DispositivoID"])
+    logger.error(f"Operación de outbox desconocida: {operation}")
+    return True
+
+def drain_shard_outbox(path, max_operations):
+    """Reenvía las operaciones pendientes de un shard respetando el orden de cada usuario.
+    
+    Un fallo reintentable solo detiene al usuario afectado; tras OUTBOX_MAX_ATTEMPTS fallos,
+    o ante un rechazo definitivo de SheetDB, la operación se descarta (dead_at) para no
+    bloquear las siguientes. Devuelve (operaciones intentadas, dependencia caída).
+    """
+    attempted = 0
+    blocked_users = set()
+    last_id = 0
+    conn = sqlite3.connect(path, timeout=5)
+    cursor = conn.cursor()
+    while attempted < max_operations:
+        cursor.execute(
+            "SELECT id, user_id, operation, payload, attempts FROM sheetdb_outbox "
+            "WHERE sent_at IS NULL AND dead_at IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (last_id, max_operations)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        
+        for operation_id, user_id, operation, payload, attempts in rows:
+            if user_id in blocked_users:
+                continue
+            if attempted >= max_operations:
+                break
+            # Con el circuito abierto no se consumen intentos: se espera a la siguiente ejecución
+            if get_circuit_breaker('sheetdb').state == 'open':
+                conn.close()
+                return attempted, True
+            
+            attempted += 1
+            permanent = False
+            try:
+                ok = apply_sheetdb_operation(operation, json.loads(payload), attempts)
+                error = None if ok else "SheetDB rechazó la operación"
+            except SheetDBRejected as e:
+                ok, error, permanent = False, str(e), True
+            except Exception as e:
+                ok, error = False, str(e)
+            
+            if ok:
+                cursor.execute("UPDATE sheetdb_outbox SET sent_at = ? WHERE id = ?", (datetime.now(), operation_id))
+                conn.commit()
+                apply_operation_to_mirror(operation, json.loads(payload))
+            elif permanent or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                cursor.execute(
+                    "UPDATE sheetdb_outbox SET attempts = attempts + 1, last_error = ?, dead_at = ? WHERE id = ?",
+                    (error, datetime.now(), operation_id)
+                )
+                conn.commit()
+                logger.error(f"Operación {operation_id} del outbox descartada tras {attempts + 1} intento(s): {error}")
+            else:
+                cursor.execute(
+                    "UPDATE sheetdb_outbox SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+                    (error, operation_id)
+                )
+                conn.commit()
+                logger.warning(f"Outbox de SheetDB detenido para el usuario {user_id} en la operación {operation_id}: {error}")
+                blocked_users.add(user_id)
+    
+    # Purgar operaciones enviadas hace tiempo (las descartadas se conservan para revisarlas)
+    cursor.execute(
+        "DELETE FROM sheetdb_outbox WHERE sent_at IS NOT NULL AND sent_at < ?",
+        (datetime.now() - timedelta(days=OUTBOX_KEEP_DAYS),)
+    )
+    conn.commit()
+    conn.close()
+    return attempted, False
+
+def drain_sheetdb_outbox(max_operations=OUTBOX_BATCH_SIZE):
+    """Reenvía las operaciones pendientes en orden por usuario; se detiene si SheetDB no está disponible"""
+    # Un solo drenador a la vez (job periódico o disparado tras una acción del usuario)
+    if not _outbox_lock.acquire(blocking=False):
+        return 0
+    
+    attempted = 0
+    try:
+        # El orden importa por usuario, y cada usuario vive en un único shard
+        for path in get_shard_paths():
+            shard_attempted, unavailable = drain_shard_outbox(path, max_operations - attempted)
+            attempted += shard_attempted
+            if unavailable or attempted >= max_operations:
+                break
+        OUTBOX_DEPTH.set(get_outbox_depth())
+    finally:
+        _outbox_lock.release()
+    
+    return attempted
+
+def get_outbox_depth():
+    depth = 0
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM sheetdb_outbox WHERE sent_at IS NULL AND dead_at IS NULL")
+        depth += cursor.fetchone()[0]
+        conn.close()
+    return depth
+
+# Espejo local de la hoja de SheetDB
+def sheet_row_key(row, seen_keys=None):
+    """Clave estable de una fila (UserID|DispositivoID|Fecha); numera las repeticiones exactas"""
+    key = f"{row.get('UserID', '')}|{row.get('DispositivoID', '')}|{row.get('Fecha', '')}"
+    if seen_keys is not None:
+        occurrence = seen_keys.get(key, 0)
+        seen_keys[key] = occurrence + 1
+        if occurrence:
+            key = f"{key}#{occurrence}"
+    return key
+
+def sheet_row_hash(row):
+    return hashlib.sha1(json.dumps(row, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def sheet_mirror_values(key, row):
+    return (
+        key, sheet_row_hash(row), str(row.get('UserID', '')), str(row.get('DispositivoID', '')),
+        row.get('Planta', ''), str(row.get('Plantado', '')).lower(), json.dumps(row, ensure_ascii=False), datetime.now()
+    )
+
+def iter_sheet_pages(page_size=SHEET_SYNC_PAGE_SIZE):
+    """Recorre la hoja completa por páginas (limit/offset de SheetDB)"""
+    offset = 0
+    while True:
+        url = f"{SHEETDB_API_URL}?limit={page_size}&offset={offset}"
+        response = resilient_request('sheetdb', 'GET', url, idempotent=True)
+        if response.status_code != 200:
+            raise RuntimeError(f"SheetDB respondió {response.status_code} al leer la hoja")
+        page = response.json()
+        if page:
+            yield page
+        if len(page) < page_size:
+            break
+        offset += page_size
+
+def sync_sheet_mirror():
+    """Sincroniza el espejo con la hoja aplicando solo las filas nuevas, cambiadas o eliminadas"""
+    # Sin drenar el outbox mientras tanto: una operación reflejada en el espejo durante la descarga
+    # no estaría en ella y la sincronización la desharía hasta la siguiente pasada
+    with _outbox_lock:
+        return _sync_sheet_mirror()
+
+def _sync_sheet_mirror():
+    conn = sqlite3.connect(DB_PATH, timeout=5)
+    cursor = conn.cursor()
+    cursor.execute("SELECT row_key, row_hash FROM sheet_mirror")
+    existing = dict(cursor.fetchall())
+    
+    # Descargar y comparar por hash antes de tocar la base; si la descarga falla no se aplica nada
+    occurrences = {}
+    seen = set()
+    changed = []
+    for page in iter_sheet_pages():
+        for row in page:
+            key = sheet_row_key(row, occurrences)
+            seen.add(key)
+            if existing.get(key) != sheet_row_hash(row):
+                changed.append(sheet_mirror_values(key, row))
+    removed = [(key,) for key in existing.keys() - seen]
+    
+    with conn:
+        cursor.executemany(
+            "INSERT OR REPLACE INTO sheet_mirror (row_key, row_hash, user_id, device_id, planta, plantado, data, synced_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            changed
+        )
+        cursor.executemany("DELETE FROM sheet_mirror WHERE row_key = ?", removed)
+        cursor.execute(
+            "INSERT OR REPLACE INTO sheet_sync_state (id, last_sync, row_count) VALUES (1, ?, ?)",
+            (datetime.now(), len(seen))
+        )
+    conn.close()
+    
+    if changed or removed:
+        logger.info(f"Espejo de SheetDB: {len(changed)} filas nuevas o cambiadas, {len(removed)} eliminadas")
+    return len(changed), len(removed)
+
+def get_mirror_last_sync():
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT last_sync FROM sheet_sync_state WHERE id = 1")
+    result = cursor.fetchone()
+    conn.close()
+    return parse_datetime_flexible(result[0]) if result and result[0] else None
+
+def is_mirror_fresh():
+    """Indica si el espejo se sincronizó hace poco como para responder consultas localmente"""
+    last_sync = get_mirror_last_sync()
+    return last_sync is not None and datetime.now() - last_sync <= timedelta(seconds=SHEET_MIRROR_MAX_AGE_SECONDS)
+
+def get_mirror_active_plant(user_id, device_id):
+    """Planta activa del usuario y dispositivo según el espejo local"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT planta FROM sheet_mirror WHERE user_id = ? AND device_id = ? AND plantado = 'true' LIMIT 1",
+        (str(user_id), str(device_id))
+    )
+    result = cursor.fetchone()
+    conn.close()
+    return (True, result[0] or "desconocida") if result else (False, "")
+
+def apply_operation_to_mirror(operation, payload):
+    """Refleja en el espejo una operación ya aplicada en SheetDB, sin esperar a la próxima sincronización"""
+    conn = sqlite3.connect(DB_PATH, timeout=5)
+    cursor = conn.cursor()
+    if operation == 'insert':
+        cursor.execute(
+            "INSERT OR REPLACE INTO sheet_mirror (row_key, row_hash, user_id, device_id, planta, plantado, data, synced_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            sheet_mirror_values(sheet_row_key(payload), payload)
+        )
+    elif operation == 'delete':
+        cursor.execute(
+            "DELETE FROM sheet_mirror WHERE user_id = ? AND device_id = ?",
+            (str(payload["UserID"]), str(payload["DispositivoID"]))
+        )
+    conn.commit()
+    conn.close()
+
+def get_mirror_plant_counts():
+    """Obtiene (planta, plantaciones activas) desde el espejo"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT planta, COUNT(*) FROM sheet_mirror WHERE plantado = 'true' GROUP BY planta ORDER BY COUNT(*) DESC"
+    )
+    counts = cursor.fetchall()
+    conn.close()
+    return counts
+
+def reconcile_sheet_mirror():
+    """Compara el espejo con la base local.
+
+    Devuelve (usuarios con dispositivo y cultivo local pero sin fila activa en la hoja,
+    filas activas de la hoja cuyo usuario ya no tiene ese dispositivo localmente).
+    Las operaciones pendientes del outbox no cuentan como diferencias.
+    """
+    # Estado local repartido entre shards
+    registered = []        # (user_id, device_id) con dispositivo y cultivo
+    local_devices = set()  # (user_id texto, device_id)
+    pending_users = set()  # user_id texto con operaciones pendientes
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.user_id, u.device_id,
+                   EXISTS (SELECT 1 FROM plant_selections ps WHERE ps.user_id = u.user_id)
+            FROM users u
+            WHERE u.device_id IS NOT NULL
+        ''')
+        for user_id, device_id, has_plant in cursor.fetchall():
+            local_devices.add((str(user_id), device_id))
+            if has_plant:
+                registered.append((user_id, device_id))
+        cursor.execute("SELECT DISTINCT user_id FROM sheetdb_outbox WHERE sent_at IS NULL AND dead_at IS NULL")
+        pending_users.update(str(row[0]) for row in cursor.fetchall())
+        conn.close()
+    
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, device_id FROM sheet_mirror WHERE plantado = 'true'")
+    mirror_active = cursor.fetchall()
+    conn.close()
+    
+    active_in_sheet = set(mirror_active)
+    missing_in_sheet = [
+        (user_id, device_id) for user_id, device_id in registered
+        if (str(user_id), device_id) not in active_in_sheet and str(user_id) not in pending_users
+    ]
+    orphaned_in_sheet = [
+        (user_id, device_id) for user_id, device_id in mirror_active
+        if (user_id, device_id) not in local_devices and user_id not in pending_users
+    ]
+    return missing_in_sheet, orphaned_in_sheet
+
+# Retención del historial de interacciones
+def init_archive_db():
+    """Crea la base de datos de archivo para las interacciones antiguas"""
+    conn = sqlite3.connect(ARCHIVE_DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS interactions_archive (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        message TEXT,
+        response TEXT,
+        timestamp TIMESTAMP,
+        archived_at TIMESTAMP
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_interactions_archive_user ON interactions_archive (user_id, id)")
+    conn.commit()
+    conn.close()
+    logger.info("Base de datos de archivo inicializada correctamente")
+
+def is_quiet_period():
+    """Indica si no ha habido interacciones en los últimos RETENTION_QUIET_MINUTES minutos en ningún shard"""
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path, timeout=5)
+        cursor = conn.cursor()
+        # La última fila por id es la más reciente; evita recorrer la tabla completa
+        cursor.execute("SELECT timestamp FROM interactions ORDER BY id DESC LIMIT 1")
+        result = cursor.fetchone()
+        conn.close()
+        if not result or not result[0]:
+            continue
+        try:
+            last_interaction = parse_datetime_flexible(result[0])
+        except ValueError:
+            continue
+        if datetime.now() - last_interaction < timedelta(minutes=RETENTION_QUIET_MINUTES):
+            return False
+    return True
+
+def archive_old_interactions(max_batches=RETENTION_MAX_BATCHES):
+    """Archiva las interacciones antiguas de todos los shards"""
+    return sum(archive_shard_interactions(path, max_batches) for path in get_shard_paths())
+
+def archive_shard_interactions(path, max_batches=RETENTION_MAX_BATCHES):
+    """Mueve por lotes las interacciones antiguas a la base de archivo y actualiza los agregados por usuario"""
+    conn = sqlite3.connect(path, timeout=5)
+    register_compression_functions(conn)
+    cursor = conn.cursor()
+    cursor.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+    
+    cutoff = datetime.now() - timedelta(days=RETENTION_DAYS)
+    archived = 0
+    
+    try:
+        for _ in range(max_batches):
+            # Los ids crecen con el tiempo: el lote es el tramo inicial de filas antiguas y se detiene en la
+            # primera reciente, así que nunca se lee más de un lote (timestamp no tiene índice)
+            cursor.execute(
+                "SELECT id, timestamp < ? FROM interactions ORDER BY id LIMIT ?",
+                (cutoff, RETENTION_BATCH_SIZE)
+            )
+            max_id = None
+            reached_recent = False
+            for row_id, is_old in cursor.fetchall():
+                if not is_old:
+                    reached_recent = True
+                    break
+                max_id = row_id
+            if max_id is None:
+                break
+            
+            # Copia, agregados y borrado en una sola transacción corta
+            with conn:
+                cursor.execute(
+                    "INSERT OR IGNORE INTO archive.interactions_archive (id, user_id, message, response, timestamp, archived_at) "
+                    "SELECT id, user_id, message, response, timestamp, ? FROM interactions WHERE id <= ? AND timestamp < ?",
+                    (datetime.now(), max_id, cutoff)
+                )
+                cursor.execute(
+                    "INSERT INTO interaction_stats (user_id, archived_count, first_interaction, last_archived) "
+                    "SELECT user_id, COUNT(*), MIN(timestamp), MAX(timestamp) FROM interactions "
+                    "WHERE id <= ? AND timestamp < ? GROUP BY user_id "
+                    "ON CONFLICT(user_id) DO UPDATE SET "
+                    "archived_count = archived_count + excluded.archived_count, "
+                    "first_interaction = MIN(COALESCE(first_interaction, excluded.first_interaction), excluded.first_interaction), "
+                    "last_archived = MAX(COALESCE(last_archived, excluded.last_archived), excluded.last_archived)",
+                    (max_id, cutoff)
+                )
+                # Un índice contentless solo borra una fila si recibe los valores que se indexaron
+                cursor.execute(
+                    "INSERT INTO interactions_fts (interactions_fts, rowid, user_key, message, response) "
+                    "SELECT 'delete', id, 'u' || user_id, message, decompress_text(response) FROM interactions "
+                    "WHERE id <= ? AND timestamp < ?",
+                    (max_id, cutoff)
+                )
+                cursor.execute("DELETE FROM interactions WHERE id <= ? AND timestamp < ?", (max_id, cutoff))
+                archived += cursor.rowcount
+            
+            if reached_recent:
+                break
+            # Ceder el lock de escritura a los handlers entre lotes
+            time.sleep(0.05)
+    finally:
+        cursor.execute("DETACH DATABASE archive")
+        conn.close()
+    
+    return archived
+
+# Última clave recomprimida por (shard, tabla); al reiniciar se vuelve a recorrer desde el principio
+_recompress_watermarks = {}
+
+def recompress_stored_text(max_batches=RECOMPRESS_MAX_BATCHES):
+    """Reescribe en el formato actual los textos heredados de todos los shards; devuelve las filas convertidas"""
+    return sum(
+        recompress_shard_table(path, table, max_batches)
+        for path in get_shard_paths() for table in COMPRESSED_COLUMNS
+    )
+
+def recompress_shard_table(path, table, max_batches=RECOMPRESS_MAX_BATCHES):
+    """Recorre por lotes una tabla de un shard y comprime los valores que no están en el formato actual"""
+    key, column = COMPRESSED_COLUMNS[table]
+    last_key = _recompress_watermarks.get((path, table), 0)
+    converted = 0
+    conn = sqlite3.connect(path, timeout=5)
+    cursor = conn.cursor()
+    try:
+        for _ in range(max_batches):
+            cursor.execute(
+                f"SELECT {key}, {column} FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?",
+                (last_key, RECOMPRESS_BATCH_SIZE)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_key = rows[-1][0]
+            encoded = (
+                (compress_text(decompress_text(value)), row_key, value)
+                for row_key, value in rows if needs_recompression(value)
+            )
+            updates = [update for update in encoded if update[0] != update[2]]
+            if updates:
+                # Solo se reescribe si el valor no cambió desde la lectura (p. ej. contexto actualizado por un handler)
+                with conn:
+                    cursor.executemany(
+                        f"UPDATE {table} SET {column} = ? WHERE {key} = ? AND {column} IS ?",
+                        updates
+                    )
+                    converted += cursor.rowcount
+            
+            # Ceder el lock de escritura a los handlers entre lotes
+            time.sleep(0.05)
+    finally:
+        conn.close()
+    _recompress_watermarks[(path, table)] = last_key
+    return converted
+
+def incremental_vacuum(max_pages=RETENTION_VACUUM_PAGES):
+    """Devuelve al sistema de archivos hasta max_pages páginas libres por base (global y shards)"""
+    freed_pages = 0
+    for path in dict.fromkeys([DB_PATH] + get_shard_paths()):
+        conn = sqlite3.connect(path, timeout=5)
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA freelist_count")
+        free_pages = cursor.fetchone()[0]
+        if free_pages:
+            cursor.execute(f"PRAGMA incremental_vacuum({int(max_pages)})")
+            cursor.fetchall()  # El pragma libera una página por cada fila recorrida
+        conn.close()
+        freed_pages += min(free_pages, max_pages)
+    return freed_pages
+
+def run_retention_maintenance():
+    """Archiva interacciones antiguas y compacta la base de datos si el bot está tranquilo"""
+    quiet = is_quiet_period()
+    
+    if not quiet:
+        logger.info("Mantenimiento de retención pospuesto: hay actividad reciente")
+        return
+    
+    archived = archive_old_interactions()
+    recompressed = recompress_stored_text()
+    freed_pages = incremental_vacuum()
+    if archived or recompressed or freed_pages:
+        logger.info(
+            f"Mantenimiento de retención: {archived} interacciones archivadas, "
+            f"{recompressed} textos recomprimidos, {freed_pages} páginas liberadas"
+        )
+
+def get_user_interaction_stats(user_id):
+    """Obtiene el total de interacciones de un usuario (archivadas + activas)"""
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT archived_count, first_interaction FROM interaction_stats WHERE user_id = ?",
+        (user_id,)
+    )
+    stats = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*), MIN(timestamp) FROM interactions WHERE user_id = ?", (user_id,))
+    live_count, live_first = cursor.fetchone()
+    conn.close()
+    
+    archived_count, archived_first = stats if stats else (0, None)
+    return {
+        "total": archived_count + live_count,
+        "archived": archived_count,
+        "first_interaction": archived_first or live_first
+    }
+
+def history_word_variants(word):
+    """Singular y plural simples de una palabra, para que 'hoja' encuentre 'hojas' sin prefijos"""
+    variants = {word}
+    if word.endswith('es') and len(word) > 4:
+        variants.add(word[:-2])
+    if word.endswith('s') and len(word) > 3:
+        variants.add(word[:-1])
+    else:
+        variants.update({word + 's', word + 'es'})
+    return sorted(variants)
+
+def history_terms(text):
+    """Palabras del texto del usuario que acotan la búsqueda (sin las muy cortas ni las frecuentes)"""
+    return [word for word in tokenize(text) if len(word) >= 3 and word not in HISTORY_STOPWORDS]
+
+def build_history_query(text):
+    """Convierte el texto del usuario en una consulta FTS5 segura: todas las palabras (o sus variantes)"""
+    return ' AND '.join(
+        '(' + ' OR '.join(f'"{variant}"' for variant in history_word_variants(word)) + ')'
+        for word in history_terms(text)
+    )
+
+def history_snippet(text, variants, size=HISTORY_SNIPPET_TOKENS):
+    """Fragmento de hasta size palabras desde poco antes de la primera coincidencia, con las coincidencias entre «»"""
+    words = (text or '').split()
+    matches = [any(token in variants for token in tokenize(word)) for word in words]
+    first = matches.index(True) if True in matches else 0
+    start = max(0, min(first - size // 4, len(words) - size))
+    fragment = ' '.join(
+        re.sub(r'^(\W*)(.*?)(\W*)$', r'\1«\2»\3', word) if matched else word
+        for word, matched in zip(words[start:start + size], matches[start:start + size])
+    )
+    return ('…' if start > 0 else '') + fragment + ('…' if start + size < len(words) else '')
+
+def search_interactions(user_id, text, page=0, page_size=HISTORY_PAGE_SIZE):
+    """Busca en las interacciones del usuario ordenadas por relevancia (bm25, la pregunta pesa doble).
+    
+    El filtro user_key va dentro del MATCH, así que bm25 solo se calcula sobre las coincidencias del usuario.
+    Devuelve (resultados [(id, fecha, fragmento de la pregunta, fragmento de la respuesta)], hay más páginas).
+    """
+    match = build_history_query(text)
+    if not match:
+        return [], False
+    
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT f.rowid, i.timestamp, i.message, i.response "
+        "FROM interactions_fts f JOIN interactions i ON i.id = f.rowid "
+        "WHERE interactions_fts MATCH ? "
+        "ORDER BY bm25(interactions_fts, 0, 2.0, 1.0), f.rowid DESC LIMIT ? OFFSET ?",
+        (f'user_key:"u{user_id}" AND {match}', page_size + 1, page * page_size)
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    
+    # El índice no guarda el texto: los fragmentos salen de la interacción (solo las de esta página)
+    variants = {variant for word in history_terms(text) for variant in history_word_variants(word)}
+    results = [
+        (interaction_id, timestamp, history_snippet(message, variants), history_snippet(decompress_text(response), variants))
+        for interaction_id, timestamp, message, response in rows[:page_size]
+    ]
+    return results, len(rows) > page_size
+
+# Exportación por streaming para analítica
+def init_export_table():
+    """Crea la tabla de marcas de agua de las exportaciones incrementales"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS export_watermarks (
+        table_name TEXT,
+        export_format TEXT,
+        last_id INTEGER DEFAULT 0,
+        exported_at TIMESTAMP,
+        PRIMARY KEY (table_name, export_format)
+    )
+    ''')
+    conn.commit()
+    conn.close()
+
+def get_export_watermark(table, export_format):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT last_id FROM export_watermarks WHERE table_name = ? AND export_format = ?",
+        (table, export_format)
+    )
+    result = cursor.fetchone()
+    conn.close()
+    return result[0] if result else 0
+
+def set_export_watermark(table, export_format, last_id):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO export_watermarks (table_name, export_format, last_id, exported_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(table_name, export_format) DO UPDATE SET last_id = excluded.last_id, exported_at = excluded.exported_at",
+        (table, export_format, last_id, datetime.now())
+    )
+    conn.commit()
+    conn.close()
+
+def iter_shard_rows(path, table, columns, since_id=0, chunk_size=EXPORT_CHUNK_SIZE):
+    """Recorre una tabla de un shard usando paginación por clave (id > último id leído)"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    query = f"SELECT {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?"
+    # Las columnas comprimidas se exportan como texto
+    column = COMPRESSED_COLUMNS.get(table, (None, None))[1]
+    compressed = columns.index(column) if column in columns else None
+    last_id = since_id
+    try:
+        while True:
+            cursor.execute(query, (last_id, chunk_size))
+            chunk = cursor.fetchall()
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            if compressed is not None:
+                chunk = [row[:compressed] + (decompress_text(row[compressed]),) + row[compressed + 1:] for row in chunk]
+            yield from chunk
+    finally:
+        conn.close()
+
+def iter_table_chunks(table, columns, since_id=0, chunk_size=EXPORT_CHUNK_SIZE):
+    """Recorre una tabla por bloques en orden de id, mezclando los shards sin materializarlos"""
+    rows = heapq.merge(
+        *(iter_shard_rows(path, table, columns, since_id, chunk_size) for path in get_shard_paths()),
+        key=lambda row: row[0]
+    )
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+def write_csv_chunks(path, columns, chunks):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for chunk in chunks:
+            writer.writerows(chunk)
+
+def write_jsonl_chunks(path, columns, chunks):
+    with open(path, 'w', encoding='utf-8') as f:
+        for chunk in chunks:
+            for row in chunk:
+                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+                f.write('\n')
+
+def get_parquet_schema(table, columns):
+    """Esquema de Parquet a partir de los tipos declarados en SQLite (no se infiere por bloque:
+    una columna toda NULL en el primer bloque tendría tipo null y los siguientes no encajarían)"""
+    conn = sqlite3.connect(get_shard_paths()[0])
+    declared = {row[1]: (row[2] or '').upper() for row in conn.execute(f"PRAGMA table_info({table})")}
+    conn.close()
+    # Las fechas se guardan como texto ISO y se exportan igual que en CSV/JSONL
+    types = {'INTEGER': pa.int64(), 'REAL': pa.float64()}
+    return pa.schema([(column, types.get(declared.get(column), pa.string())) for column in columns])
+
+def write_parquet_chunks(path, columns, chunks, schema=None):
+    """Escribe cada bloque como un row group de Parquet con un esquema fijo (requiere pyarrow)"""
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pydict({
+                column: [row[i] for row in chunk] for i, column in enumerate(columns)
+            }, schema=schema)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+EXPORT_WRITERS = {
+    'csv': write_csv_chunks,
+    'jsonl': write_jsonl_chunks,
+    'parquet': write_parquet_chunks,
+}
+
+def export_table(table, export_format='csv', incremental=True, chunk_size=EXPORT_CHUNK_SIZE):
+    """Exporta una tabla a EXPORT_DIR en streaming; devuelve (filas exportadas, ruta del archivo)"""
+    if export_format == 'parquet' and pa is None:
+        logger.warning("pyarrow no está instalado; se exporta en CSV")
+        export_format = 'csv'
+    
+    columns = EXPORT_TABLES[table]
+    since_id = get_export_watermark(table, export_format) if incremental else 0
+    
+    # Se escribe en un temporal propio de esta ejecución y solo se publica si tuvo filas
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{table}_", suffix=f".{export_format}.tmp", dir=EXPORT_DIR)
+    os.close(fd)
+    
+    # Contabilizar el avance sin materializar la tabla
+    progress = {"rows": 0, "last_id": since_id}
+    
+    def track(chunks):
+        for chunk in chunks:
+            progress["rows"] += len(chunk)
+            progress["last_id"] = chunk[-1][0]
+            yield chunk
+    
+    write_chunks = EXPORT_WRITERS[export_format]
+    if export_format == 'parquet':
+        write_chunks = functools.partial(write_chunks, schema=get_parquet_schema(table, columns))
+    try:
+        write_chunks(tmp_path, columns, track(iter_table_chunks(table, columns, since_id, chunk_size)))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    
+    if progress["rows"] == 0:
+        os.remove(tmp_path)
+        logger.info(f"Exportación de {table}: sin filas nuevas desde id {since_id}")
+        return 0, None
+    
+    # El rango de ids y los microsegundos hacen único el nombre aunque coincidan dos ejecuciones
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    path = os.path.join(EXPORT_DIR, f"{table}_{stamp}_{since_id + 1}-{progress['last_id']}.{export_format}")
+    os.chmod(tmp_path, 0o644)   # mkstemp crea el archivo solo legible por el dueño
+    os.replace(tmp_path, path)
+    
+    if incremental:
+        set_export_watermark(table, export_format, progress["last_id"])
+    logger.info(f"Exportación de {table}: {progress['rows']} filas en {path}")
+    return progress["rows"], path
+
+def run_export(argv):
+    """Comando de exportación: python mainAIGoogle.py export [--format csv|jsonl|parquet] [--full] [tablas...]"""
+    parser = argparse.ArgumentParser(prog='mainAIGoogle.py export', description="Exporta datos para analítica")
+    parser.add_argument('tables', nargs='*', help=f"Tablas a exportar ({', '.join(EXPORT_TABLES)})")
+    parser.add_argument('--format', dest='export_format', default='parquet' if pa is not None else 'csv',
+                        choices=list(EXPORT_WRITERS))
+    parser.add_argument('--full', action='store_true', help="Ignorar la marca de agua y exportar todo")
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    
+    unknown_tables = set(args.tables) - set(EXPORT_TABLES)
+    if unknown_tables:
+        parser.error(f"Tablas no exportables: {', '.join(sorted(unknown_tables))}")
+    
+    init_db()
+    init_export_table()
+    for table in args.tables or list(EXPORT_TABLES):
+        export_table(table, args.export_format, incremental=not args.full, chunk_size=args.chunk_size)
+
+# Base de conocimiento local de cultivos NFT
+# Rangos de referencia por cultivo: pH, conductividad (mS/cm), temperaturas (°C) y ciclo (días desde trasplante)
+PLANT_KNOWLEDGE = {
+    'lechuga': {
+        'nombre': 'Lechuga',
+        'ph': (5.5, 6.5),
+        'ec': (0.8, 1.2),
+        'temp_aire': (15, 22),
+        'temp_solucion': (18, 22),
+        'ciclo': (35, 50),
+        'notas': "Sensible al calor: por encima de 24 °C tiende a espigarse y amargar.",
+    },
+    'acelga': {
+        'nombre': 'Acelga',
+        'ph': (6.0, 7.0),
+        'ec': (1.8, 2.3),
+        'temp_aire': (15, 24),
+        'temp_solucion': (18, 22),
+        'ciclo': (50, 60),
+        'notas': "Admite cosechas sucesivas cortando las hojas externas.",
+    },
+    'espinaca': {
+        'nombre': 'Espinaca',
+        'ph': (6.0, 7.0),
+        'ec': (1.8, 2.3),
+        'temp_aire': (10, 20),
+        'temp_solucion': (16, 20),
+        'ciclo': (40, 50),
+        'notas': "Prefiere clima fresco; con días largos y calor florece pronto.",
+    },
+    'aromaticas': {
+        'nombre': 'Aromáticas',
+        'ph': (5.5, 6.5),
+        'ec': (1.0, 1.6),
+        'temp_aire': (18, 27),
+        'temp_solucion': (18, 22),
+        'ciclo': (30, 60),
+        'notas': "Albahaca, menta, cilantro y perejil; podar puntas para estimular ramificación.",
+    },
+    'chile': {
+        'nombre': 'Chile/Pimiento',
+        'ph': (5.8, 6.3),
+        'ec': (1.8, 2.8),
+        'temp_aire': (20, 30),
+        'temp_solucion': (20, 24),
+        'ciclo': (90, 120),
+        'notas': "Requiere tutorado y más potasio en floración y fructificación.",
+    },
+    'jitomate': {
+        'nombre': 'Jitomate',
+        'ph': (5.5, 6.5),
+        'ec': (2.0, 3.5),
+        'temp_aire': (18, 27),
+        'temp_solucion': (20, 24),
+        'ciclo': (90, 120),
+        'notas': "En NFT conviene usar variedades de porte bajo y vigilar el taponamiento del canal por raíces.",
+    },
+    'ornamentales': {
+        'nombre': 'Ornamentales',
+        'ph': (5.5, 6.5),
+        'ec': (1.2, 2.0),
+        'temp_aire': (16, 25),
+        'temp_solucion': (18, 22),
+        'ciclo': (60, 120),
+        'notas': "Los rangos varían según la especie; verifica los de tu variedad.",
+    },
+}
+
+# Palabras (sin acentos) que identifican cada cultivo en una pregunta
+PLANT_SYNONYMS = {
+    'lechuga': ['lechuga', 'lechugas'],
+    'acelga': ['acelga', 'acelgas'],
+    'espinaca': ['espinaca', 'espinacas'],
+    'aromaticas': ['aromatica', 'aromaticas', 'albahaca', 'menta', 'cilantro', 'perejil', 'hierbabuena'],
+    'chile': ['chile', 'chiles', 'pimiento', 'pimientos', 'aji'],
+    'jitomate': ['jitomate', 'jitomates', 'tomate', 'tomates'],
+    'ornamentales': ['ornamental', 'ornamentales', 'flor', 'flores'],
+}
+
+# Palabras que identifican cada parámetro consultado
+PARAMETER_SYNONYMS = {
+    'ph': ['ph', 'acidez'],
+    'ec': ['ec', 'ce', 'conductividad', 'electroconductividad'],
+    'temperatura': ['temperatura', 'temperaturas', 'grados', 'calor', 'frio'],
+    'ciclo': ['ciclo', 'cosecha', 'cosechar', 'tarda', 'demora'],
+}
+
+# Palabras que indican una pregunta de diagnóstico o de procedimiento (se responden con Gemini)
+DIAGNOSTIC_WORDS = {
+    'amarilla', 'amarillas', 'amarillo', 'mancha', 'manchas', 'plaga', 'plagas', 'hongo', 'hongos',
+    'problema', 'problemas', 'enferma', 'enfermedad', 'marchita', 'seca', 'secas', 'podrida',
+    'raiz', 'raices', 'hoja', 'hojas', 'foto', 'imagen', 'ayuda', 'por', 'porque',
+    'como', 'bajar', 'bajo', 'subir', 'subo', 'ajustar', 'corregir', 'cambiar', 'cambio', 'mejorar',
+}
+
+KNOWLEDGE_MAX_WORDS = 15  # Longitud máxima de una pregunta "simple"
+
+def normalize_text(text):
+    """Minúsculas y sin acentos, para comparar palabras clave"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+def tokenize(text):
+    return re.findall(r'[a-z0-9]+', normalize_text(text))
+
+def build_knowledge_index():
+    """Índice en memoria palabra -> ('planta' | 'parametro', clave)"""
+    index = {}
+    for plant, words in PLANT_SYNONYMS.items():
+        for word in words:
+            index[word] = ('planta', plant)
+    for parameter, words in PARAMETER_SYNONYMS.items():
+        for word in words:
+            index[word] = ('parametro', parameter)
+    return index
+
+KNOWLEDGE_INDEX = build_knowledge_index()
+
+def lookup_knowledge(text):
+    """Devuelve (cultivos mencionados, parámetros mencionados, palabras) de un texto"""
+    words = tokenize(text)
+    plants, parameters = [], []
+    for word in words:
+        entry = KNOWLEDGE_INDEX.get(word)
+        if entry is None:
+            continue
+        kind, key = entry
+        target = plants if kind == 'planta' else parameters
+        if key not in target:
+            target.append(key)
+    return plants, parameters, words
+
+def format_range(values, unit=''):
+    low, high = values
+    return f"{low:g}–{high:g}{unit}"
+
+def format_parameter(plant, parameter):
+    """Texto de un parámetro de un cultivo"""
+    info = PLANT_KNOWLEDGE[plant]
+    if parameter == 'ph':
+        return f"pH de la solución: {format_range(info['ph'])}"
+    if parameter == 'ec':
+        return f"Conductividad eléctrica (EC): {format_range(info['ec'], ' mS/cm')}"
+    if parameter == 'temperatura':
+        return (f"Temperatura del aire: {format_range(info['temp_aire'], ' °C')}; "
+                f"de la solución: {format_range(info['temp_solucion'], ' °C')}")
+    return f"Ciclo hasta cosecha: {format_range(info['ciclo'], ' días')} desde el trasplante"
+
+def get_knowledge_snippet(plant):
+    """Resumen compacto de los parámetros de un cultivo para inyectar en el prompt"""
+    info = PLANT_KNOWLEDGE.get(plant)
+    if not info:
+        return None
+    return (
+        f"{info['nombre']} en NFT: pH {format_range(info['ph'])}; EC {format_range(info['ec'], ' mS/cm')}; "
+        f"aire {format_range(info['temp_aire'], ' °C')}; solución {format_range(info['temp_solucion'], ' °C')}; "
+        f"ciclo {format_range(info['ciclo'], ' días')}. {info['notas']}"
+    )
+
+def answer_from_knowledge_base(message, active_plant=None):
+    """Responde directamente preguntas simples sobre parámetros de un cultivo; None si no aplica"""
+    plants, parameters, words = lookup_knowledge(message)
+    
+    if not parameters or len(words) > KNOWLEDGE_MAX_WORDS or DIAGNOSTIC_WORDS.intersection(words):
+        return None
+    
+    plant = plants[0] if len(plants) == 1 else (active_plant if not plants else None)
+    if plant not in PLANT_KNOWLEDGE:
+        return None
+    
+    info = PLANT_KNOWLEDGE[plant]
+    lines = [f"📗 {info['nombre']} en hidroponía NFT"]
+    lines.extend(f"• {format_parameter(plant, parameter)}" for parameter in parameters)
+    lines.append(f"\n💡 {info['notas']}")
+    return "\n".join(lines)
+
+def get_relevant_snippet(message, active_plant=None):
+    """Fragmento de la base de conocimiento para el cultivo mencionado o, si no hay, el activo"""
+    plants, _, _ = lookup_knowledge(message)
+    plant = plants[0] if plants else active_plant
+    return get_knowledge_snippet(plant) if plant else None
+
+# Respuestas recientes de la IA, reutilizadas cuando el control de sobrecarga prioriza la caché
+_ai_response_cache = OrderedDict()   # (pregunta normalizada, cultivo) -> (respuesta, expira en)
+_ai_response_cache_lock = threading.Lock()
+
+def get_response_cache_key(message, active_plant=None):
+    return normalize_text(message).strip(), active_plant or ''
+
+def get_cached_ai_response(message, active_plant=None):
+    key = get_response_cache_key(message, active_plant)
+    with _ai_response_cache_lock:
+        cached = _ai_response_cache.get(key)
+        hit = bool(cached) and cached[1] > time.time()
+        if hit:
+            _ai_response_cache.move_to_end(key)
+    CACHE_COUNTERS['respuestas_ia'].record(hit)
+    return cached[0] if hit else None
+
+def cache_ai_response(message, active_plant, response):
+    key = get_response_cache_key(message, active_plant)
+    with _ai_response_cache_lock:
+        _ai_response_cache[key] = (response, time.time() + AI_RESPONSE_CACHE_TTL_SECONDS)
+        _ai_response_cache.move_to_end(key)
+        while len(_ai_response_cache) > AI_RESPONSE_CACHE_SIZE:
+            _ai_response_cache.popitem(last=False)
+
+# Resúmenes diarios de cuidado
+def get_active_plant(user_id):
+    """Obtiene el último cultivo seleccionado por el usuario"""
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT plant_type FROM plant_selections WHERE user_id = ? ORDER BY id DESC LIMIT 1",
+        (user_id,)
+    )
+    result = cursor.fetchone()
+    conn.close()
+    return result[0] if result else None
+
+def get_active_plantings():
+    """Obtiene (user_id, device_id, plant_type) de los usuarios con dispositivo, cultivo y hora de resumen"""
+    plantings = []
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.user_id, u.device_id, ps.plant_type
+            FROM users u
+            JOIN plant_selections ps
+              ON ps.id = (SELECT MAX(id) FROM plant_selections WHERE user_id = u.user_id)
+            WHERE u.device_id IS NOT NULL AND u.digest_hour IS NOT NULL
+        ''')
+        plantings.extend(cursor.fetchall())
+        conn.close()
+    plantings.sort()
+    return plantings
+
+def get_recent_interactions(user_id, limit=DIGEST_RECENT_INTERACTIONS):
+    """Obtiene las últimas interacciones (mensaje, respuesta) de un usuario"""
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT message, response FROM interactions WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+        (user_id, limit)
+    )
+    interactions = [(message, decompress_text(response)) for message, response in cursor.fetchall()]
+    conn.close()
+    return interactions
+
+def get_digest_date():
+    """Fecha local (DIGEST_TIMEZONE) a la que corresponde el resumen de hoy"""
+    return datetime.now(pytz.timezone(DIGEST_TIMEZONE)).strftime('%Y-%m-%d')
+
+def get_users_with_digest(digest_date):
+    """Obtiene los user_id que ya tienen resumen para la fecha indicada"""
+    user_ids = set()
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM care_digests WHERE digest_date = ?", (digest_date,))
+        user_ids.update(row[0] for row in cursor.fetchall())
+        conn.close()
+    return user_ids
+
+def save_care_digest(user_id, digest_date, plant_type, device_id, content):
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT OR REPLACE INTO care_digests (user_id, digest_date, plant_type, device_id, content, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, digest_date, plant_type, device_id, content, datetime.now())
+    )
+    conn.commit()
+    conn.close()
+
+def get_care_digest(user_id, digest_date):
+    """Obtiene (plant_type, content) del resumen del usuario para la fecha indicada"""
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT plant_type, content FROM care_digests WHERE user_id = ? AND digest_date = ?",
+        (user_id, digest_date)
+    )
+    result = cursor.fetchone()
+    conn.close()
+    return result
+
+def get_undelivered_digests(digest_date, hour):
+    """Obtiene (user_id, plant_type, content) de los resúmenes pendientes cuya hora de entrega ya llegó.
+    
+    Incluye las horas anteriores para entregar con retraso los resúmenes que aún no estaban
+    generados a su hora (p. ej. la misma hora de DIGEST_BUILD_HOUR) o que se perdieron con el bot detenido.
+    """
+    digests = []
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT d.user_id, d.plant_type, d.content
+            FROM care_digests d
+            JOIN users u ON u.user_id = d.user_id
+            WHERE d.digest_date = ? AND d.delivered_at IS NULL AND u.digest_hour <= ?
+        ''', (digest_date, hour))
+        digests.extend(cursor.fetchall())
+        conn.close()
+    return digests
+
+def mark_digest_delivered(user_id, digest_date):
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE care_digests SET delivered_at = ? WHERE user_id = ? AND digest_date = ?",
+        (datetime.now(), user_id, digest_date)
+    )
+    conn.commit()
+    conn.close()
+
+def set_digest_hour(user_id, hour):
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET digest_hour = ? WHERE user_id = ?", (hour, user_id))
+    conn.commit()
+    conn.close()
+
+def build_digest_prompt(plant_type, device_id, recent_interactions):
+    """Construye el prompt del resumen diario para una plantación"""
+    prompt = (
+        f"Como experto en hidroponía NFT, prepara un resumen breve (máximo 200 palabras) de lo que "
+        f"el cultivador debe revisar hoy en su cultivo de {plant_type} (dispositivo {device_id}). "
+        "Incluye una lista corta de verificaciones: nivel de agua, pH, conductividad, temperatura y "
+        "estado de hojas y raíces."
+    )
+    snippet = get_knowledge_snippet(plant_type)
+    if snippet:
+        prompt += f"\n\nParámetros de referencia: {snippet}"
+    if recent_interactions:
+        prompt += "\n\nConsultas recientes del cultivador:"
+        for message, response in recent_interactions:
+            prompt += f"\n- Pregunta: {message[:200]}\n  Respuesta: {(response or '')[:200]}"
+    return prompt
+
+async def generate_care_digest(semaphore, digest_date, user_id, device_id, plant_type):
+    """Genera y guarda el resumen de una plantación respetando el límite de concurrencia"""
+    async with semaphore:
+        recent = await run_db(get_recent_interactions, user_id)
+        prompt = build_digest_prompt(plant_type, device_id, recent)
+        response = await asyncio.to_thread(
+            get_ai_response, prompt, user_id=user_id, flow='digest', enforce_budget=False
+        )
+    
+    if response.startswith("Error") or response.startswith("Lo siento") or response.startswith("No se pudo"):
+        logger.warning(f"No se pudo generar el resumen diario para usuario {user_id}: {response}")
+        return False
+    
+    await run_db(save_care_digest, user_id, digest_date, plant_type, device_id, response)
+    return True
+
+async def build_daily_digests():
+    """Genera los resúmenes del día para todas las plantaciones activas, por lotes"""
+    digest_date = get_digest_date()
+    plantings = await run_db(get_active_plantings)
+    done = await run_db(get_users_with_digest, digest_date)
+    pending = [planting for planting in plantings if planting[0] not in done]
+    
+    semaphore = asyncio.Semaphore(DIGEST_CONCURRENCY)
+    generated = 0
+    for i in range(0, len(pending), DIGEST_BATCH_SIZE):
+        batch = pending[i:i + DIGEST_BATCH_SIZE]
+        results = await asyncio.gather(
+            *(generate_care_digest(semaphore, digest_date, user_id, device_id, plant_type)
+              for user_id, device_id, plant_type in batch),
+            return_exceptions=True
+        )
+        generated += sum(1 for result in results if result is True)
+    
+    logger.info(f"Resúmenes diarios {digest_date}: {generated}/{len(pending)} generados")
+    return generated
+
+# Ingesta de telemetría de los dispositivos
+_telemetry_lock = threading.Lock()
+_telemetry_buffer = []      # Lecturas pendientes de escribir: (device_id, metric, ts, value)
+_telemetry_flush_lock = threading.Lock()  # Una sola escritura de lotes a la vez
+_telemetry_server = None
+
+def parse_telemetry_payload(body, device_id=None):
+    """Convierte el cuerpo JSON en lecturas (device_id, metric, ts, value).
+    
+    Acepta una lectura {"device_id": ..., "ts": ..., "ph": 6.1, "ec": 1.2, ...},
+    una lista de lecturas o {"device_id": ..., "readings": [...]}. Si la ruta trae
+    el dispositivo (/telemetry/<device_id>, como un tópico MQTT) no hace falta en el cuerpo.
+    """
+    if isinstance(body, dict) and isinstance(body.get('readings'), list):
+        device_id = body.get('device_id', device_id)
+        body = body['readings']
+    if isinstance(body, dict):
+        body = [body]
+    if not isinstance(body, list):
+        raise ValueError("El cuerpo debe ser una lectura o una lista de lecturas")
+    
+    now = int(time.time())
+    readings = []
+    for item in body:
+        if not isinstance(item, dict):
+            raise ValueError("Cada lectura debe ser un objeto JSON")
+        item_device = str(item.get('device_id', device_id) or '').strip()
+        if not item_device:
+            raise ValueError("Falta device_id")
+        ts = item.get('ts', now)
+        if not isinstance(ts, (int, float)) or not math.isfinite(ts) or ts <= 0:
+            raise ValueError("ts debe ser un timestamp Unix en segundos")
+        for metric in SENSOR_METRICS:
+            value = item.get(metric)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if not math.isfinite(value):
+                    raise ValueError(f"{metric} debe ser un número finito")
+                readings.append((item_device, metric, int(ts), float(value)))
+    return readings
+
+def buffer_telemetry(readings):
+    """Encola lecturas para la escritura por lotes; devuelve False si el buffer está lleno"""
+    with _telemetry_lock:
+        if len(_telemetry_buffer) + len(readings) > TELEMETRY_BUFFER_MAX:
+            return False
+        _telemetry_buffer.extend(readings)
+    return True
+
+@timed_db_write
+def flush_telemetry():
+    """Escribe las lecturas pendientes y actualiza los agregados en una sola transacción.
+    
+    Las lecturas solo salen del buffer cuando la transacción se confirma; si falla,
+    se reintentan en la siguiente ejecución.
+    """
+    with _telemetry_flush_lock:
+        with _telemetry_lock:
+            batch = _telemetry_buffer[:]
+        
+        if not batch:
+            return 0
+        
+        write_telemetry_batch(batch)
+        # Las lecturas nuevas se añaden al final, así que el lote escrito es el prefijo del buffer
+        with _telemetry_lock:
+            del _telemetry_buffer[:len(batch)]
+    
+    # Evaluar las reglas de alerta sobre las lecturas recién escritas
+    ALERT_ENGINE.process(batch)
+    return len(batch)
+
+def write_telemetry_batch(batch):
+    """Inserta un lote de lecturas y sus agregados en una sola transacción"""
+    # Agregar en memoria por (dispositivo, métrica, resolución, intervalo) antes de escribir
+    rollups = {}
+    for device_id, metric, ts, value in batch:
+        for resolution, seconds in SENSOR_ROLLUPS.items():
+            key = (device_id, metric, resolution, ts - ts % seconds)
+            agg = rollups.get(key)
+            if agg is None:
+                rollups[key] = [1, value, value, value, ts, value]
+            else:
+                agg[0] += 1
+                agg[1] += value
+                agg[2] = min(agg[2], value)
+                agg[3] = max(agg[3], value)
+                if ts >= agg[4]:
+                    agg[4], agg[5] = ts, value
+    
+    # Sin commit (error a mitad de lote) la conexión se cierra y la transacción se revierte
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO sensor_readings (device_id, metric, ts, value) VALUES (?, ?, ?, ?)",
+            batch
+        )
+        cursor.executemany(
+            "INSERT INTO sensor_rollups (device_id, metric, resolution, bucket, count, sum, min, max, last_ts, last_value) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(device_id, metric, resolution, bucket) DO UPDATE SET "
+            "count = count + excluded.count, "
+            "sum = sum + excluded.sum, "
+            "min = MIN(min, excluded.min), "
+            "max = MAX(max, excluded.max), "
+            "last_value = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last_value ELSE last_value END, "
+            "last_ts = MAX(last_ts, excluded.last_ts)",
+            [(*key, *agg) for key, agg in rollups.items()]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def prune_telemetry():
+    """Borra por lotes las lecturas crudas y los agregados por minuto más antiguos que su retención"""
+    now = int(time.time())
+    raw_cutoff = now - TELEMETRY_RAW_KEEP_DAYS * 86400
+    minute_cutoff = now - TELEMETRY_MINUTE_KEEP_DAYS * 86400
+    deleted = 0
+    
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    cursor = conn.cursor()
+    # Las lecturas llegan casi en orden, así que se borra por rango de id (sin índice por ts)
+    while True:
+        cursor.execute(
+            "SELECT MAX(id) FROM (SELECT id, ts FROM sensor_readings ORDER BY id LIMIT ?) WHERE ts < ?",
+            (TELEMETRY_PRUNE_BATCH_SIZE, raw_cutoff)
+        )
+        last_id = cursor.fetchone()[0]
+        if last_id is None:
+            break
+        cursor.execute("DELETE FROM sensor_readings WHERE id <= ? AND ts < ?", (last_id, raw_cutoff))
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount == 0:
+            break
+    
+    cursor.execute(
+        "DELETE FROM sensor_rollups WHERE resolution = 'minute' AND bucket < ?",
+        (minute_cutoff,)
+    )
+    deleted += cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+def get_sensor_latest(device_id):
+    """Última lectura de cada métrica del dispositivo: {metric: (ts, value)}"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    latest = {}
+    for metric in SENSOR_METRICS:
+        cursor.execute(
+            "SELECT last_ts, last_value FROM sensor_rollups "
+            "WHERE device_id = ? AND metric = ? AND resolution = 'minute' "
+            "ORDER BY bucket DESC LIMIT 1",
+            (device_id, metric)
+        )
+        row = cursor.fetchone()
+        if row:
+            latest[metric] = row
+    conn.close()
+    return latest
+
+def get_sensor_summary(device_id, resolution, since_ts):
+    """Resumen por métrica desde since_ts a partir de los agregados: {metric: (promedio, mínimo, máximo, lecturas)}"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT metric, SUM(sum) / SUM(count), MIN(min), MAX(max), SUM(count) FROM sensor_rollups "
+        "WHERE device_id = ? AND resolution = ? AND bucket >= ? GROUP BY metric",
+        (device_id, resolution, since_ts - since_ts % SENSOR_ROLLUPS[resolution])
+    )
+    summary = {metric: tuple(values) for metric, *values in cursor.fetchall()}
+    conn.close()
+    return summary
+
+def format_sensor_value(metric, value):
+    return f"{value:.2f}{SENSOR_METRICS[metric][1]}"
+
+class TelemetryRequestHandler(BaseHTTPRequestHandler):
+    """Endpoint POST /telemetry[/<device_id>] para las lecturas de los dispositivos.
+    
+    Ejemplo: curl -X POST localhost:8080/telemetry/ABC123 -d '{"ph": 6.1, "ec": 1.1}'
+    """
+    
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path != '/telemetry' and not path.startswith('/telemetry/'):
+            self.send_json(404, {"error": "not found"})
+            return
+        if TELEMETRY_TOKEN and not hmac.compare_digest(
+            self.headers.get('X-Telemetry-Token', '').encode('utf-8'), TELEMETRY_TOKEN.encode('utf-8')
+        ):
+            self.send_json(401, {"error": "unauthorized"})
+            return
+        
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_json(400, {"error": "invalid Content-Length"})
+            return
+        if length <= 0 or length > TELEMETRY_MAX_BODY_BYTES:
+            self.send_json(413 if length else 400, {"error": "invalid body size"})
+            return
+        
+        try:
+            body = json.loads(self.rfile.read(length))
+            readings = parse_telemetry_payload(body, path[len('/telemetry/'):] or None)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        
+        if not buffer_telemetry(readings):
+            self.send_json(503, {"error": "buffer full"}, {"Retry-After": str(TELEMETRY_FLUSH_INTERVAL_SECONDS)})
+            return
+        self.send_json(202, {"accepted": len(readings)})
+    
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        logger.debug("Telemetría %s - %s", self.address_string(), format % args)
+
+def start_telemetry_server():
+    """Inicia el endpoint de ingesta en un hilo aparte"""
+    global _telemetry_server
+    if TELEMETRY_PORT is None:
+        return None
+    if not TELEMETRY_TOKEN and TELEMETRY_HOST not in ('127.0.0.1', 'localhost', '::1'):
+        logger.error(f"Ingesta de telemetría desactivada: escuchar en {TELEMETRY_HOST} requiere TELEMETRY_TOKEN")
+        return None
+    _telemetry_server = ThreadingHTTPServer((TELEMETRY_HOST, TELEMETRY_PORT), TelemetryRequestHandler)
+    _telemetry_server.daemon_threads = True
+    threading.Thread(target=_telemetry_server.serve_forever, name='telemetry', daemon=True).start()
+    logger.info(f"Ingesta de telemetría escuchando en {TELEMETRY_HOST}:{TELEMETRY_PORT}")
+    return _telemetry_server
+
+def stop_telemetry_server():
+    global _telemetry_server
+    if _telemetry_server is not None:
+        _telemetry_server.shutdown()
+        _telemetry_server.server_close()
+        _telemetry_server = None
+
+# Reglas de alerta evaluadas de forma incremental sobre las lecturas
+def get_device_subscribers(device_ids):
+    """Obtiene {device_id: [(user_id, plant_type), ...]} de los usuarios que tienen registrados esos dispositivos"""
+    if not device_ids:
+        return {}
+    subscribers = {device_id: [] for device_id in device_ids}
+    placeholders = ','.join('?' * len(device_ids))
+    # El dispositivo no determina el shard, así que se consultan todos
+    for path in get_shard_paths():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT u.device_id, u.user_id, ps.plant_type
+            FROM users u
+            LEFT JOIN plant_selections ps
+              ON ps.id = (SELECT MAX(id) FROM plant_selections WHERE user_id = u.user_id)
+            WHERE u.device_id IN ({placeholders})
+        ''', list(device_ids))
+        for device_id, user_id, plant_type in cursor.fetchall():
+            subscribers[device_id].append((user_id, plant_type))
+        conn.close()
+    return subscribers
+
+def get_alert_range(metric, plant_type):
+    """Rango aceptable (mínimo, máximo) de la métrica según el cultivo; None si no hay referencia"""
+    if metric == 'nivel':
+        return (ALERT_MIN_LEVEL, None)
+    info = PLANT_KNOWLEDGE.get(plant_type)
+    key = ALERT_KNOWLEDGE_KEYS.get(metric)
+    if not info or not key:
+        return None
+    return info[key]
+
+class AlertEngine:
+    """Evalúa reglas de rango, velocidad de cambio y falta de datos con estado O(1) por dispositivo y regla"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_reading = {}   # (device_id, metric) -> (ts, value)
+        self.rate_anchor = {}    # (device_id, metric) -> (ts, value) al inicio de la ventana de cambio
+        self.last_seen = {}      # device_id -> ts de la última lectura
+        self.rules = {}          # (device_id, metric, rule) -> {'active', 'streak', 'since', 'notified'}
+        self.subscribers = {}    # device_id -> (cargado_en, [(user_id, plant_type)])
+        self.pending = []        # Notificaciones por enviar: (user_id, texto)
+        self.loaded = False
+    
+    def load(self):
+        """Recupera de la base las alertas activas y la última lectura de cada dispositivo"""
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("SELECT device_id, metric, rule, active, since, last_notified FROM sensor_alerts")
+        for device_id, metric, rule, active, since, notified in cursor.fetchall():
+            self.rules[(device_id, metric, rule)] = {
+                'active': bool(active), 'streak': 0, 'since': since, 'notified': notified
+            }
+        cursor.execute(
+            "SELECT device_id, MAX(last_ts) FROM sensor_rollups WHERE resolution = 'day' GROUP BY device_id"
+        )
+        self.last_seen.update(cursor.fetchall())
+        conn.close()
+        self.loaded = True
+    
+    def get_subscribers(self, device_ids):
+        """Usuarios y cultivo de cada dispositivo, consultando solo los que no están en memoria"""
+        now = time.time()
+        missing = [d for d in device_ids
+                   if d not in self.subscribers or now - self.subscribers[d][0] > ALERT_CONTEXT_TTL_SECONDS]
+        for _ in range(len(device_ids) - len(missing)):
+            CACHE_COUNTERS['suscriptores_alertas'].record(True)
+        for _ in missing:
+            CACHE_COUNTERS['suscriptores_alertas'].record(False)
+        for device_id, subscribers in get_device_subscribers(missing).items():
+            self.subscribers[device_id] = (now, subscribers)
+        return {d: self.subscribers[d][1] for d in device_ids}
+    
+    def update_rule(self, key, breached, cleared, ts, confirm=ALERT_CONFIRM_READINGS):
+        """Aplica debounce a una regla; devuelve 'fire', 'repeat', 'clear' o None y guarda los cambios de estado"""
+        state = self.rules.setdefault(key, {'active': False, 'streak': 0, 'since': None, 'notified': None})
+        event = None
+        if breached:
+            state['streak'] += 1
+            if not state['active'] and state['streak'] >= confirm:
+                state.update(active=True, since=ts, notified=ts)
+                event = 'fire'
+            elif state['active'] and ts - (state['notified'] or 0) >= ALERT_REPEAT_SECONDS:
+                state['notified'] = ts
+                event = 'repeat'
+        else:
+            state['streak'] = 0
+            if state['active'] and cleared:
+                state.update(active=False, since=None, notified=None)
+                event = 'clear'
+        if event:
+            self.save_rule(key, state)
+        return event
+    
+    def save_rule(self, key, state):
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        conn.execute(
+            "INSERT OR REPLACE INTO sensor_alerts (device_id, metric, rule, active, since, last_notified) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (*key, int(state['active']), state['since'], state['notified'])
+        )
+        conn.commit()
+        conn.close()
+    
+    def notify(self, subscribers, text):
+        for user_id, _ in subscribers:
+            self.pending.append((user_id, text))
+    
+    def process(self, readings):
+        """Evalúa las reglas de rango y velocidad de cambio para un lote de lecturas"""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            subscribers = self.get_subscribers({device_id for device_id, _, _, _ in readings})
+            for device_id, metric, ts, value in sorted(readings, key=lambda reading: reading[2]):
+                self.last_seen[device_id] = max(ts, self.last_seen.get(device_id, 0))
+                device_subscribers = subscribers.get(device_id)
+                if not device_subscribers:
+                    continue
+                
+                # Las lecturas atrasadas no cambian el estado incremental
+                previous = self.last_reading.get((device_id, metric))
+                if previous and ts < previous[0]:
+                    continue
+                self.last_reading[(device_id, metric)] = (ts, value)
+                
+                self.check_range(device_id, metric, ts, value, device_subscribers)
+                self.check_rate(device_id, metric, ts, value, device_subscribers)
+    
+    def check_range(self, device_id, metric, ts, value, subscribers):
+        plant_type = subscribers[0][1]
+        limits = get_alert_range(metric, plant_type)
+        if not limits:
+            return
+        low, high = limits
+        margin = ALERT_HYSTERESIS.get(metric, 0)
+        breached = (low is not None and value < low) or (high is not None and value > high)
+        cleared = (low is None or value >= low + margin) and (high is None or value <= high - margin)
+        event = self.update_rule((device_id, metric, 'range'), breached, cleared, ts)
+        
+        name = SENSOR_METRICS[metric][0]
+        crop = PLANT_KNOWLEDGE[plant_type]['nombre'] if plant_type in PLANT_KNOWLEDGE else None
+        if event in ('fire', 'repeat'):
+            expected = format_range(limits, SENSOR_METRICS[metric][1]) if high is not None else f"mínimo {low}{SENSOR_METRICS[metric][1]}"
+            self.notify(subscribers,
+                f"⚠️ {name} fuera de rango en el dispositivo {device_id}: {format_sensor_value(metric, value)}\n"
+                f"Recomendado{' para ' + crop if crop else ''}: {expected}")
+        elif event == 'clear':
+            self.notify(subscribers,
+                f"✅ {name} de nuevo en rango en el dispositivo {device_id}: {format_sensor_value(metric, value)}")
+    
+    def check_rate(self, device_id, metric, ts, value, subscribers):
+        anchor = self.rate_anchor.get((device_id, metric))
+        if anchor is None:
+            self.rate_anchor[(device_id, metric)] = (ts, value)
+            return
+        elapsed = ts - anchor[0]
+        if elapsed < ALERT_RATE_WINDOW_SECONDS:
+            return
+        self.rate_anchor[(device_id, metric)] = (ts, value)
+        
+        rate = (value - anchor[1]) * 3600 / elapsed
+        limit = ALERT_RATE_LIMITS.get(metric)
+        if limit is None:
+            return
+        event = self.update_rule((device_id, metric, 'rate'), abs(rate) > limit, abs(rate) <= limit, ts, confirm=1)
+        if event in ('fire', 'repeat'):
+            self.notify(subscribers,
+                f"📈 {SENSOR_METRICS[metric][0]} cambia rápido en el dispositivo {device_id}: "
+                f"{rate:+.2f}{SENSOR_METRICS[metric][1]} por hora (ahora {format_sensor_value(metric, value)})")
+    
+    def check_stale(self, now=None):
+        """Revisa los dispositivos que dejaron de enviar lecturas"""
+        now = int(now or time.time())
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            subscribers = self.get_subscribers(list(self.last_seen))
+            for device_id, last_ts in self.last_seen.items():
+                if not subscribers.get(device_id):
+                    continue
+                stale = now - last_ts > ALERT_STALE_SECONDS
+                event = self.update_rule((device_id, '*', 'stale'), stale, not stale, now, confirm=1)
+                if event in ('fire', 'repeat'):
+                    self.notify(subscribers[device_id],
+                        f"📡 El dispositivo {device_id} no envía lecturas desde "
+                        f"{datetime.fromtimestamp(last_ts).strftime('%d/%m %H:%M')}.")
+                elif event == 'clear':
+                    self.notify(subscribers[device_id], f"📡 El dispositivo {device_id} volvió a enviar lecturas.")
+    
+    def pop_notifications(self):
+        with self.lock:
+            pending = self.pending[:]
+            self.pending.clear()
+        return pending
+
+ALERT_ENGINE = AlertEngine()
+
+# Campañas de difusión: recorren users por clave (shard, user_id) y guardan el cursor tras cada página
+def create_broadcast(message, plant_type=None, active_days=None, created_by=None):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO broadcast_campaigns (message, plant_type, active_days, status, created_by, created_at) "
+        "VALUES (?, ?, ?, 'running', ?, ?)",
+        (message, plant_type, active_days, created_by, int(time.time()))
+    )
+    campaign_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return campaign_id
+
+def get_broadcast(campaign_id):
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM broadcast_campaigns WHERE id = ?", (campaign_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return dict(result) if result else None
+
+def get_recent_broadcasts(limit=5):
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM broadcast_campaigns ORDER BY id DESC LIMIT ?", (limit,))
+    results = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return results
+
+def get_running_broadcasts():
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM broadcast_campaigns WHERE status = 'running' ORDER BY id")
+    results = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return results
+
+def set_broadcast_status(campaign_id, status):
+    """Cambia el estado de una campaña en curso; devuelve False si ya había terminado"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE broadcast_campaigns SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+        (status, int(time.time()) if status != 'running' else None, campaign_id)
+    )
+    updated = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return updated
+
+def fetch_broadcast_page(campaign, page_size=BROADCAST_PAGE_SIZE):
+    """Siguiente página de destinatarios a partir del cursor de la campaña.
+
+    Devuelve (shard, último user_id leído, user_ids pendientes) o (None, None, []) al terminar.
+    Los usuarios que ya tienen resultado en la campaña se omiten (reanudación tras una caída).
+    """
+    conditions = ["user_id > ?", "blocked_at IS NULL"]
+    params = []
+    if campaign['active_days']:
+        conditions.append("last_activity >= ?")
+        params.append(datetime.now() - timedelta(days=campaign['active_days']))
+    if campaign['plant_type']:
+        conditions.append(
+            "(SELECT plant_type FROM plant_selections p WHERE p.user_id = users.user_id ORDER BY p.id DESC LIMIT 1) = ?"
+        )
+        params.append(campaign['plant_type'])
+    query = f"SELECT user_id FROM users WHERE {' AND '.join(conditions)} ORDER BY user_id LIMIT ?"
+    
+    shard, last_user_id = campaign['shard'], campaign['last_user_id']
+    while shard < SHARD_COUNT:
+        conn = sqlite3.connect(get_shard_path(shard))
+        user_ids = [row[0] for row in conn.execute(query, (last_user_id, *params, page_size))]
+        conn.close()
+        if user_ids:
+            break
+        shard, last_user_id = shard + 1, 0
+    else:
+        return None, None, []
+    
+    conn = sqlite3.connect(DB_PATH)
+    done = {row[0] for row in conn.execute(
+        f"SELECT user_id FROM broadcast_deliveries WHERE campaign_id = ? AND user_id IN ({', '.join('?' * len(user_ids))})",
+        (campaign['id'], *user_ids)
+    )}
+    conn.close()
+    return shard, user_ids[-1], [user_id for user_id in user_ids if user_id not in done]
+
+def mark_users_blocked(user_ids):
+    """Marca a los usuarios que bloquearon el bot para que las difusiones los omitan"""
+    now = datetime.now()
+    for shard, shard_user_ids in group_by_shard(user_ids).items():
+        conn = sqlite3.connect(get_shard_path(shard), timeout=10)
+        conn.executemany("UPDATE users SET blocked_at = ? WHERE user_id = ?", [(now, user_id) for user_id in shard_user_ids])
+        conn.commit()
+        conn.close()
+
+@timed_db_write
+def record_broadcast_page(campaign_id, shard, last_user_id, results):
+    """Guarda los resultados [(user_id, estado, error)] de una página y avanza el cursor en una transacción"""
+    now = int(time.time())
+    counts = {status: sum(1 for _, result, _ in results if result == status) for status in ('sent', 'failed', 'blocked')}
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO broadcast_deliveries (campaign_id, user_id, status, error, sent_at) VALUES (?, ?, ?, ?, ?)",
+        [(campaign_id, user_id, status, error, now) for user_id, status, error in results]
+    )
+    cursor.execute(
+        "UPDATE broadcast_campaigns SET shard = ?, last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ? "
+        "WHERE id = ?",
+        (shard, last_user_id, counts['sent'], counts['failed'], counts['blocked'], campaign_id)
+    )
+    conn.commit()
+    conn.close()
+    
+    blocked = [user_id for user_id, status, _ in results if status == 'blocked']
+    if blocked:
+        mark_users_blocked(blocked)
+
+# Contabilidad de tokens de Gemini por usuario y flujo
+_usage_lock = threading.Lock()
+_usage_buffer = []   # Llamadas pendientes de escribir: (user_id, flow, model, prompt, candidates, total, latency_ms, created_at)
+_daily_tokens = {}   # (user_id, fecha) -> tokens consumidos en el día, incluyendo lo aún no escrito
+_usage_flush_lock = threading.Lock()  # Serializa la escritura de lotes con la carga de totales desde la base
+
+def get_usage_date():
+    return datetime.now().strftime('%Y-%m-%d')
+
+def _load_daily_tokens(user_id, usage_date):
+    """Tokens del usuario en la fecha; si no están en memoria se leen de la base sin retener _usage_lock"""
+    key = (user_id, usage_date)
+    with _usage_lock:
+        tokens = _daily_tokens.get(key)
+    CACHE_COUNTERS['tokens_diarios'].record(tokens is not None)
+    if tokens is not None:
+        return tokens
+    
+    # Sin una escritura de lotes en curso, lo confirmado en la base y lo pendiente en el buffer no se solapan
+    with _usage_flush_lock:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT COALESCE(SUM(total_tokens), 0) FROM ai_usage_daily WHERE user_id = ? AND usage_date = ?",
+            (user_id, usage_date)
+        )
+        stored = cursor.fetchone()[0]
+        conn.close()
+        with _usage_lock:
+            if key not in _daily_tokens:
+                _daily_tokens[key] = stored + sum(
+                    call[5] for call in _usage_buffer
+                    if call[0] == user_id and datetime.fromtimestamp(call[7]).strftime('%Y-%m-%d') == usage_date
+                )
+            return _daily_tokens[key]
+
+def get_user_tokens_today(user_id):
+    return _load_daily_tokens(user_id, get_usage_date())
+
+def is_over_token_budget(user_id):
+    """Indica si el usuario ya agotó su presupuesto diario de tokens"""
+    return bool(USER_DAILY_TOKEN_BUDGET) and get_user_tokens_today(user_id) >= USER_DAILY_TOKEN_BUDGET
+
+def record_ai_usage(user_id, flow, model, usage_metadata, latency_ms):
+    """Registra en memoria el consumo de una llamada; flush_ai_usage lo escribe por lotes"""
+    prompt_tokens = usage_metadata.get("promptTokenCount", 0)
+    candidate_tokens = usage_metadata.get("candidatesTokenCount", 0)
+    total_tokens = usage_metadata.get("totalTokenCount", prompt_tokens + candidate_tokens)
+    
+    usage_date = get_usage_date()
+    with _usage_lock:
+        _usage_buffer.append((
+            user_id, flow, model, prompt_tokens, candidate_tokens, total_tokens, int(latency_ms), int(time.time())
+        ))
+        key = (user_id, usage_date)
+        if key in _daily_tokens:
+            _daily_tokens[key] += total_tokens
+            return
+    # Primera llamada del día: el total se carga de la base e incluye la llamada recién encolada
+    if user_id is not None:
+        _load_daily_tokens(user_id, usage_date)
+
+@timed_db_write
+def flush_ai_usage():
+    """Escribe las llamadas pendientes y actualiza los agregados diarios en una sola transacción.
+    
+    Las llamadas solo salen del buffer cuando la transacción se confirma; si falla, se reintentan
+    en la siguiente ejecución.
+    """
+    with _usage_flush_lock:
+        with _usage_lock:
+            batch = _usage_buffer[:]
+            # Descartar contadores de días anteriores
+            today = get_usage_date()
+            for key in [key for key in _daily_tokens if key[1] != today]:
+                del _daily_tokens[key]
+        
+        if not batch:
+            return 0
+        
+        write_ai_usage_batch(batch)
+        # Las llamadas nuevas se añaden al final, así que el lote escrito es el prefijo del buffer
+        with _usage_lock:
+            del _usage_buffer[:len(batch)]
+    return len(batch)
+
+def write_ai_usage_batch(batch):
+    """Inserta un lote de llamadas y sus agregados diarios en una sola transacción"""
+    # Agregar en memoria por (usuario, fecha, flujo) antes de escribir
+    daily = {}
+    for user_id, flow, model, prompt_tokens, candidate_tokens, total_tokens, latency_ms, created_at in batch:
+        usage_date = datetime.fromtimestamp(created_at).strftime('%Y-%m-%d')
+        totals = daily.setdefault((user_id, usage_date, flow), [0, 0, 0, 0, 0])
+        totals[0] += 1
+        totals[1] += prompt_tokens
+        totals[2] += candidate_tokens
+        totals[3] += total_tokens
+        totals[4] += latency_ms
+    
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO ai_usage (user_id, flow, model, prompt_tokens, candidate_tokens, total_tokens, latency_ms, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            batch
+        )
+        cursor.executemany(
+            "INSERT INTO ai_usage_daily (user_id, usage_date, flow, calls, prompt_tokens, candidate_tokens, total_tokens, latency_ms_total) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id, usage_date, flow) DO UPDATE SET "
+            "calls = calls + excluded.calls, "
+            "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+            "candidate_tokens = candidate_tokens + excluded.candidate_tokens, "
+            "total_tokens = total_tokens + excluded.total_tokens, "
+            "latency_ms_total = latency_ms_total + excluded.latency_ms_total",
+            [(user_id if user_id is not None else 0, usage_date, flow, *totals)
+             for (user_id, usage_date, flow), totals in daily.items()]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_top_token_consumers(days=1, limit=10):
+    """Obtiene (user_id, username, llamadas, tokens, latencia media ms) de los mayores consumidores"""
+    since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT user_id, SUM(calls), SUM(total_tokens), SUM(latency_ms_total) / MAX(SUM(calls), 1)
+        FROM ai_usage_daily
+        WHERE usage_date >= ?
+        GROUP BY user_id
+        ORDER BY SUM(total_tokens) DESC
+        LIMIT ?
+    ''', (since, limit))
+    rows = cursor.fetchall()
+    conn.close()
+    
+    # Los usuarios viven en sus shards; se consultan después de agregar
+    usernames = get_usernames([row[0] for row in rows])
+    return [(user_id, usernames.get(user_id), *totals) for user_id, *totals in rows]
+
+def get_token_usage_by_flow(days=1):
+    """Obtiene (flujo, llamadas, tokens, latencia media ms) agregados en los últimos días"""
+    since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT flow, SUM(calls), SUM(total_tokens), SUM(latency_ms_total) / MAX(SUM(calls), 1)
+        FROM ai_usage_daily
+        WHERE usage_date >= ?
+        GROUP BY flow
+        ORDER BY SUM(total_tokens) DESC
+    ''', (since,))
+    flows = cursor.fetchall()
+    conn.close()
+    return flows
+
+def is_admin(user_id):
+    return user_id in ADMIN_USER_IDS
+
+# Enrutamiento de solicitudes entre variantes de Gemini
+class ModelRouter:
+    """Elige el modelo de Gemini para cada clase de solicitud.
+
+    Sigue el orden de MODEL_ROUTES, pero pasa al final los modelos degradados (tasa de error
+    o p95 de latencia por encima de los umbrales en la ventana reciente) o con el circuito abierto.
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, latency_ms, ok):
+        with self._lock:
+            samples = self._samples.setdefault(model, deque(maxlen=MODEL_STATS_WINDOW))
+            samples.append((latency_ms, ok))
+
+    def stats(self, model):
+        """Devuelve (muestras, p95 en ms, tasa de error) de la ventana reciente del modelo"""
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        if not samples:
+            return 0, 0.0, 0.0
+        latencies = sorted(latency for latency, _ in samples)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        error_rate = sum(1 for _, ok in samples if not ok) / len(samples)
+        return len(samples), p95, error_rate
+
+    def is_degraded(self, model):
+        count, p95, error_rate = self.stats(model)
+        if get_circuit_breaker(f'gemini:{model}').is_open():
+            return True
+        return count >= MODEL_MIN_SAMPLES and (error_rate > MODEL_MAX_ERROR_RATE or p95 > MODEL_MAX_P95_MS)
+
+    def candidates(self, request_class):
+        """Modelos a probar en orden: primero los sanos según la regla, luego los degradados"""
+        models = self.routes.get(request_class) or self.routes['text']
+        healthy = [model for model in models if not self.is_degraded(model)]
+        return healthy + [model for model in models if model not in healthy]
+
+    def is_available(self, request_class):
+        """Indica si algún modelo de la ruta tiene el circuito cerrado"""
+        models = self.routes.get(request_class) or self.routes['text']
+        return any(not get_circuit_breaker(f'gemini:{model}').is_open() for model in models)
+
+MODEL_ROUTER = ModelRouter(MODEL_ROUTES)
+
+# Control de sobrecarga
+class OverloadController:
+    """Sube de modo degradado cuando crece el trabajo pendiente o el p95 de Gemini y baja solo.
+    
+    Los updates se procesan de uno en uno, así que la carga se acumula en la cola de updates
+    de PTB (update_queue, asignada al arrancar) y no en las llamadas a Gemini en curso.
+
+    Los niveles se acumulan: 1 omite el filtro de fotos, 2 recorta la respuesta y el contexto,
+    3 sirve antes respuestas guardadas y 4 rechaza las consultas nuevas. Se sube de golpe al nivel
+    que marcan las señales y se baja de uno en uno tras OVERLOAD_RECOVERY_SECONDS por debajo del
+    umbral con histéresis.
+    """
+    
+    def __init__(self):
+        self.level = 0
+        self.changed_at = time.time()
+        self.calm_since = None
+        self.events = []              # Cambios pendientes de escribir: (anterior, nuevo, trabajo pendiente, p95, ts)
+        self._latencies = deque()     # (ts, latencia en ms)
+        self._lock = threading.Lock()
+        self.update_queue = None      # application.update_queue, asignada en on_startup
+    
+    def observe(self, latency_ms):
+        with self._lock:
+            self._latencies.append((time.time(), latency_ms))
+        self.evaluate()
+    
+    def pending_work(self):
+        """Updates esperando en la cola de PTB + llamadas a Gemini en curso + consultas SQLite en cola"""
+        backlog = self.update_queue.qsize() if self.update_queue is not None else 0
+        return backlog + GEMINI_IN_FLIGHT.value + _db_pending
+    
+    def signals(self):
+        """Devuelve (trabajo pendiente, p95 en ms de la ventana reciente)"""
+        since = time.time() - OVERLOAD_WINDOW_SECONDS
+        with self._lock:
+            while self._latencies and self._latencies[0][0] < since:
+                self._latencies.popleft()
+            latencies = sorted(latency for _, latency in self._latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if len(latencies) >= OVERLOAD_MIN_SAMPLES else 0.0
+        return self.pending_work(), p95
+    
+    def target_level(self, pending, p95, factor=1.0):
+        level = 0
+        for candidate, (max_pending, max_p95) in sorted(OVERLOAD_THRESHOLDS.items()):
+            if pending >= max_pending * factor or p95 >= max_p95 * factor:
+                level = candidate
+        return level
+    
+    def evaluate(self):
+        """Recalcula el nivel con las señales actuales y lo devuelve"""
+        pending, p95 = self.signals()
+        now = time.time()
+        with self._lock:
+            previous = self.level
+            if self.target_level(pending, p95) > self.level:
+                self.level = self.target_level(pending, p95)
+                self.calm_since = None
+            elif self.level and self.target_level(pending, p95, OVERLOAD_RECOVERY_FACTOR) < self.level:
+                if self.calm_since is None:
+                    self.calm_since = now
+                elif now - self.calm_since >= OVERLOAD_RECOVERY_SECONDS:
+                    self.level -= 1
+                    self.calm_since = now
+            else:
+                self.calm_since = None
+            level = self.level
+            if level != previous:
+                self.changed_at = now
+                self.events.append((OVERLOAD_MODES[previous], OVERLOAD_MODES[level], pending, int(p95), int(now)))
+        
+        if level != previous:
+            log = logger.warning if level > previous else logger.info
+            log(f"Modo de sobrecarga: {OVERLOAD_MODES[previous]} -> {OVERLOAD_MODES[level]} "
+                f"({pending} tareas pendientes, p95 {p95:.0f} ms)")
+        return level
+    
+    def mode(self):
+        return OVERLOAD_MODES[self.evaluate()]
+    
+    def skip_image_gate(self):
+        return self.evaluate() >= 1
+    
+    def generation_limits(self):
+        """Devuelve (maxOutputTokens, mensajes de contexto o None para no recortar)"""
+        if self.evaluate() >= 2:
+            return OVERLOAD_REDUCED_OUTPUT_TOKENS, OVERLOAD_REDUCED_CONTEXT_MESSAGES
+        return 1024, None
+    
+    def prefer_cached(self):
+        return self.evaluate() >= 3
+    
+    def should_reject(self):
+        return self.evaluate() >= 4
+    
+    def rejection_message(self):
+        return (f"Lo siento, el asistente está saturado en este momento. "
+                f"Inténtalo de nuevo en {OVERLOAD_RETRY_AFTER_SECONDS} segundos.")
+    
+    def pop_events(self):
+        with self._lock:
+            events = self.events[:]
+            self.events.clear()
+        return events
+
+OVERLOAD_CONTROLLER = OverloadController()
+
+def flush_overload_events():
+    """Escribe los cambios de modo pendientes en overload_events"""
+    events = OVERLOAD_CONTROLLER.pop_events()
+    if not events:
+        return 0
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO overload_events (previous_mode, mode, in_flight, p95_ms, created_at) VALUES (?, ?, ?, ?, ?)",
+        events
+    )
+    conn.commit()
+    conn.close()
+    return len(events)
+
+def classify_request(flow, question, has_image):
+    """Clase de solicitud según el flujo y el tamaño de la pregunta (el texto del usuario, sin el prompt añadido)"""
+    if flow == 'image_gate':
+        return 'classify'
+    if has_image:
+        return 'image'
+    if flow == 'digest':
+        return 'digest'
+    return 'short_text' if len(question) <= SHORT_TEXT_MAX_CHARS else 'text'
+
+def send_gemini_request(model, payload, headers):
+    endpoint = GEMINI_ENDPOINT_TEMPLATE.format(model=model)
+    dependency = f'gemini:{model}'
+    GEMINI_IN_FLIGHT.add(1)
+    try:
+        if GEMINI_HEDGE_AFTER_SECONDS:
+            return hedged_request(dependency, 'POST', endpoint, GEMINI_HEDGE_AFTER_SECONDS, json=payload, headers=headers)
+        # generateContent no tiene efectos secundarios, se puede reintentar
+        return resilient_request(dependency, 'POST', endpoint, idempotent=True, json=payload, headers=headers)
+    finally:
+        GEMINI_IN_FLIGHT.add(-1)
+
+def route_gemini_request(request_class, payload, headers):
+    """Envía la solicitud al primer modelo disponible de la ruta y cambia al siguiente si falla.
+
+    Devuelve (respuesta, modelo, latencia en ms).
+    """
+    last_error = None
+    last_result = None
+    
+    for model in MODEL_ROUTER.candidates(request_class):
+        started = time.perf_counter()
+        try:
+            response = send_gemini_request(model, payload, headers)
+        except DependencyUnavailable as e:
+            last_error = e
+            continue
+        except (requests.ConnectionError, requests.Timeout) as e:
+            MODEL_ROUTER.record(model, (time.perf_counter() - started) * 1000, ok=False)
+            OVERLOAD_CONTROLLER.observe((time.perf_counter() - started) * 1000)
+            last_error = e
+            continue
+        
+        latency_ms = (time.perf_counter() - started) * 1000
+        ok = response.status_code not in MODEL_FALLBACK_STATUS_CODES
+        MODEL_ROUTER.record(model, latency_ms, ok)
+        OVERLOAD_CONTROLLER.observe(latency_ms)
+        if ok:
+            return response, model, latency_ms
+        
+        logger.warning(f"Modelo {model} respondió {response.status_code}; se prueba el siguiente de la ruta {request_class}")
+        last_result = (response, model, latency_ms)
+    
+    if last_result:
+        return last_result
+    raise last_error or DependencyUnavailable('gemini')
+
+# Preparación de imágenes para Gemini (inline o mediante la API de archivos)
+_image_part_cache = OrderedDict()   # file_unique_id de Telegram -> (parte de Gemini, expira en)
+_image_part_cache_lock = threading.Lock()
+
+def build_image_part(image_data):
+    """Parte de Gemini para una imagen: acepta base64 o una parte ya construida (inline_data o file_data)"""
+    if isinstance(image_data, dict):
+        return image_data
+    return {
+        "inline_data": {
+            "mime_type": "image/jpeg",
+            "data": image_data
+        }
+    }
+
+def upload_gemini_file(stream, size, mime_type='image/jpeg', display_name='foto'):
+    """Sube una imagen con la API de archivos de Gemini (subida reanudable) y devuelve su URI.
+
+    El cuerpo se envía directamente desde el stream, sin copias intermedias ni base64.
+    """
+    start = resilient_request(
+        'gemini_upload', 'POST', GEMINI_UPLOAD_URL, idempotent=True,
+        headers={
+            'X-Goog-Upload-Protocol': 'resumable',
+            'X-Goog-Upload-Command': 'start',
+            'X-Goog-Upload-Header-Content-Length': str(size),
+            'X-Goog-Upload-Header-Content-Type': mime_type,
+            'Content-Type': 'application/json',
+        },
+        json={'file': {'display_name': display_name}}
+    )
+    upload_url = start.headers.get('X-Goog-Upload-URL')
+    if start.status_code != 200 or not upload_url:
+        raise RuntimeError(f"No se pudo iniciar la subida a Gemini: {start.status_code}")
+    
+    stream.seek(0)
+    response = resilient_request(
+        'gemini_upload', 'POST', upload_url,
+        headers={
+            'Content-Length': str(size),
+            'X-Goog-Upload-Offset': '0',
+            'X-Goog-Upload-Command': 'upload, finalize',
+        },
+        data=stream
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"Error subiendo la imagen a Gemini: {response.status_code}")
+    return response.json()['file']['uri']
 
+def prepare_image_part(stream, size, cache_key=None):
+    """Parte de Gemini para una foto descargada en un stream.
 
-def set_user_context(user_id, context):
-    conn = sqlite3.connect('hydroponic_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET context = ? WHERE user_id = ?", (json.dumps(context), user_id))
-    conn.commit()
-    conn.close()
+    Las imágenes pequeñas van inline en base64; las grandes se suben con la API de archivos
+    y su URI se guarda en caché para reutilizarla mientras no expire.
+    """
+    if cache_key is not None:
+        with _image_part_cache_lock:
+            cached = _image_part_cache.get(cache_key)
+            if cached and cached[1] > time.time():
+                _image_part_cache.move_to_end(cache_key)
+                CACHE_COUNTERS['imagenes_gemini'].record(True)
+                return cached[0]
+        CACHE_COUNTERS['imagenes_gemini'].record(False)
+    
+    if size > INLINE_IMAGE_MAX_BYTES:
+        try:
+            file_uri = upload_gemini_file(stream, size)
+            part = {"file_data": {"mime_type": "image/jpeg", "file_uri": file_uri}}
+            if cache_key is not None:
+                with _image_part_cache_lock:
+                    _image_part_cache[cache_key] = (part, time.time() + GEMINI_FILE_TTL_SECONDS)
+                    while len(_image_part_cache) > IMAGE_PART_CACHE_SIZE:
+                        _image_part_cache.popitem(last=False)
+            return part
+        except Exception as e:
+            logger.warning(f"Subida de imagen a Gemini fallida, se envía inline: {e}")
+    
+    stream.seek(0)
+    return build_image_part(base64.b64encode(stream.read()).decode('ascii'))
 
-def save_device_id(user_id, device_id):
-    conn = sqlite3.connect('hydroponic_bot.db')
-    cursor = conn.cursor()
-    if device_id is None:
-        cursor.execute("UPDATE users SET device_id = NULL WHERE user_id = ?", (user_id,))
-    else:
-        cursor.execute("UPDATE users SET device_id = ? WHERE user_id = ?", (device_id, user_id))
-    conn.commit()
-    conn.close()
+async def download_photo(context, photo):
+    """Descarga una foto de Telegram a un archivo temporal en memoria (pasa a disco si es grande)"""
+    file = await context.bot.get_file(photo.file_id)
+    stream = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_MAX_BYTES)
+    await file.download_to_memory(out=stream)
+    size = stream.tell()
+    return stream, size
 
-def get_device_id(user_id):
-    conn = sqlite3.connect('hydroponic_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT device_id FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result and result[0] else None
+def get_followup_image_part(session):
+    """Parte de la última foto subida por el usuario si aún es reciente, para preguntas de seguimiento"""
+    last_image = session.last_image
+    if last_image and time.time() - last_image['at'] <= FOLLOWUP_IMAGE_SECONDS:
+        return last_image['part']
+    session.last_image = None
+    return None
 
 # Función para conectar con Google AI Studio
-def get_ai_response(prompt, context=None, image_data=None):
+def get_ai_response(prompt, context=None, image_data=None, user_id=None, flow='text', enforce_budget=True, request_class=None):
     if not API_KEY:
         logger.error("No se encontró la clave API de Google. Configura GOOGLE_API_KEY en las variables de entorno.")
         return "Error: API key no configurada."
+    
+    # Verificar el presupuesto diario antes de enviar la solicitud
+    if user_id is not None and enforce_budget and is_over_token_budget(user_id):
+        logger.warning(f"Usuario {user_id} superó su presupuesto diario de tokens")
+        return BUDGET_EXCEEDED_MESSAGE
+    
+    # Bajo sobrecarga extrema no se aceptan consultas interactivas nuevas
+    if flow in OVERLOAD_REJECT_FLOWS and OVERLOAD_CONTROLLER.should_reject():
+        return OVERLOAD_CONTROLLER.rejection_message()
+    
+    # En los modos degradados se pide una respuesta más corta con menos contexto
+    max_output_tokens, max_context_messages = OVERLOAD_CONTROLLER.generation_limits()
+    if context and max_context_messages is not None:
+        context = context[-max_context_messages:]
 
     # Crear el payload para la solicitud a Google AI Studio (Gemini API)
     parts = []
     
-    # Añadir imagen si se proporciona
+    # Añadir imagen o imágenes si se proporcionan (base64 o partes ya preparadas)
     if image_data:
-        parts.append({
-            "inline_data": {
-                "mime_type": "image/jpeg",
-                "data": image_data
-            }
-        })
+        images = image_data if isinstance(image_data, list) else [image_data]
+        parts.extend(build_image_part(image) for image in images)
     
     # Añadir texto (SIEMPRE debe haber texto)
     parts.append({"text": prompt})
@@ -469,7 +4102,7 @@ def get_ai_response(prompt, context=None, image_data=None):
             "temperature": 0.01,
             "topK": 40,
             "topP": 0.95,
-            "maxOutputTokens": 1024,
+            "maxOutputTokens": max_output_tokens,
         }
     }
     
@@ -477,12 +4110,16 @@ def get_ai_response(prompt, context=None, image_data=None):
         "Content-Type": "application/json"
     }
     
+    # Elegir el modelo según la clase de solicitud
+    if request_class is None:
+        request_class = classify_request(flow, prompt, bool(image_data))
+    
     try:
-        response = requests.post(ENDPOINT, json=payload, headers=headers)
+        response, model, latency_ms = route_gemini_request(request_class, payload, headers)
         
-        # Log para debugging
-        logger.info(f"Request payload: {json.dumps(payload, indent=2)}")
-        logger.info(f"Response status: {response.status_code}")
+        # Log para debugging (sin serializar el payload completo)
+        logger.info(f"Request: {len(contents)} mensajes, imagen={'sí' if image_data else 'no'}; "
+                    f"response status: {response.status_code} ({model})")
         
         if response.status_code != 200:
             logger.error(f"API Error: {response.status_code} - {response.text}")
@@ -491,6 +4128,10 @@ def get_ai_response(prompt, context=None, image_data=None):
         response.raise_for_status()
         
         result = response.json()
+        
+        # Registrar tokens y latencia de la llamada
+        record_ai_usage(user_id, flow, result.get("modelVersion", model), result.get("usageMetadata", {}), latency_ms)
+        
         # Extraer la respuesta del formato de Gemini
         if "candidates" in result and len(result["candidates"]) > 0:
             candidate = result["candidates"][0]
@@ -502,28 +4143,507 @@ def get_ai_response(prompt, context=None, image_data=None):
         else:
             logger.error(f"No se encontraron candidatos en la respuesta: {result}")
             return "No se pudo generar una respuesta válida."
+    except DependencyUnavailable:
+        return "Lo siento, el servicio de IA no está disponible en este momento. Inténtalo de nuevo en unos minutos."
     except Exception as e:
         logger.error(f"Error al conectar con Google AI Studio: {e}")
         return "Lo siento, ha ocurrido un error al procesar tu solicitud. Por favor, inténtalo de nuevo más tarde."
 
 # Función para detectar si una imagen contiene plantas usando IA
-def is_plant_image(image_data):
+def is_plant_image(image_data, user_id=None):
     prompt = "Analyze this image and respond with only 'YES' if it contains plants, flowers, vegetables, herbs, or any botanical elements. Respond with only 'NO' if it doesn't contain plants. Be very strict - only respond YES if there are clearly visible plants in the image."
+    if isinstance(image_data, list) and len(image_data) > 1:
+        # Álbum: una sola llamada para todas las fotos
+        prompt = "Analyze these images and respond with only 'YES' if any of them contains plants, flowers, vegetables, herbs, or any botanical elements. Respond with only 'NO' if none of them contains plants. Be very strict - only respond YES if there are clearly visible plants."
     
     try:
-        response = get_ai_response(prompt, image_data=image_data)
+        # El presupuesto se comprueba antes del filtro: aquí un rechazo se confundiría con un "NO"
+        response = get_ai_response(prompt, image_data=image_data, user_id=user_id, flow='image_gate', enforce_budget=False)
         return response.strip().upper() == 'YES'
     except Exception as e:
         logger.error(f"Error al analizar imagen: {e}")
         return False
 
+# Acceso asíncrono a SQLite: los handlers nunca esperan al disco dentro del event loop
+_db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='sqlite')
+_db_pending = 0   # Consultas encoladas o en curso (solo se modifica desde el event loop)
+
+async def run_db(func, *args, **kwargs):
+    """Ejecuta un helper de SQLite en el pool dedicado y espera su resultado sin bloquear el loop"""
+    global _db_pending
+    _db_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            _db_executor, functools.partial(func, *args, **kwargs)
+        )
+    finally:
+        _db_pending -= 1
+
+def make_async(func):
+    """Versión awaitable de un helper de SQLite"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+async def db_transaction(user_id, *operations):
+    """Agrupa escrituras del usuario en una sola transacción: db_transaction(uid, (write_interaction, (uid, m, r)), ...)"""
+    return await run_db(run_user_transaction, user_id, *operations)
+
+register_user_async = make_async(register_user)
+update_user_activity_async = make_async(update_user_activity)
+save_interaction_async = make_async(save_interaction)
+get_user_context_async = make_async(get_user_context)
+set_user_context_async = make_async(set_user_context)
+get_device_id_async = make_async(get_device_id)
+save_device_id_async = make_async(save_device_id)
+save_plant_selection_async = make_async(save_plant_selection)
+get_active_plant_async = make_async(get_active_plant)
+save_reminder_async = make_async(save_reminder)
+get_user_reminders_async = make_async(get_user_reminders)
+get_user_timezone_async = make_async(get_user_timezone)
+search_interactions_async = make_async(search_interactions)
+set_user_timezone_async = make_async(set_user_timezone)
+delete_reminder_async = make_async(delete_reminder)
+get_pending_reminders_async = make_async(get_pending_reminders)
+get_care_digest_async = make_async(get_care_digest)
+set_digest_hour_async = make_async(set_digest_hour)
+get_undelivered_digests_async = make_async(get_undelivered_digests)
+mark_digest_delivered_async = make_async(mark_digest_delivered)
+get_sensor_latest_async = make_async(get_sensor_latest)
+get_sensor_summary_async = make_async(get_sensor_summary)
+
+class HandlerStats:
+    """Contadores en memoria de un handler: tiempo total, tiempo esperando E/S y bloqueo del event loop"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.wall_ms = 0.0
+        self.io_ms = 0.0
+        self.max_block_ms = 0.0
+        self.recent_wall_ms = deque(maxlen=HANDLER_STATS_WINDOW)
+    
+    def record(self, wall_ms, loop_ms, max_step_ms, failed):
+        self.calls += 1
+        self.errors += int(failed)
+        self.wall_ms += wall_ms
+        self.io_ms += max(0.0, wall_ms - loop_ms)
+        self.max_block_ms = max(self.max_block_ms, max_step_ms)
+        self.recent_wall_ms.append(wall_ms)
+    
+    def p95_ms(self):
+        samples = sorted(self.recent_wall_ms)
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0.0
+
+HANDLER_STATS = {}
+
+class TimedCoroutine:
+    """Ejecuta una corrutina paso a paso midiendo cuánto corre en el event loop.
+    
+    Cada paso (send/throw) es tiempo en que el handler ocupa el loop; el resto del tiempo
+    total lo pasa esperando E/S (Telegram, SQLite, Gemini). El paso más largo es el mayor
+    retraso que el handler causó al resto de actualizaciones.
+    """
+    
+    def __init__(self, coro, stats):
+        self.coro = coro
+        self.stats = stats
+    
+    def __await__(self):
+        started = time.perf_counter()
+        loop_time = 0.0
+        max_step = 0.0
+        failed = True
+        value, error = None, None
+        try:
+            while True:
+                step_started = time.perf_counter()
+                try:
+                    if error is not None:
+                        yielded = self.coro.throw(error)
+                    else:
+                        yielded = self.coro.send(value)
+                except StopIteration as stop:
+                    failed = False
+                    return stop.value
+                finally:
+                    step = time.perf_counter() - step_started
+                    loop_time += step
+                    max_step = max(max_step, step)
+                
+                try:
+                    value, error = (yield yielded), None
+                except BaseException as e:
+                    value, error = None, e
+        finally:
+            self.stats.record((time.perf_counter() - started) * 1000, loop_time * 1000, max_step * 1000, failed)
+
+def get_handler_stats(name):
+    stats = HANDLER_STATS.get(name)
+    if stats is None:
+        stats = HANDLER_STATS[name] = HandlerStats(name)
+    return stats
+
+def instrument_handler(func):
+    """Decorador para handlers async: registra sus tiempos en HANDLER_STATS"""
+    stats = get_handler_stats(func.__name__)
+    
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await TimedCoroutine(func(*args, **kwargs), stats)
+    return wrapper
+
+class SamplingProfiler:
+    """Profiler de muestreo bajo demanda: cuenta pilas de todos los hilos en formato 'folded'
+    (compatible con flamegraph.pl y speedscope). Sin sesión activa no hay ningún hilo ni coste."""
+    
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = None
+        self.counts = None
+        self.samples = 0
+        self.started_at = None
+    
+    def is_running(self):
+        return self.thread is not None
+    
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.counts = {}
+            self.samples = 0
+            self.started_at = datetime.now()
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+            self.thread.start()
+            return True
+    
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+    
+    def stop(self):
+        """Detiene el muestreo y devuelve (muestras, texto en formato folded)"""
+        with self.lock:
+            if self.thread is None:
+                return 0, ""
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            folded = '\n'.join(f"{stack} {count}" for stack, count in sorted(self.counts.items()))
+            return self.samples, folded
+
+SAMPLING_PROFILER = SamplingProfiler()
+
+class LoopLagMonitor:
+    """Mide el retraso del event loop: cuánto se atrasa un sleep de periodo fijo"""
+    
+    def __init__(self, interval=LOOP_LAG_INTERVAL_SECONDS, window=LOOP_LAG_WINDOW):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.task = None
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (loop.time() - started - self.interval) * 1000)
+            self.samples.append(lag_ms)
+            if lag_ms >= LOOP_LAG_WARN_MS:
+                logger.warning(f"Event loop bloqueado durante {lag_ms:.0f} ms")
+    
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+    
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+    
+    def stats(self):
+        """Percentiles del retraso en ms sobre la ventana reciente"""
+        samples = sorted(self.samples)
+        if not samples:
+            return {"samples": 0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        return {
+            "samples": len(samples),
+            "p50": samples[len(samples) // 2],
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            "max": samples[-1],
+        }
+
+LOOP_LAG_MONITOR = LoopLagMonitor()
+
+# Sesiones de usuario acotadas en memoria (en lugar de context.user_data)
+class UserSession:
+    """Estado de un usuario entre mensajes, con campos fijos"""
+    
+    __slots__ = ('user_id', 'ai_mode', 'cancel_mode', 'reminder_message', 'last_image', 'history_query', 'last_seen', 'stored')
+    CONVERSATION_FIELDS = ('cancel_mode', 'reminder_message')   # Solo valen mientras dura la conversación
+    
+    def __init__(self, user_id, state=None, stored=None):
+        state = state or {}
+        self.user_id = user_id
+        self.ai_mode = state.get('ai_mode', False)
+        self.cancel_mode = state.get('cancel_mode', False)
+        self.reminder_message = state.get('reminder_message')
+        self.last_image = state.get('last_image')
+        self.history_query = None     # Última búsqueda de /historial (no se guarda al descargar la sesión)
+        self.last_seen = time.time()
+        self.stored = stored          # Último estado guardado en SQLite, para no reescribirlo sin cambios
+    
+    def end_conversation(self):
+        self.cancel_mode = False
+        self.reminder_message = None
+    
+    def to_json(self):
+        """Estado serializado o None si no queda nada que guardar"""
+        if self.last_image and time.time() - self.last_image['at'] > FOLLOWUP_IMAGE_SECONDS:
+            self.last_image = None
+        state = {name: getattr(self, name) for name in ('ai_mode', 'cancel_mode', 'reminder_message', 'last_image')
+                 if getattr(self, name)}
+        return json.dumps(state) if state else None
+
+class SessionStore:
+    """Sesiones en memoria con tope duro (LRU) y descarga por inactividad a user_sessions.
+
+    Solo se usa desde el event loop; la lectura y escritura en SQLite va por run_db.
+    """
+    
+    def __init__(self, max_users=SESSION_MAX_USERS, idle_seconds=SESSION_IDLE_SECONDS):
+        self.max_users = max_users
+        self.idle_seconds = idle_seconds
+        self.sessions = OrderedDict()   # user_id -> UserSession, de la menos a la más reciente
+        self.offloading = {}            # user_id -> UserSession descargada cuyo guardado está en curso
+        self.evictions = 0
+    
+    async def get(self, user_id):
+        """Sesión del usuario, cargándola de SQLite si fue descargada"""
+        session = self.sessions.get(user_id) or self.offloading.get(user_id)
+        if session is None:
+            row = await run_db(load_user_session, user_id)
+            session = self.sessions.get(user_id)   # Otro mensaje pudo cargarla mientras tanto
+            if session is None:
+                session = self.restore(user_id, row)
+        session.last_seen = time.time()
+        self.sessions[user_id] = session
+        self.sessions.move_to_end(user_id)
+        
+        if len(self.sessions) > self.max_users:
+            overflow = []
+            while len(self.sessions) > self.max_users:
+                overflow.append(self.sessions.popitem(last=False)[1])
+            await self.offload(overflow)
+        return session
+    
+    def restore(self, user_id, row):
+        if not row:
+            return UserSession(user_id)
+        state, updated_at = row
+        session = UserSession(user_id, json.loads(state), stored=state)
+        # La conversación ya expiró por inactividad
+        if time.time() - updated_at > self.idle_seconds:
+            session.end_conversation()
+        return session
+    
+    async def offload(self, sessions):
+        """Guarda en SQLite las sesiones sacadas de memoria que cambiaron"""
+        changed = []
+        for session in sessions:
+            state = session.to_json()
+            if state != session.stored:
+                changed.append((session.user_id, state))
+                self.offloading[session.user_id] = session
+        self.evictions += len(sessions)
+        if not changed:
+            return
+        try:
+            await run_db(save_user_sessions, changed)
+        finally:
+            for user_id, _ in changed:
+                self.offloading.pop(user_id, None)
+    
+    async def evict_idle(self):
+        """Descarga las sesiones inactivas; su conversación ya terminó por conversation_timeout"""
+        cutoff = time.time() - self.idle_seconds
+        idle = []
+        for user_id, session in self.sessions.items():
+            if session.last_seen > cutoff:
+                break
+            idle.append(session)
+        for session in idle:
+            del self.sessions[session.user_id]
+            session.end_conversation()
+        await self.offload(idle)
+        return len(idle)
+    
+    def drain(self):
+        """Saca todas las sesiones para guardarlas al apagar el bot; devuelve [(user_id, estado)]"""
+        states = [(session, session.to_json()) for session in self.sessions.values()]
+        self.sessions.clear()
+        return [(session.user_id, state) for session, state in states if state != session.stored]
+
+SESSION_STORE = SessionStore()
+
+async def get_session(update: Update):
+    return await SESSION_STORE.get(update.effective_user.id)
+
+# Coalescencia de solicitudes idénticas en curso
+class SingleFlight:
+    """Comparte el resultado de solicitudes idénticas (misma huella) en lugar de repetirlas.
+
+    Solo se usa desde el event loop. Con remember (True o una función que decide según el
+    resultado) la huella y su resultado se recuerdan SINGLE_FLIGHT_RECENT_SECONDS después de
+    terminar, de modo que un duplicado tardío también lo reutiliza. Los updates se procesan de
+    uno en uno, así que los duplicados casi siempre llegan cuando el primero ya terminó.
+    """
+    
+    def __init__(self, recent_seconds=SINGLE_FLIGHT_RECENT_SECONDS):
+        self.recent_seconds = recent_seconds
+        self.in_flight = {}           # huella -> tarea en curso
+        self.recent = OrderedDict()   # huella -> (fin monotonic, resultado), de la más antigua a la más reciente
+    
+    def is_recent(self, key):
+        cutoff = time.monotonic() - self.recent_seconds
+        while self.recent and next(iter(self.recent.values()))[0] < cutoff:
+            self.recent.popitem(last=False)
+        return key in self.recent
+    
+    async def run(self, key, factory, remember=False):
+        """Ejecuta factory() salvo que haya una solicitud igual en curso o reciente; devuelve (resultado, compartido)"""
+        task = self.in_flight.get(key)
+        recent = task is None and self.is_recent(key)
+        CACHE_COUNTERS['solicitudes_compartidas'].record(task is not None or recent)
+        if recent:
+            return self.recent[key][1], True
+        if task is not None:
+            return await asyncio.shield(task), True
+        
+        task = asyncio.ensure_future(factory())
+        self.in_flight[key] = task
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            self.in_flight.pop(key, None)
+        # Solo se recuerdan los resultados correctos: un error se puede reintentar de inmediato
+        if remember is True or (remember and remember(result)):
+            self.recent[key] = (time.monotonic(), result)
+            self.recent.move_to_end(key)
+        return result, False
+
+SINGLE_FLIGHT = SingleFlight()
+
+def request_fingerprint(*parts):
+    """Huella corta de un texto o de identificadores de imagen"""
+    return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+# Envío de campañas de difusión dentro del event loop, respetando el límite de Telegram
+_broadcast_tasks = {}   # campaign_id -> tarea asyncio en curso
+
+async def send_broadcast_message(bot, user_id, text):
+    """Envía un mensaje de difusión; devuelve (estado, error) con estado 'sent', 'blocked' o 'failed'"""
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            return 'sent', None
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"Telegram pidió esperar {retry_after} s durante la difusión")
+            await asyncio.sleep(retry_after)
+        except Forbidden as e:
+            return 'blocked', str(e)
+        except TelegramError as e:
+            return 'failed', str(e)
+    return 'failed', 'RetryAfter'
+
+async def run_broadcast(bot, campaign_id):
+    """Envía la campaña página a página desde su último punto de control"""
+    interval = 1 / BROADCAST_RATE_PER_SECOND
+    while True:
+        campaign = await run_db(get_broadcast, campaign_id)
+        if not campaign or campaign['status'] != 'running':
+            return
+        shard, last_user_id, user_ids = await run_db(fetch_broadcast_page, campaign)
+        if shard is None:
+            break
+        
+        results = []
+        try:
+            for user_id in user_ids:
+                status, error = await send_broadcast_message(bot, user_id, f"📢 {campaign['message']}")
+                results.append((user_id, status, error))
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            # Guardar lo enviado de la página para no repetirlo al reanudar; shield evita que
+            # una segunda cancelación interrumpa la escritura, que sigue fuera del event loop
+            if results:
+                await asyncio.shield(run_db(record_broadcast_page, campaign_id, shard, results[-1][0], results))
+            raise
+        await run_db(record_broadcast_page, campaign_id, shard, last_user_id, results)
+    
+    if await run_db(set_broadcast_status, campaign_id, 'done'):
+        campaign = await run_db(get_broadcast, campaign_id)
+        logger.info(f"Difusión {campaign_id} terminada: {campaign['sent']} enviados, "
+                    f"{campaign['failed']} fallidos, {campaign['blocked']} bloqueados")
+        if campaign['created_by']:
+            try:
+                await bot.send_message(chat_id=campaign['created_by'], text=f"✅ {format_broadcast(campaign)}")
+            except TelegramError as e:
+                logger.error(f"No se pudo avisar del fin de la difusión {campaign_id}: {e}")
+
+def start_broadcast_task(bot, campaign_id):
+    async def runner():
+        try:
+            await run_broadcast(bot, campaign_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error en la difusión {campaign_id}; se reanudará en el próximo arranque: {e}")
+        finally:
+            _broadcast_tasks.pop(campaign_id, None)
+    
+    if campaign_id not in _broadcast_tasks:
+        _broadcast_tasks[campaign_id] = asyncio.get_running_loop().create_task(runner())
+
+def format_broadcast(campaign):
+    filters_text = []
+    if campaign['plant_type']:
+        filters_text.append(f"cultivo={campaign['plant_type']}")
+    if campaign['active_days']:
+        filters_text.append(f"activos={campaign['active_days']}")
+    return (
+        f"Difusión #{campaign['id']} ({campaign['status']}"
+        f"{', ' + ' '.join(filters_text) if filters_text else ''}): "
+        f"{campaign['sent']} enviados, {campaign['failed']} fallidos, {campaign['blocked']} bloqueados"
+    )
+
 # Comandos del bot
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    register_user(user.id, user.username, user.first_name)
+    await register_user_async(user.id, user.username, user.first_name)
     
     # Verificar si el usuario ya tiene un ID de dispositivo registrado
-    device_id = get_device_id(user.id)
+    device_id = await get_device_id_async(user.id)
     
     if not device_id:
         # Si no tiene ID de dispositivo, solicitarlo
@@ -534,17 +4654,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return DEVICE_ID
     else:
         # Si ya tiene ID de dispositivo, mostrar menú principal
-        keyboard = [
-            [InlineKeyboardButton("🌱 Cultivos", callback_data='menu_plants')],
-            [InlineKeyboardButton("🤖 Consultar IA", callback_data='menu_ai')],
-            [InlineKeyboardButton("💧 Recordatorios", callback_data='menu_reminders')],
-            [InlineKeyboardButton("ℹ️ Ayuda", callback_data='menu_help')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.message.reply_text(
             f"¡Hola {user.first_name}! 👋 Soy tu asistente para hidroponía NFT. ¿En qué puedo ayudarte hoy?",
-            reply_markup=reply_markup
+            reply_markup=MAIN_MENU_MARKUP
         )
         return ConversationHandler.END
 
@@ -559,12 +4671,13 @@ async def save_device_id_handler(update: Update, context: ContextTypes.DEFAULT_T
     device_id = update.message.text.strip()
 
     # Guardar el ID de dispositivo en la base de datos
-    save_device_id(user_id, device_id)
+    await save_device_id_async(user_id, device_id)
 
     # Verificar si estamos en modo cancelación
-    if context.user_data.get('cancel_mode', False):
+    session = await get_session(update)
+    if session.cancel_mode:
         # Limpiar el flag de cancelación
-        context.user_data.pop('cancel_mode', None)
+        session.cancel_mode = False
         
         # Mostrar mensaje de confirmación específico para cancelación
         await update.message.reply_text(
@@ -579,17 +4692,9 @@ async def save_device_id_handler(update: Update, context: ContextTypes.DEFAULT_T
         )
 
     # Mostrar menú principal en ambos casos
-    keyboard = [
-        [InlineKeyboardButton("🌱 Cultivos", callback_data='menu_plants')],
-        [InlineKeyboardButton("🤖 Consultar IA", callback_data='menu_ai')],
-        [InlineKeyboardButton("💧 Recordatorios", callback_data='menu_reminders')],
-        [InlineKeyboardButton("ℹ️ Ayuda", callback_data='menu_help')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await update.message.reply_text(
         "¿En qué puedo ayudarte ahora?",
-        reply_markup=reply_markup
+        reply_markup=MAIN_MENU_MARKUP
     )
 
     return ConversationHandler.END
@@ -597,14 +4702,6 @@ async def save_device_id_handler(update: Update, context: ContextTypes.DEFAULT_T
 # Nueva función para manejar el menú de ayuda
 async def show_help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra el menú de ayuda con botones interactivos"""
-    keyboard = [
-        [InlineKeyboardButton("🔄 Reiniciar bot", callback_data='help_start')],
-        [InlineKeyboardButton("🗑️ Limpiar conversación", callback_data='help_clear')],
-        [InlineKeyboardButton("📱 Cambiar dispositivo", callback_data='help_device')],
-        [InlineKeyboardButton("↩️ Volver al menú", callback_data='menu_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     help_text = (
         "ℹ️ **AYUDA - Asistente Hidropónico NFT**\n\n"
         "**¿Qué puedo hacer por ti?**\n\n"
@@ -616,65 +4713,48 @@ async def show_help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "**Acciones rápidas:**"
     )
     
-    return help_text, reply_markup
+    return help_text, HELP_MENU_MARKUP
 
-# Nueva función para manejar las acciones de ayuda
-async def handle_help_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Maneja las acciones del menú de ayuda"""
+# Acciones del menú de ayuda
+@CALLBACK_ROUTER.route('help_start')
+async def help_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reinicia el bot - equivalente a /start"""
     query = update.callback_query
-    await query.answer()
-    
-    if query.data == 'help_start':
-        # Reiniciar el bot - equivalente a /start
-        user = query.from_user
-        register_user(user.id, user.username, user.first_name)
-        
-        keyboard = [
-            [InlineKeyboardButton("🌱 Cultivos", callback_data='menu_plants')],
-            [InlineKeyboardButton("🤖 Consultar IA", callback_data='menu_ai')],
-            [InlineKeyboardButton("💧 Recordatorios", callback_data='menu_reminders')],
-            [InlineKeyboardButton("ℹ️ Ayuda", callback_data='menu_help')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"🔄 **Bot reiniciado**\n\n¡Hola {user.first_name}! 👋 "
-            "Soy tu asistente para hidroponía NFT. ¿En qué puedo ayudarte?",
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-        return ConversationHandler.END
+    user = query.from_user
+    await register_user_async(user.id, user.username, user.first_name)
     
-    elif query.data == 'help_clear':
-        # Limpiar contexto - equivalente a /clear
-        user_id = query.from_user.id
-        set_user_context(user_id, [])
-        
-        keyboard = [
-            [InlineKeyboardButton("🌱 Cultivos", callback_data='menu_plants')],
-            [InlineKeyboardButton("🤖 Consultar IA", callback_data='menu_ai')],
-            [InlineKeyboardButton("💧 Recordatorios", callback_data='menu_reminders')],
-            [InlineKeyboardButton("ℹ️ Ayuda", callback_data='menu_help')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "🗑️ **Contexto limpiado**\n\n"
-            "Se ha borrado el historial de conversación con la IA. "
-            "¿En qué más puedo ayudarte?",
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-        return ConversationHandler.END
+    await query.edit_message_text(
+        f"🔄 **Bot reiniciado**\n\n¡Hola {user.first_name}! 👋 "
+        "Soy tu asistente para hidroponía NFT. ¿En qué puedo ayudarte?",
+        parse_mode='Markdown',
+        reply_markup=MAIN_MENU_MARKUP
+    )
+    return ConversationHandler.END
+
+@CALLBACK_ROUTER.route('help_clear')
+async def help_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Limpia el contexto - equivalente a /clear"""
+    query = update.callback_query
+    await set_user_context_async(query.from_user.id, [])
     
-    elif query.data == 'help_device':
-        # Cambiar dispositivo - equivalente a /device
-        await query.edit_message_text(
-            "📱 **Cambio de dispositivo**\n\n"
-            "Por favor, ingresa el nuevo ID de tu dispositivo hidropónico:",
-            parse_mode='Markdown'
-        )
-        return DEVICE_ID
+    await query.edit_message_text(
+        "🗑️ **Contexto limpiado**\n\n"
+        "Se ha borrado el historial de conversación con la IA. "
+        "¿En qué más puedo ayudarte?",
+        parse_mode='Markdown',
+        reply_markup=MAIN_MENU_MARKUP
+    )
+    return ConversationHandler.END
+
+@CALLBACK_ROUTER.route('help_device')
+async def help_change_device(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cambia el dispositivo - equivalente a /device"""
+    await update.callback_query.edit_message_text(
+        "📱 **Cambio de dispositivo**\n\n"
+        "Por favor, ingresa el nuevo ID de tu dispositivo hidropónico:",
+        parse_mode='Markdown'
+    )
+    return DEVICE_ID
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /help que muestra el menú de ayuda"""
@@ -691,18 +4771,12 @@ async def device_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clear_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    set_user_context(user_id, [])
+    await set_user_context_async(user_id, [])
     await update.message.reply_text("Contexto de conversación borrado. ¿En qué más puedo ayudarte?")
 
+@CALLBACK_ROUTER.route('menu_ai')
 async def start_ai_consultation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    
-    # Crear teclado con opción de regresar al menú
-    keyboard = [
-        [InlineKeyboardButton("🏠 Regresar al menú principal", callback_data='menu_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.edit_message_text(
         text="🤖 Modo consulta IA activado\n\n"
@@ -710,104 +4784,217 @@ async def start_ai_consultation(update: Update, context: ContextTypes.DEFAULT_TY
              "• Preguntas sobre plantas y hidroponía\n"
              "• Fotos de plantas para análisis\n\n"
              "💡 Solo acepto fotos que contengan plantas.",
-        reply_markup=reply_markup
+        reply_markup=BACK_TO_MAIN_MARKUP
     )
     
     # Activar el modo consulta IA
-    context.user_data['ai_mode'] = True
+    (await get_session(update)).ai_mode = True
     return AI_CONSULTATION
 
-async def handle_ai_consultation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Análisis de fotos: una foto suelta o todas las de un álbum en una sola solicitud a Gemini
+_pending_albums = {}   # media_group_id -> {'update': primera actualización, 'photos': [...]}
+_album_tasks = set()   # Referencias a las tareas de análisis de álbumes en curso
+
+def collect_album_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Añade la foto a su álbum; la primera programa el análisis conjunto tras ALBUM_COLLECT_SECONDS"""
+    group_id = update.message.media_group_id
+    album = _pending_albums.get(group_id)
+    if album is None:
+        album = _pending_albums[group_id] = {'update': update, 'photos': []}
+        task = asyncio.get_running_loop().create_task(flush_album(group_id, context))
+        _album_tasks.add(task)
+        task.add_done_callback(_album_tasks.discard)
+    if len(album['photos']) < ALBUM_MAX_PHOTOS:
+        album['photos'].append(update.message.photo[-1])
+
+async def flush_album(group_id, context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.sleep(ALBUM_COLLECT_SECONDS)
+    album = _pending_albums.pop(group_id)
+    await TimedCoroutine(analyze_photos(album['update'], context, album['photos']), get_handler_stats('analyze_album'))
+
+async def prepare_photo(context, photo):
+    """Descarga una foto y prepara su parte para Gemini (inline o subida) fuera del event loop"""
+    stream, size = await download_photo(context, photo)
+    with stream:
+        return await asyncio.to_thread(prepare_image_part, stream, size, photo.file_unique_id)
+
+async def analyze_photos(update: Update, context: ContextTypes.DEFAULT_TYPE, photos):
+    """Analiza las fotos una sola vez aunque el usuario las reenvíe mientras el análisis sigue en curso"""
+    key = ('photo', update.effective_user.id, request_fingerprint(*(photo.file_unique_id for photo in photos)))
+    response, shared = await SINGLE_FLIGHT.run(
+        key, lambda: analyze_photos_once(update, context, photos), remember=lambda response: response is not None
+    )
+    if shared and response is not None:
+        logger.info(f"Fotos repetidas de {update.effective_user.id} atendidas con el análisis anterior")
+        message_parts = split_message(response)
+        for i, part in enumerate(message_parts):
+            await update.message.reply_text(part, reply_markup=BACK_TO_MAIN_MARKUP if i == len(message_parts) - 1 else None)
+
+async def analyze_photos_once(update: Update, context: ContextTypes.DEFAULT_TYPE, photos):
+    """Analiza las fotos y responde; devuelve el análisis si se obtuvo o None si hubo un error"""
     user_id = update.effective_user.id
     
-    # Crear teclado para regresar al menú
-    keyboard = [
-        [InlineKeyboardButton("🏠 Regresar al menú principal", callback_data='menu_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Teclado para regresar al menú
+    reply_markup = BACK_TO_MAIN_MARKUP
     
-    # Verificar si es una foto
-    if update.message.photo:
-        try:
-            # Obtener la foto de mayor resolución
-            photo = update.message.photo[-1]
-            file = await context.bot.get_file(photo.file_id)
-            
-            # Descargar la imagen
-            photo_bytes = await file.download_as_bytearray()
-            
-            # Convertir a base64
-            import base64
-            image_data = base64.b64encode(photo_bytes).decode('utf-8')
-            
-            # Verificar si la imagen contiene plantas
-            if not is_plant_image(image_data):
-                await update.message.reply_text(
-                    "❌ Lo siento, solo acepto fotos de plantas.\n"
-                    "Por favor, envía una imagen que contenga plantas para que pueda ayudarte con información sobre ellas.",
-                    reply_markup=reply_markup
-                )
-                return AI_CONSULTATION
-            
-            # Procesar la imagen con IA - Prompt más conciso
-            prompt = "Analiza brevemente esta imagen de plantas (máximo 500 palabras). Incluye: estado de la planta, problemas visibles, y cuidados para hidroponía NFT."
-            
-            # Obtener contexto del usuario
-            user_context = get_user_context(user_id)
-            
-            # Obtener respuesta de la IA
-            response = get_ai_response(prompt, user_context, image_data)
-            
-            # Verificar si la respuesta no es un error
-            if not response.startswith("Error") and not response.startswith("Lo siento"):
-                # Actualizar contexto (FORMATO CORREGIDO)
-                user_context.append({
-                    "role": "user", 
-                    "parts": [{"text": "Imagen de planta enviada"}]
-                })
-                user_context.append({
-                    "role": "model", 
-                    "parts": [{"text": response[:500]}]  # Truncar para contexto
-                })
-                
-                # Mantener contexto limitado
-                if len(user_context) > 6:  # Reducido aún más
-                    user_context = user_context[-6:]
-                
-                set_user_context(user_id, user_context)
-                
-                # Guardar interacción
-                save_interaction(user_id, "Imagen de planta", response[:1000])  # Truncar para BD
-            
-            # Dividir respuesta si es necesario
-            message_parts = split_message(response)
-            
-            # Enviar cada parte
-            for i, part in enumerate(message_parts):
-                if i == len(message_parts) - 1:  # Último mensaje
-                    await update.message.reply_text(part, reply_markup=reply_markup)
-                else:
-                    await update.message.reply_text(part)
-            
-        except Exception as e:
-            logger.error(f"Error procesando imagen: {e}")
+    try:
+        # Fallar rápido si Gemini está caído, antes de descargar la foto
+        if not MODEL_ROUTER.is_available('image'):
+            await update.message.reply_text(
+                "⚠️ El servicio de IA no está disponible en este momento. Inténtalo de nuevo en unos minutos.",
+                reply_markup=reply_markup
+            )
+            return
+        
+        # Rechazar antes de descargar si el bot está saturado
+        if OVERLOAD_CONTROLLER.should_reject():
+            await update.message.reply_text(f"⏳ {OVERLOAD_CONTROLLER.rejection_message()}", reply_markup=reply_markup)
+            return
+        
+        # Comprobar el presupuesto diario una sola vez, antes de descargar y del filtro de plantas
+        if await run_db(is_over_token_budget, user_id):
+            await update.message.reply_text(BUDGET_EXCEEDED_MESSAGE, reply_markup=reply_markup)
+            return
+        
+        # Descargar y preparar las fotos (inline o subidas a Gemini) en paralelo
+        image_parts = await asyncio.gather(*(prepare_photo(context, photo) for photo in photos))
+        image_data = image_parts[0] if len(image_parts) == 1 else list(image_parts)
+        
+        # Verificar si la imagen contiene plantas (se omite en modo degradado para ahorrar una llamada)
+        if not OVERLOAD_CONTROLLER.skip_image_gate() and not await asyncio.to_thread(is_plant_image, image_data, user_id):
             await update.message.reply_text(
-                "❌ Error al procesar la imagen. Por favor, inténtalo de nuevo.",
+                "❌ Lo siento, solo acepto fotos de plantas.\n"
+                "Por favor, envía una imagen que contenga plantas para que pueda ayudarte con información sobre ellas.",
                 reply_markup=reply_markup
             )
+            return
+        
+        # Las fotos subidas se reutilizan en las preguntas de seguimiento
+        if len(image_parts) == 1 and "file_data" in image_data:
+            (await get_session(update)).last_image = {'part': image_data, 'at': time.time()}
+        
+        # Procesar la imagen con IA - Prompt más conciso
+        prompt = "Analiza brevemente esta imagen de plantas (máximo 500 palabras). Incluye: estado de la planta, problemas visibles, y cuidados para hidroponía NFT."
+        if len(image_parts) > 1:
+            prompt = (f"Analiza brevemente estas {len(image_parts)} imágenes del mismo sistema NFT en una sola respuesta "
+                      "(máximo 500 palabras). Incluye: estado de las plantas, problemas visibles, y cuidados para hidroponía NFT.")
+        
+        # Añadir los parámetros de referencia del cultivo activo
+        snippet = get_knowledge_snippet(await get_active_plant_async(user_id))
+        if snippet:
+            prompt += f"\n\nParámetros de referencia del cultivo del usuario: {snippet}"
+        
+        # Obtener contexto del usuario
+        user_context = await get_user_context_async(user_id)
+        
+        # Obtener respuesta de la IA
+        response = await asyncio.to_thread(
+            get_ai_response, prompt, user_context, image_data, user_id=user_id, flow='photo'
+        )
+        
+        # Verificar si la respuesta no es un error
+        if not response.startswith("Error") and not response.startswith("Lo siento"):
+            # Actualizar contexto (FORMATO CORREGIDO)
+            user_context.append({
+                "role": "user", 
+                "parts": [{"text": "Imagen de planta enviada" if len(image_parts) == 1 else f"Álbum de {len(image_parts)} fotos enviado"}]
+            })
+            user_context.append({
+                "role": "model", 
+                "parts": [{"text": response[:500]}]  # Truncar para contexto
+            })
+            
+            # Mantener contexto limitado
+            if len(user_context) > 6:  # Reducido aún más
+                user_context = user_context[-6:]
+            
+            # Guardar contexto, interacción y actividad en una sola transacción
+            await db_transaction(
+                user_id,
+                (write_user_context, (user_id, user_context)),
+                (write_interaction, (user_id, "Imagen de planta" if len(image_parts) == 1 else f"Álbum de {len(image_parts)} fotos", response[:1000])),  # Truncar para BD
+                (write_user_activity, (user_id,))
+            )
+        
+        # Dividir respuesta si es necesario
+        message_parts = split_message(response)
+        
+        # Enviar cada parte
+        for i, part in enumerate(message_parts):
+            if i == len(message_parts) - 1:  # Último mensaje
+                await update.message.reply_text(part, reply_markup=reply_markup)
+            else:
+                await update.message.reply_text(part)
+        
+        if not response.startswith("Error") and not response.startswith("Lo siento"):
+            return response
+    except Exception as e:
+        logger.error(f"Error procesando imagen: {e}")
+        await update.message.reply_text(
+            "❌ Error al procesar la imagen. Por favor, inténtalo de nuevo.",
+            reply_markup=reply_markup
+        )
+
+async def handle_ai_consultation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Teclado para regresar al menú
+    reply_markup = BACK_TO_MAIN_MARKUP
+    
+    # Verificar si es una foto; las fotos de un álbum se reúnen y se analizan juntas
+    if update.message.photo:
+        if update.message.media_group_id:
+            collect_album_photo(update, context)
+        else:
+            await analyze_photos(update, context, [update.message.photo[-1]])
     
     # Si es texto
     elif update.message.text:
         message = update.message.text
         
         # Obtener contexto del usuario
-        user_context = get_user_context(user_id)
+        user_context = await get_user_context_async(user_id)
+        active_plant = await get_active_plant_async(user_id)
         
-        # Añadir contexto especializado en plantas - Prompt más conciso
-        specialized_prompt = f"Como experto en hidroponía, responde brevemente (máximo 400 palabras): {message}"
+        # Las preguntas simples sobre parámetros se responden desde la base de conocimiento local
+        response = answer_from_knowledge_base(message, active_plant)
+        CACHE_COUNTERS['base_conocimiento'].record(response is not None)
         
-        # Obtener respuesta de la IA
-        response = get_ai_response(specialized_prompt, user_context)
+        # Bajo sobrecarga se prefiere una respuesta anterior a la misma pregunta
+        followup_image = get_followup_image_part(await get_session(update))
+        if response is None and followup_image is None and OVERLOAD_CONTROLLER.prefer_cached():
+            response = get_cached_ai_response(message, active_plant)
+        
+        if response is None:
+            # Añadir contexto especializado en plantas - Prompt más conciso
+            specialized_prompt = f"Como experto en hidroponía, responde brevemente (máximo 400 palabras): {message}"
+            
+            # Añadir solo el fragmento de conocimiento del cultivo relevante
+            snippet = get_relevant_snippet(message, active_plant)
+            if snippet:
+                specialized_prompt = f"Datos de referencia: {snippet}\n\n{specialized_prompt}"
+            
+            # Obtener respuesta de la IA, reutilizando la última foto subida si la conversación sigue sobre ella;
+            # la misma pregunta repetida en curso o hace menos de SINGLE_FLIGHT_RECENT_SECONDS comparte su respuesta
+            image_key = followup_image.get('file_data', {}).get('file_uri') if followup_image else None
+            response, shared = await SINGLE_FLIGHT.run(
+                ('ai', user_id, request_fingerprint(message, image_key)),
+                lambda: asyncio.to_thread(
+                    get_ai_response, specialized_prompt, user_context, followup_image,
+                    user_id=user_id, flow='text',
+                    # Clasificar por la pregunta: el prefijo y los datos de referencia no la hacen más larga
+                    request_class=classify_request('text', message, bool(followup_image))
+                ),
+                remember=lambda response: not response.startswith("Error") and not response.startswith("Lo siento")
+            )
+            if shared:
+                # La primera solicitud ya guarda el contexto y la interacción
+                message_parts = split_message(response)
+                for i, part in enumerate(message_parts):
+                    await update.message.reply_text(part, reply_markup=reply_markup if i == len(message_parts) - 1 else None)
+                return AI_CONSULTATION
+            if followup_image is None and not response.startswith("Error") and not response.startswith("Lo siento"):
+                cache_ai_response(message, active_plant, response)
         
         # Verificar si la respuesta no es un error
         if not response.startswith("Error") and not response.startswith("Lo siento"):
@@ -825,10 +5012,13 @@ async def handle_ai_consultation(update: Update, context: ContextTypes.DEFAULT_T
             if len(user_context) > 6:  # Reducido aún más
                 user_context = user_context[-6:]
             
-            set_user_context(user_id, user_context)
-            
-            # Guardar interacción
-            save_interaction(user_id, message, response[:1000])  # Truncar para BD
+            # Guardar contexto, interacción y actividad en una sola transacción
+            await db_transaction(
+                user_id,
+                (write_user_context, (user_id, user_context)),
+                (write_interaction, (user_id, message, response[:1000])),  # Truncar para BD
+                (write_user_activity, (user_id,))
+            )
         
         # Dividir respuesta si es necesario
         message_parts = split_message(response)
@@ -842,179 +5032,123 @@ async def handle_ai_consultation(update: Update, context: ContextTypes.DEFAULT_T
     
     return AI_CONSULTATION
 
-async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Handlers del menú principal
+@CALLBACK_ROUTER.route('menu_main')
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Desactivar modo IA si estaba activo
+    (await get_session(update)).ai_mode = False
+    
+    await update.callback_query.edit_message_text(
+        text="Menú principal - ¿Qué deseas hacer?",
+        reply_markup=MAIN_MENU_MARKUP
+    )
+    return ConversationHandler.END
+
+@CALLBACK_ROUTER.route('menu_plants')
+async def show_plants_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    
-    if query.data == 'menu_main':
-        # Desactivar modo IA si estaba activo
-        context.user_data['ai_mode'] = False
-        
-        keyboard = [
-            [InlineKeyboardButton("🌱 Cultivos", callback_data='menu_plants')],
-            [InlineKeyboardButton("🤖 Consultar IA", callback_data='menu_ai')],
-            [InlineKeyboardButton("💧 Recordatorios", callback_data='menu_reminders')],
-            [InlineKeyboardButton("ℹ️ Ayuda", callback_data='menu_help')]  # ← Agregar esta línea
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            text="Menú principal - ¿Qué deseas hacer?",
-            reply_markup=reply_markup
-        )
-        return ConversationHandler.END
-    
-    elif query.data == 'menu_ai':
-        return await start_ai_consultation(update, context)
+    user_id = query.from_user.id
+    device_id = await get_device_id_async(user_id)
     
-    elif query.data == 'menu_plants':
-        user_id = query.from_user.id
-        device_id = get_device_id(user_id)
-        
-        # Consultar si el usuario tiene una planta activa
-        tiene_planta_activa, planta_actual = consultar_estado_plantacion(user_id, device_id)
-        
-        if tiene_planta_activa:
-            # El usuario ya tiene una planta activa, mostrar mensaje y opciones
-            keyboard = [
-                [InlineKeyboardButton("❌ Cancelar plantación actual", callback_data='cancel_planting')],
-                [InlineKeyboardButton("↩️ Volver al menú", callback_data='menu_main')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                text=f"🌱 Actualmente tienes una plantación activa de {planta_actual}.\n\n"
-                     "Para seleccionar una nueva planta, primero debes cancelar la plantación actual.",
-                reply_markup=reply_markup
-            )
-        else:
-            # El usuario no tiene planta activa, mostrar opciones de plantas
-            keyboard = [
-                [InlineKeyboardButton("🥬 Lechuga", callback_data='plant_lechuga')],
-                [InlineKeyboardButton("🌿 Acelga", callback_data='plant_acelga')],
-                [InlineKeyboardButton("🍃 Espinaca", callback_data='plant_espinaca')],
-                [InlineKeyboardButton("🌿 Aromáticas", callback_data='plant_aromaticas')],
-                [InlineKeyboardButton("🌶️ Chile/Pimiento", callback_data='plant_chile')],
-                [InlineKeyboardButton("🍅 Jitomate", callback_data='plant_jitomate')],
-                [InlineKeyboardButton("🌸 Ornamentales", callback_data='plant_ornamentales')],
-                [InlineKeyboardButton("↩️ Volver", callback_data='menu_main')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                text="Selecciona un cultivo para registrar en tu sistema:",
-                reply_markup=reply_markup
-            )
+    # Consultar si el usuario tiene una planta activa (puede consultar SheetDB, así que va en otro hilo)
+    tiene_planta_activa, planta_actual = await asyncio.to_thread(consultar_estado_plantacion, user_id, device_id)
     
-    elif query.data == 'cancel_planting':
-        return await cancel_planting_handler(update, context)
-
-    elif query.data == 'menu_reminders':
-        keyboard = [
-            [InlineKeyboardButton("⏰ Configurar recordatorio", callback_data='reminder_set')],
-            [InlineKeyboardButton("📝 Ver recordatorios", callback_data='reminder_list')],
-            [InlineKeyboardButton("↩️ Volver", callback_data='menu_main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    if tiene_planta_activa:
+        # El usuario ya tiene una planta activa, mostrar mensaje y opciones
         await query.edit_message_text(
-            text="🔔 **Gestión de Recordatorios**\n\n"
-                 "Configura recordatorios para:\n"
-                 "• Revisar nivel de agua\n"
-                 "• Cambiar nutrientes\n" 
-                 "• Verificar pH\n"
-                 "• Limpiar sistema\n"
-                 "• Cualquier tarea de mantenimiento",
-            parse_mode='Markdown',
-            reply_markup=reply_markup
+            text=f"🌱 Actualmente tienes una plantación activa de {planta_actual}.\n\n"
+                 "Para seleccionar una nueva planta, primero debes cancelar la plantación actual.",
+            reply_markup=ACTIVE_PLANTING_MARKUP
         )
-    elif query.data == 'menu_help':
-        help_text, reply_markup = await show_help_menu(update, context)
+    else:
+        # El usuario no tiene planta activa, mostrar opciones de plantas
         await query.edit_message_text(
-            text=help_text,
-            parse_mode='Markdown',
-            reply_markup=reply_markup
+            text="Selecciona un cultivo para registrar en tu sistema:",
+            reply_markup=PLANTS_MENU_MARKUP
         )
+
+@CALLBACK_ROUTER.route('menu_reminders')
+async def show_reminders_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(
+        text="🔔 **Gestión de Recordatorios**\n\n"
+             "Configura recordatorios para:\n"
+             "• Revisar nivel de agua\n"
+             "• Cambiar nutrientes\n" 
+             "• Verificar pH\n"
+             "• Limpiar sistema\n"
+             "• Cualquier tarea de mantenimiento",
+        parse_mode='Markdown',
+        reply_markup=REMINDERS_MENU_MARKUP
+    )
+
+@CALLBACK_ROUTER.route('menu_help')
+async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    help_text, reply_markup = await show_help_menu(update, context)
+    await update.callback_query.edit_message_text(
+        text=help_text,
+        parse_mode='Markdown',
+        reply_markup=reply_markup
+    )
+
+@CALLBACK_ROUTER.prefix('plant')
+async def select_plant(update: Update, context: ContextTypes.DEFAULT_TYPE, plant_type):
+    query = update.callback_query
+    user_id = query.from_user.id
+    user = query.from_user
+    device_id = await get_device_id_async(user_id)
     
-    elif query.data.startswith('plant_'):
-        plant_type = query.data.split('_')[1]
-        user_id = query.from_user.id
-        user = query.from_user
-        device_id = get_device_id(user_id)
-        
-        # Guardar selección en la base de datos local
-        save_plant_selection(user_id, plant_type)
-        
-        # Registrar selección en SheetDB con ID de dispositivo
-        registrado_sheets = registrar_seleccion_planta(
-            user_id, 
-            user.username if user.username else "Sin username",
-            user.first_name if user.first_name else "Sin nombre",
-            plant_type,
-            device_id
-        )
-        
-        # Mensaje de confirmación simple
-        if registrado_sheets:
-            response = f"✅ {plant_type.capitalize()} registrada exitosamente en tu sistema hidropónico.\n\n"
-            response += "Tu plantación está ahora activa y registrada en nuestra base de datos."
-        else:
-            response = f"❌ Error al registrar {plant_type}. Por favor, inténtalo de nuevo."
-        
-        await query.edit_message_text(
-            text=response,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Volver", callback_data='menu_plants')]])
-        )
+    # Guardar la selección local y encolar su registro en SheetDB en una sola transacción
+    sheet_row = build_sheet_row(user_id, user.username, user.first_name, plant_type, device_id)
+    await save_plant_selection_async(user_id, plant_type, sheet_row)
+    
+    # Sincronizar con SheetDB en segundo plano, sin esperar la respuesta
+    context.job_queue.run_once(drain_outbox_job, 0)
+    
+    # Mensaje de confirmación simple
+    response = f"✅ {plant_type.capitalize()} registrada exitosamente en tu sistema hidropónico.\n\n"
+    response += "Tu plantación está ahora activa y registrada en nuestra base de datos."
+    
+    await query.edit_message_text(
+        text=response,
+        reply_markup=PLANT_REGISTERED_MARKUP
+    )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
     
     # Verificar si estamos en modo consulta IA
-    if context.user_data.get('ai_mode', False):
+    if (await get_session(update)).ai_mode:
         return await handle_ai_consultation(update, context)
     
     # Verificar si el usuario ya tiene un ID de dispositivo
-    device_id = get_device_id(user_id)
+    device_id = await get_device_id_async(user_id)
     
     if not device_id:
         # Si no tiene ID, solicitarlo
         return await request_device_id(update, context)
     
     # Si no está en modo IA, redirigir al menú principal
-    keyboard = [
-        [InlineKeyboardButton("🌱 Cultivos", callback_data='menu_plants')],
-        [InlineKeyboardButton("🤖 Consultar IA", callback_data='menu_ai')],
-        [InlineKeyboardButton("💧 Recordatorios", callback_data='menu_reminders')],
-        [InlineKeyboardButton("ℹ️ Ayuda", callback_data='menu_help')]  # ← Agregar esta línea
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         "Para interactuar conmigo, por favor usa el menú de opciones:",
-        reply_markup=reply_markup
+        reply_markup=MAIN_MENU_MARKUP
     )
 
 #Maneja específicamente la cancelación de plantación y establece un flag cancel_mode en el contexto del usuario.
+@CALLBACK_ROUTER.route('cancel_planting')
 async def cancel_planting_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja la cancelación de plantación y solicita nuevo ID de dispositivo"""
     query = update.callback_query
-    await query.answer()
     
     user_id = query.from_user.id
-    device_id = get_device_id(user_id)
-
-    # Eliminar el registro del usuario en SheetDB
-    try:
-        # Construir URL para eliminar por UserID y DispositivoID
-        delete_url = f"{SHEETDB_API_URL}/UserID/{user_id}/DispositivoID/{device_id}"
-        response = requests.delete(delete_url)
-        
-        if response.status_code in [200, 204]:
-            logger.info(f"Registro eliminado de SheetDB para user_id {user_id} y device_id {device_id}")
-        else:
-            logger.warning(f"Respuesta inesperada al eliminar de SheetDB: {response.status_code}")
-    except Exception as e:
-        logger.error(f"Error al eliminar registro de SheetDB: {e}")
+    device_id = await get_device_id_async(user_id)
 
-    # Limpiar el device_id en la base local
-    save_device_id(user_id, None)
+    # Limpiar el device_id en la base local y encolar el borrado en SheetDB en la misma transacción
+    sheet_delete = {"UserID": str(user_id), "DispositivoID": device_id} if device_id else None
+    await save_device_id_async(user_id, None, sheet_delete=sheet_delete)
+    
+    # Sincronizar con SheetDB en segundo plano
+    context.job_queue.run_once(drain_outbox_job, 0)
 
     await query.edit_message_text(
         text="❌ Plantación cancelada y datos eliminados.\n\n"
@@ -1022,139 +5156,561 @@ async def cancel_planting_handler(update: Update, context: ContextTypes.DEFAULT_
     )
     
     # Marcar que estamos en modo cancelación para manejar diferente el siguiente input
-    context.user_data['cancel_mode'] = True
+    (await get_session(update)).cancel_mode = True
     return DEVICE_ID # Retornar el estado para capturar el nuevo device_id
 
 # Función para enviar recordatorios
 async def send_reminders_job(context: ContextTypes.DEFAULT_TYPE):
     """Job que se ejecuta cada minuto para verificar recordatorios pendientes - CORREGIDO"""
     try:
-        pending_reminders = get_pending_reminders()
+        pending_reminders = await get_pending_reminders_async()
         
         for reminder_id, user_id, message in pending_reminders:
             try:
                 # Enviar el recordatorio al usuario
-                keyboard = [
-                    [InlineKeyboardButton("🏠 Menú principal", callback_data='menu_main')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
                 await context.bot.send_message(
                     chat_id=user_id,
                     text=f"⏰ **RECORDATORIO**\n\n{message}",
                     parse_mode='Markdown',
-                    reply_markup=reply_markup
+                    reply_markup=REMINDER_NOTIFICATION_MARKUP
                 )
                 
                 # Eliminar el recordatorio después de enviarlo
-                delete_reminder(reminder_id)
+                await delete_reminder_async(user_id, reminder_id)
                 logger.info(f"Recordatorio {reminder_id} enviado y eliminado para usuario {user_id}")
                 
+            except Forbidden:
+                logger.info(f"Usuario {user_id} bloqueó el bot; recordatorio {reminder_id} descartado")
+                await run_db(mark_users_blocked, [user_id])
+                await delete_reminder_async(user_id, reminder_id)
             except Exception as e:
                 logger.error(f"Error enviando recordatorio {reminder_id} a usuario {user_id}: {e}")
                 # Eliminar recordatorio fallido para evitar spam
-                delete_reminder(reminder_id)
+                await delete_reminder_async(user_id, reminder_id)
                 
     except Exception as e:
         logger.error(f"Error en job de recordatorios: {e}")
 
-# Manejadores para configurar recordatorios
-async def handle_reminder_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# Job de mantenimiento del historial (se ejecuta en el pool de SQLite para no bloquear los handlers)
+async def retention_job(context: ContextTypes.DEFAULT_TYPE):
+    """Archiva interacciones antiguas y ejecuta incremental_vacuum en periodos tranquilos"""
+    try:
+        await run_db(run_retention_maintenance)
+    except Exception as e:
+        logger.error(f"Error en job de retención: {e}")
+
+# Job que escribe por lotes el consumo de Gemini
+async def flush_usage_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await run_db(flush_ai_usage)
+        await run_db(flush_overload_events)
+    except Exception as e:
+        logger.error(f"Error escribiendo el consumo de la IA: {e}")
+
+async def usage_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /consumo [días] (solo administradores): mayores consumidores de tokens"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔ Comando restringido a administradores.")
+        return
     
-    if query.data == 'reminder_set':
-        await query.edit_message_text(
-            text="⏰ **Configurar Recordatorio**\n\n"
-                 "Escribe el mensaje que quieres recordar.\n"
-                 "Ejemplo: 'Revisar nivel de agua' o 'Cambiar nutrientes'",
-            parse_mode='Markdown'
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    if days < 1:
+        await update.message.reply_text("Uso: /consumo [días], con días ≥ 1.")
+        return
+    await run_db(flush_ai_usage)
+    consumers = await run_db(get_top_token_consumers, days)
+    flows = await run_db(get_token_usage_by_flow, days)
+    
+    text = f"📊 Consumo de IA (últimos {days} día(s))\n\n"
+    if not consumers:
+        text += "Sin consumo registrado."
+    else:
+        text += "Por flujo:\n"
+        for flow, calls, tokens, avg_latency in flows:
+            text += f"• {flow}: {calls} llamadas, {tokens} tokens, {avg_latency} ms promedio\n"
+        text += "\nMayores consumidores:\n"
+        for i, (user_id, username, calls, tokens, avg_latency) in enumerate(consumers, 1):
+            text += f"{i}. {username or user_id}: {tokens} tokens en {calls} llamadas ({avg_latency} ms)\n"
+    
+    await update.message.reply_text(text)
+
+async def on_startup(application: Application):
+    """Tareas en segundo plano que viven dentro del event loop"""
+    LOOP_LAG_MONITOR.start()
+    OVERLOAD_CONTROLLER.update_queue = application.update_queue
+    
+    # Reanudar las difusiones interrumpidas desde su último punto de control
+    for campaign_id in await run_db(get_running_broadcasts):
+        logger.info(f"Reanudando la difusión {campaign_id}")
+        start_broadcast_task(application.bot, campaign_id)
+
+async def on_shutdown(application: Application):
+    """Vacía los buffers en memoria antes de terminar"""
+    LOOP_LAG_MONITOR.stop()
+    for task in list(_broadcast_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*_broadcast_tasks.values(), return_exceptions=True)
+    stop_telemetry_server()
+    flush_telemetry()
+    flush_ai_usage()
+    save_user_sessions(SESSION_STORE.drain())
+    _db_executor.shutdown(wait=True)
+
+# Job que descarga de memoria las sesiones inactivas
+async def evict_sessions_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        evicted = await SESSION_STORE.evict_idle()
+        if evicted:
+            logger.info(f"{evicted} sesiones inactivas descargadas; {len(SESSION_STORE.sessions)} en memoria")
+    except Exception as e:
+        logger.error(f"Error descargando sesiones inactivas: {e}")
+
+# Job que resume en el log el retraso del event loop y la cola de SQLite
+async def loop_lag_report_job(context: ContextTypes.DEFAULT_TYPE):
+    stats = LOOP_LAG_MONITOR.stats()
+    logger.info(
+        f"Lag del event loop ({stats['samples']} muestras): p50 {stats['p50']:.1f} ms, "
+        f"p95 {stats['p95']:.1f} ms, máx {stats['max']:.1f} ms; consultas SQLite en cola: {_db_pending}"
+    )
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /difusion (solo administradores): envía un aviso a todos los usuarios o a un filtro"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔ Comando restringido a administradores.")
+        return
+    
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        await update.message.reply_text(
+            "Uso:\n"
+            "/difusion [cultivo=<planta>] [activos=<días>] <mensaje>\n"
+            "/difusion estado\n"
+            "/difusion cancelar <id>"
         )
-        return REMINDER_MESSAGE
-        
-    elif query.data == 'reminder_list':
-        user_id = query.from_user.id
-        reminders = get_user_reminders(user_id)
+        return
+    
+    if text == 'estado':
+        campaigns = await run_db(get_recent_broadcasts)
+        await update.message.reply_text("\n".join(format_broadcast(c) for c in campaigns) or "Sin difusiones.")
+        return
+    
+    if text.startswith('cancelar'):
+        campaign_id = text.partition(' ')[2].strip()
+        if not campaign_id.isdigit() or not await run_db(set_broadcast_status, int(campaign_id), 'cancelled'):
+            await update.message.reply_text("❌ No hay una difusión en curso con ese id.")
+            return
+        task = _broadcast_tasks.get(int(campaign_id))
+        if task:
+            task.cancel()
+        await update.message.reply_text(f"🛑 Difusión #{campaign_id} cancelada.")
+        return
+    
+    # Filtros opcionales al inicio del mensaje
+    options = {}
+    match = re.match(r'((?:(?:cultivo|activos)=\S+\s+)*)(.*)', text, re.S)
+    for option in match.group(1).split():
+        key, _, value = option.partition('=')
+        options[key] = value
+    message = match.group(2).strip()
+    if not message or ('activos' in options and not options['activos'].isdigit()):
+        await update.message.reply_text("❌ Indica el mensaje y, si usas activos=, un número de días.")
+        return
+    
+    plant_type = options.get('cultivo', '').lower() or None
+    active_days = int(options['activos']) if 'activos' in options else None
+    campaign_id = await run_db(create_broadcast, message, plant_type, active_days, update.effective_user.id)
+    start_broadcast_task(context.bot, campaign_id)
+    await update.message.reply_text(
+        f"📢 Difusión #{campaign_id} iniciada. Consulta el avance con /difusion estado."
+    )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /stats [minutos] (solo administradores): estado en vivo a partir de contadores en memoria"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔ Comando restringido a administradores.")
+        return
+    
+    minutes = int(context.args[0]) if context.args and context.args[0].isdigit() else STATS_ACTIVE_MINUTES
+    minutes = max(1, min(minutes, STATS_ACTIVITY_MAX_MINUTES))
+    
+    text = "📈 Estado del bot\n\n"
+    text += f"Usuarios activos (últimos {minutes} min): {count_active_users(minutes)}\n"
+    text += f"Recordatorios pendientes: {PENDING_REMINDERS.value}\n"
+    text += f"Sesiones en memoria: {len(SESSION_STORE.sessions)}/{SESSION_STORE.max_users} ({SESSION_STORE.evictions} descargadas)\n"
+    text += f"Solicitudes a Gemini en curso: {GEMINI_IN_FLIGHT.value}\n"
+    pending, p95 = OVERLOAD_CONTROLLER.signals()
+    text += (
+        f"Modo de carga: {OVERLOAD_CONTROLLER.mode()} desde hace "
+        f"{int(time.time() - OVERLOAD_CONTROLLER.changed_at) // 60} min "
+        f"(trabajo pendiente {pending}, p95 Gemini {p95:.0f} ms)\n"
+    )
+    text += (
+        f"Colas: outbox SheetDB {OUTBOX_DEPTH.value} · alertas {len(ALERT_ENGINE.pending)} · "
+        f"telemetría {len(_telemetry_buffer)} · consumo IA {len(_usage_buffer)} · SQLite {_db_pending}\n"
+    )
+    
+    write_latency = DB_WRITE_LATENCY.percentiles()
+    if write_latency:
+        p50, p95, samples = write_latency
+        text += f"Escrituras SQLite: p50 {p50:.1f} ms · p95 {p95:.1f} ms ({samples} muestras)\n"
+    lag = LOOP_LAG_MONITOR.stats()
+    text += f"Event loop: p95 {lag['p95']:.1f} ms · máx {lag['max']:.1f} ms\n"
+    
+    text += "\nCachés:\n"
+    for name, counter in CACHE_COUNTERS.items():
+        rate = counter.hit_rate()
+        text += f"• {name}: {f'{rate:.0%}' if rate is not None else 'sin datos'} ({counter.hits}/{counter.hits + counter.misses})\n"
+    
+    text += "\nCircuitos: " + ", ".join(f"{name} {breaker.state}" for name, breaker in CIRCUIT_BREAKERS.items()) + "\n"
+    
+    slowest = sorted((stats for stats in HANDLER_STATS.values() if stats.calls), key=lambda stats: stats.p95_ms(), reverse=True)[:3]
+    if slowest:
+        text += "\nHandlers más lentos (p95):\n"
+        for stats in slowest:
+            text += f"• {stats.name}: {stats.p95_ms():.0f} ms ({stats.calls} llamadas)\n"
+    
+    await update.message.reply_text(text)
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /perfil [segundos] (solo administradores): activa el profiler de muestreo y envía el perfil"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔ Comando restringido a administradores.")
+        return
+    
+    seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else PROFILE_DEFAULT_SECONDS
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if not SAMPLING_PROFILER.start():
+        await update.message.reply_text("⏳ Ya hay un perfil en curso.")
+        return
+    
+    # El handler termina enseguida; un job detiene el profiler y envía el archivo
+    context.job_queue.run_once(finish_profile_job, seconds, chat_id=update.effective_chat.id)
+    await update.message.reply_text(f"🔬 Perfilando durante {seconds} s...")
+
+async def finish_profile_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        samples, folded = await asyncio.to_thread(SAMPLING_PROFILER.stop)
+        if not samples:
+            await context.bot.send_message(chat_id=context.job.chat_id, text="No se tomaron muestras.")
+            return
+        document = io.BytesIO(folded.encode('utf-8'))
+        await context.bot.send_document(
+            chat_id=context.job.chat_id,
+            document=document,
+            filename=f"perfil_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded",
+            caption=f"{samples} muestras (formato folded: flamegraph.pl o speedscope.app)"
+        )
+    except Exception as e:
+        logger.error(f"Error enviando el perfil: {e}")
+
+# Job que reenvía a SheetDB las operaciones pendientes del outbox
+async def drain_outbox_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(drain_sheetdb_outbox)
+    except Exception as e:
+        logger.error(f"Error drenando el outbox de SheetDB: {e}")
+
+# Job que sincroniza el espejo local de la hoja
+async def sync_sheet_mirror_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(sync_sheet_mirror)
+    except DependencyUnavailable:
+        logger.warning("Sincronización del espejo pospuesta: SheetDB no disponible")
+    except Exception as e:
+        logger.error(f"Error sincronizando el espejo de SheetDB: {e}")
+
+async def plantations_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /plantaciones (solo administradores): resumen de plantaciones desde el espejo local"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔ Comando restringido a administradores.")
+        return
+    
+    last_sync = await run_db(get_mirror_last_sync)
+    counts = await run_db(get_mirror_plant_counts)
+    missing_in_sheet, orphaned_in_sheet = await run_db(reconcile_sheet_mirror)
+    
+    text = "🌱 Plantaciones activas (espejo de SheetDB)\n"
+    text += f"Última sincronización: {last_sync.strftime('%d/%m/%Y %H:%M') if last_sync else 'nunca'}\n\n"
+    if counts:
+        for planta, total in counts:
+            text += f"• {planta}: {total}\n"
+    else:
+        text += "Sin plantaciones activas.\n"
+    text += (
+        f"\nConciliación:\n"
+        f"• Registradas localmente sin fila en la hoja: {len(missing_in_sheet)}\n"
+        f"• Filas activas sin dispositivo local: {len(orphaned_in_sheet)}"
+    )
+    await update.message.reply_text(text)
+
+# Jobs de resúmenes diarios
+async def build_digests_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job diario (fuera de horas pico) que genera los resúmenes de cuidado"""
+    try:
+        await build_daily_digests()
+    except Exception as e:
+        logger.error(f"Error en job de resúmenes diarios: {e}")
+
+async def deliver_digests_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job horario que entrega los resúmenes a los usuarios cuya hora elegida ya llegó"""
+    try:
+        digest_date = get_digest_date()
+        hour = datetime.now(pytz.timezone(DIGEST_TIMEZONE)).hour
+        digests = await get_undelivered_digests_async(digest_date, hour)
         
-        if not reminders:
-            keyboard = [
-                [InlineKeyboardButton("➕ Crear recordatorio", callback_data='reminder_set')],
-                [InlineKeyboardButton("↩️ Volver", callback_data='menu_main')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text="📝 No tienes recordatorios activos.",
-                reply_markup=reply_markup
-            )
+        for user_id, plant_type, content in digests:
+            try:
+                for part in split_message(f"🌱 Resumen diario de tu {plant_type}\n\n{content}"):
+                    await context.bot.send_message(chat_id=user_id, text=part)
+                await mark_digest_delivered_async(user_id, digest_date)
+            except Exception as e:
+                logger.error(f"Error enviando resumen diario a usuario {user_id}: {e}")
+    except Exception as e:
+        logger.error(f"Error en job de entrega de resúmenes: {e}")
+
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /resumen: muestra el resumen de cuidado de hoy"""
+    user_id = update.effective_user.id
+    digest = await get_care_digest_async(user_id, get_digest_date())
+    
+    if not digest:
+        await update.message.reply_text(
+            "📋 Aún no hay resumen de hoy para tu cultivo.\n\n"
+            "Los resúmenes se generan cada madrugada para las plantaciones registradas con hora de entrega; "
+            "actívalo con /resumen_hora <hora>.",
+            reply_markup=MAIN_MENU_MARKUP
+        )
+        return
+    
+    plant_type, content = digest
+    message_parts = split_message(f"🌱 Resumen diario de tu {plant_type}\n\n{content}")
+    for i, part in enumerate(message_parts):
+        if i == len(message_parts) - 1:
+            await update.message.reply_text(part, reply_markup=MAIN_MENU_MARKUP)
         else:
-            # Mostrar lista de recordatorios
-            colombia_tz = pytz.timezone('America/Bogota')
-            text = "📝 **Tus Recordatorios Activos:**\n\n"
-            keyboard = []
-            
-            for i, (reminder_id, message, reminder_time) in enumerate(reminders[:5], 1):  # Máximo 5 recordatorios
-                try:
-                    # Convertir la fecha a timezone de Colombia - CORREGIDO
-                    if isinstance(reminder_time, str):
-                        # Intentar diferentes formatos de fecha
-                        try:
-                            # Formato con microsegundos
-                            dt = datetime.strptime(reminder_time, '%Y-%m-%d %H:%M:%S.%f')
-                        except ValueError:
-                            try:
-                                # Formato sin microsegundos
-                                dt = datetime.strptime(reminder_time, '%Y-%m-%d %H:%M:%S')
-                            except ValueError:
-                                # Formato ISO con T
-                                dt = datetime.fromisoformat(reminder_time.replace('T', ' ').replace('Z', ''))
-                    else:
-                        dt = reminder_time
-                    
-                    # Asegurar que la fecha tenga timezone UTC antes de convertir
-                    if dt.tzinfo is None:
-                        dt = pytz.utc.localize(dt)
-                    
-                    dt_colombia = dt.astimezone(colombia_tz)
-                    fecha_str = dt_colombia.strftime('%d/%m/%Y %I:%M %p')
-                    
-                    text += f"{i}. {message}\n📅 {fecha_str}\n\n"
-                    
-                    # Botón para cancelar este recordatorio
-                    keyboard.append([InlineKeyboardButton(
-                        f"❌ Cancelar recordatorio {i}", 
-                        callback_data=f'cancel_reminder_{reminder_id}'
-                    )])
-                    
-                except Exception as e:
-                    logger.error(f"Error procesando recordatorio {reminder_id}: {e}")
-                    # Mostrar recordatorio con fecha sin procesar
-                    text += f"{i}. {message}\n📅 {reminder_time}\n\n"
-                    keyboard.append([InlineKeyboardButton(
-                        f"❌ Cancelar recordatorio {i}", 
-                        callback_data=f'cancel_reminder_{reminder_id}'
-                    )])
-            
-            # Botones de navegación
-            keyboard.extend([
-                [InlineKeyboardButton("➕ Nuevo recordatorio", callback_data='reminder_set')],
-                [InlineKeyboardButton("↩️ Volver", callback_data='menu_main')]
-            ])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(text=text, parse_mode='Markdown', reply_markup=reply_markup)
+            await update.message.reply_text(part)
+
+async def digest_hour_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /resumen_hora <hora|off>: configura la hora de entrega del resumen diario"""
+    user_id = update.effective_user.id
+    arg = context.args[0].lower() if context.args else ''
     
-    elif query.data.startswith('cancel_reminder_'):
-        reminder_id = int(query.data.split('_')[2])
-        delete_reminder(reminder_id)
-        
+    if arg in ('off', 'no'):
+        await set_digest_hour_async(user_id, None)
+        await update.message.reply_text("🔕 Resumen diario desactivado.")
+        return
+    
+    # El resumen del día se genera a DIGEST_BUILD_HOUR: antes no habría nada que entregar
+    if not arg.isdigit() or not DIGEST_BUILD_HOUR <= int(arg) <= 23:
+        await update.message.reply_text(
+            f"Uso: /resumen_hora <hora {DIGEST_BUILD_HOUR}-23> para recibir el resumen diario a esa hora, "
+            "o /resumen_hora off para desactivarlo."
+        )
+        return
+    
+    await set_digest_hour_async(user_id, int(arg))
+    await update.message.reply_text(f"🔔 Recibirás el resumen diario de tu cultivo a las {int(arg):02d}:00.")
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /historial <búsqueda>: busca en las consultas anteriores del usuario"""
+    text = update.message.text.partition(' ')[2].strip()
+    if not build_history_query(text):
+        await update.message.reply_text(
+            "Uso: /historial <palabras>, por ejemplo /historial hojas amarillas"
+        )
+        return
+    
+    (await get_session(update)).history_query = text
+    message, reply_markup = await render_history_page(update.effective_user.id, text, 0)
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+@CALLBACK_ROUTER.prefix('history_page', int)
+async def history_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    query = update.callback_query
+    text = (await get_session(update)).history_query
+    if not text:
+        await query.edit_message_text("⌛ La búsqueda expiró. Vuelve a usar /historial <palabras>.")
+        return
+    message, reply_markup = await render_history_page(query.from_user.id, text, page)
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
+async def render_history_page(user_id, text, page):
+    """Texto y teclado de una página de resultados de /historial"""
+    results, has_more = await search_interactions_async(user_id, text, page)
+    if not results:
+        return (f"🔎 Sin resultados para «{text}»." if page == 0 else "🔎 No hay más resultados."), None
+    
+    message = f"🔎 Resultados para «{text}» (página {page + 1}):\n\n"
+    for _, timestamp, question, answer in results:
+        try:
+            fecha = parse_datetime_flexible(timestamp).strftime('%d/%m/%Y')
+        except (ValueError, TypeError):
+            fecha = str(timestamp)[:10]
+        message += f"📅 {fecha}\n❓ {question}\n💬 {answer}\n\n"
+    
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Anteriores", callback_data=f'history_page_{page - 1}'))
+    if has_more:
+        buttons.append(InlineKeyboardButton("➡️ Siguientes", callback_data=f'history_page_{page + 1}'))
+    return message, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /zona [zona IANA]: muestra o configura la zona horaria de los recordatorios"""
+    user_id = update.effective_user.id
+    
+    if not context.args:
+        user_tz = await get_user_timezone_async(user_id)
+        await update.message.reply_text(
+            f"🌎 Tu zona horaria es {user_tz.zone}.\n"
+            "Para cambiarla usa /zona <zona>, por ejemplo /zona America/Mexico_City"
+        )
+        return
+    
+    try:
+        user_tz = pytz.timezone(context.args[0])
+    except pytz.UnknownTimeZoneError:
+        await update.message.reply_text("❌ Zona horaria no reconocida. Ejemplo: /zona America/Lima")
+        return
+    
+    await set_user_timezone_async(user_id, user_tz.zone)
+    await update.message.reply_text(f"✅ Zona horaria configurada: {user_tz.zone}")
+
+# Jobs de la telemetría de los dispositivos
+async def flush_telemetry_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await run_db(flush_telemetry)
+    except Exception as e:
+        logger.error(f"Error escribiendo la telemetría: {e}")
+
+async def sensor_alerts_job(context: ContextTypes.DEFAULT_TYPE):
+    """Revisa los dispositivos sin datos y envía las alertas pendientes"""
+    try:
+        await run_db(ALERT_ENGINE.check_stale)
+        for user_id, text in ALERT_ENGINE.pop_notifications():
+            try:
+                await context.bot.send_message(chat_id=user_id, text=text, reply_markup=BACK_TO_MAIN_MARKUP)
+            except Exception as e:
+                logger.error(f"Error enviando alerta a usuario {user_id}: {e}")
+    except Exception as e:
+        logger.error(f"Error en job de alertas: {e}")
+
+async def prune_telemetry_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        deleted = await run_db(prune_telemetry)
+        if deleted:
+            logger.info(f"Telemetría purgada: {deleted} filas")
+    except Exception as e:
+        logger.error(f"Error purgando la telemetría: {e}")
+
+async def sensor_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /estado: últimas lecturas y resumen de 24 horas y 7 días del dispositivo"""
+    device_id = await get_device_id_async(update.effective_user.id)
+    if not device_id:
+        await update.message.reply_text(
+            "Primero registra tu dispositivo con /device para ver su estado.",
+            reply_markup=MAIN_MENU_MARKUP
+        )
+        return
+    
+    now = int(time.time())
+    latest = await get_sensor_latest_async(device_id)
+    if not latest:
+        await update.message.reply_text(
+            f"📡 Aún no se han recibido lecturas del dispositivo {device_id}.",
+            reply_markup=MAIN_MENU_MARKUP
+        )
+        return
+    last_day = await get_sensor_summary_async(device_id, 'hour', now - 86400)
+    last_week = await get_sensor_summary_async(device_id, 'day', now - 7 * 86400)
+    
+    text = f"📡 Estado del dispositivo {device_id}\n\n"
+    for metric, (name, _) in SENSOR_METRICS.items():
+        if metric not in latest:
+            continue
+        ts, value = latest[metric]
+        text += f"{name}: {format_sensor_value(metric, value)} ({datetime.fromtimestamp(ts).strftime('%d/%m %H:%M')})\n"
+        if metric in last_day:
+            avg, low, high, _ = last_day[metric]
+            text += f"  24 h: prom. {format_sensor_value(metric, avg)}, rango {low:.2f}–{high:.2f}\n"
+        if metric in last_week:
+            avg, low, high, _ = last_week[metric]
+            text += f"  7 días: prom. {format_sensor_value(metric, avg)}, rango {low:.2f}–{high:.2f}\n"
+    
+    await update.message.reply_text(text, reply_markup=MAIN_MENU_MARKUP)
+
+# Manejadores para configurar recordatorios
+@CALLBACK_ROUTER.route('reminder_set')
+async def reminder_set(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(
+        text="⏰ **Configurar Recordatorio**\n\n"
+             "Escribe el mensaje que quieres recordar.\n"
+             "Ejemplo: 'Revisar nivel de agua' o 'Cambiar nutrientes'",
+        parse_mode='Markdown'
+    )
+    return REMINDER_MESSAGE
+
+@CALLBACK_ROUTER.route('reminder_list')
+async def reminder_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_reminders_page(update, (0, 0))
+
+@CALLBACK_ROUTER.prefix('reminder_page')
+async def reminder_page(update: Update, context: ContextTypes.DEFAULT_TYPE, cursor):
+    """Página siguiente del listado; el parámetro es la clave '<reminder_ts>:<id>' del último mostrado"""
+    reminder_ts, _, reminder_id = cursor.partition(':')
+    if not reminder_ts.isdigit() or not reminder_id.isdigit():
+        await show_reminders_page(update, (0, 0))
+        return
+    await show_reminders_page(update, (int(reminder_ts), int(reminder_id)))
+
+async def show_reminders_page(update: Update, after):
+    """Muestra una página de recordatorios leyendo solo esa página de la base"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    reminders, has_more = await get_user_reminders_async(user_id, after)
+
+    if not reminders:
         await query.edit_message_text(
-            text="✅ Recordatorio cancelado exitosamente.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("📝 Ver recordatorios", callback_data='reminder_list'),
-                InlineKeyboardButton("↩️ Menú", callback_data='menu_main')
-            ]])
+            text="📝 No tienes recordatorios activos.",
+            reply_markup=NO_REMINDERS_MARKUP
         )
+        return
+    
+    # Mostrar la página en la zona horaria del usuario
+    user_tz = await get_user_timezone_async(user_id)
+    text = "📝 **Tus Recordatorios Activos:**\n\n"
+    keyboard = []
+
+    for i, (reminder_id, message, reminder_ts) in enumerate(reminders, 1):
+        fecha_str = datetime.fromtimestamp(reminder_ts, user_tz).strftime('%d/%m/%Y %I:%M %p')
+        text += f"{i}. {message}\n📅 {fecha_str}\n\n"
+
+        # Botón para cancelar este recordatorio
+        keyboard.append([InlineKeyboardButton(
+            f"❌ Cancelar recordatorio {i}", 
+            callback_data=f'cancel_reminder_{reminder_id}'
+        )])
+
+    # Botones de navegación
+    if has_more:
+        last_id, _, last_ts = reminders[-1]
+        keyboard.append([InlineKeyboardButton("➡️ Siguientes", callback_data=f'reminder_page_{last_ts}:{last_id}')])
+    keyboard.extend([
+        [InlineKeyboardButton("➕ Nuevo recordatorio", callback_data='reminder_set')],
+        [InlineKeyboardButton("↩️ Volver", callback_data='menu_main')]
+    ])
+
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(text=text, parse_mode='Markdown', reply_markup=reply_markup)
+
+@CALLBACK_ROUTER.prefix('cancel_reminder', int)
+async def cancel_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE, reminder_id):
+    await delete_reminder_async(update.callback_query.from_user.id, reminder_id)
+    
+    await update.callback_query.edit_message_text(
+        text="✅ Recordatorio cancelado exitosamente.",
+        reply_markup=REMINDER_CANCELLED_MARKUP
+    )
 
 # Función auxiliar para manejar la conversión de fechas de manera más robusta
 def parse_datetime_flexible(date_string):
@@ -1197,98 +5753,48 @@ async def handle_reminder_message(update: Update, context: ContextTypes.DEFAULT_
         return REMINDER_MESSAGE
     
     # Guardar el mensaje en el contexto del usuario
-    context.user_data['reminder_message'] = message
-    
-    # Crear teclado con opciones de tiempo predefinidas
-    keyboard = [
-        [InlineKeyboardButton("⏰ 15 minutos", callback_data='time_15m')],
-        [InlineKeyboardButton("⏰ 30 minutos", callback_data='time_30m')],
-        [InlineKeyboardButton("⏰ 1 hora", callback_data='time_1h')],
-        [InlineKeyboardButton("⏰ 2 horas", callback_data='time_2h')],
-        [InlineKeyboardButton("⏰ 6 horas", callback_data='time_6h')],
-        [InlineKeyboardButton("⏰ 12 horas", callback_data='time_12h')],
-        [InlineKeyboardButton("⏰ 1 día", callback_data='time_1d')],
-        [InlineKeyboardButton("⏰ 3 días", callback_data='time_3d')],
-        [InlineKeyboardButton("❌ Cancelar", callback_data='menu_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    (await get_session(update)).reminder_message = message
     
+    # Mostrar las opciones de tiempo predefinidas
     await update.message.reply_text(
         f"✅ Mensaje guardado: *{message}*\n\n"
         "🕐 ¿Cuándo quieres recibir este recordatorio?",
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=REMINDER_TIME_MARKUP
     )
     
     return REMINDER_TIME
 
-async def handle_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@CALLBACK_ROUTER.prefix('time')
+async def handle_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYPE, time_option):
     """Procesa la selección de tiempo y guarda el recordatorio"""
     query = update.callback_query
-    await query.answer()
-    
-    if query.data == 'menu_main':
-        return await handle_menu(update, context)
     
     # Obtener el mensaje guardado
-    reminder_message = context.user_data.get('reminder_message')
+    session = await get_session(update)
+    reminder_message = session.reminder_message
     if not reminder_message:
         await query.edit_message_text("❌ Error: No se encontró el mensaje del recordatorio.")
         return ConversationHandler.END
     
     # Calcular el tiempo del recordatorio
-    time_mapping = {
-        'time_15m': 15,           # 15 minutos
-        'time_30m': 30,           # 30 minutos  
-        'time_1h': 60,            # 1 hora
-        'time_2h': 120,           # 2 horas
-        'time_6h': 360,           # 6 horas
-        'time_12h': 720,          # 12 horas
-        'time_1d': 1440,          # 1 día
-        'time_3d': 4320           # 3 días
-    }
-    
-    minutes = time_mapping.get(query.data)
-    if not minutes:
+    if time_option not in REMINDER_TIME_OPTIONS:
         await query.edit_message_text("❌ Opción no válida.")
         return ConversationHandler.END
+    minutes, time_label = REMINDER_TIME_OPTIONS[time_option]
     
-    # Calcular fecha y hora del recordatorio
-    colombia_tz = pytz.timezone('America/Bogota')
-    now = datetime.now(colombia_tz)
-    reminder_time = now + timedelta(minutes=minutes)
-    
-    # Convertir a UTC para guardar en la base de datos
-    reminder_time_utc = reminder_time.astimezone(pytz.utc).replace(tzinfo=None)
+    # Calcular la hora del recordatorio en segundos UTC desde epoch
+    reminder_ts = int(time.time()) + minutes * 60
     
     # Guardar el recordatorio
     user_id = query.from_user.id
-    reminder_id = save_reminder(user_id, reminder_message, reminder_time_utc)
+    reminder_id = await save_reminder_async(user_id, reminder_message, reminder_ts)
     
     # Limpiar datos temporales
-    context.user_data.pop('reminder_message', None)
-    
-    # Mostrar confirmación
-    time_labels = {
-        'time_15m': '15 minutos',
-        'time_30m': '30 minutos',
-        'time_1h': '1 hora',
-        'time_2h': '2 horas',
-        'time_6h': '6 horas',
-        'time_12h': '12 horas',
-        'time_1d': '1 día',
-        'time_3d': '3 días'
-    }
-    
-    time_label = time_labels.get(query.data, 'tiempo seleccionado')
-    fecha_str = reminder_time.strftime('%d/%m/%Y %I:%M %p')
+    session.reminder_message = None
     
-    keyboard = [
-        [InlineKeyboardButton("📝 Ver recordatorios", callback_data='reminder_list')],
-        [InlineKeyboardButton("➕ Otro recordatorio", callback_data='reminder_set')],
-        [InlineKeyboardButton("🏠 Menú principal", callback_data='menu_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Mostrar confirmación en la zona horaria del usuario
+    fecha_str = datetime.fromtimestamp(reminder_ts, await get_user_timezone_async(user_id)).strftime('%d/%m/%Y %I:%M %p')
     
     await query.edit_message_text(
         f"✅ **Recordatorio configurado**\n\n"
@@ -1296,7 +5802,7 @@ async def handle_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYP
         f"⏰ En: {time_label}\n"
         f"📅 Fecha: {fecha_str}",
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=REMINDER_SAVED_MARKUP
     )
     
     return ConversationHandler.END
@@ -1305,6 +5811,8 @@ def main():
     # Inicializar la base de datos
     init_db()
     init_reminders_table() 
+    init_archive_db()
+    load_runtime_stats()
     
     # Obtener el token de Telegram del ambiente
     token = 'TELEGRAM_BOT_TOKEN' # Reemplazar con token real TELEGRAM_BOT_TOKEN
@@ -1313,25 +5821,71 @@ def main():
         return
     
     # Crear la aplicación
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_init(on_startup).post_shutdown(on_shutdown).build()
 
     # Configurar el job para verificar recordatorios cada minuto
     job_queue = application.job_queue
     job_queue.run_repeating(send_reminders_job, interval=60, first=10)
     
+    # Configurar el job de retención del historial de interacciones
+    job_queue.run_repeating(retention_job, interval=RETENTION_INTERVAL_SECONDS, first=300)
+    
+    # Configurar el drenado periódico del outbox de SheetDB
+    job_queue.run_repeating(drain_outbox_job, interval=OUTBOX_DRAIN_INTERVAL_SECONDS, first=5)
+    
+    # Configurar la sincronización periódica del espejo de la hoja
+    job_queue.run_repeating(sync_sheet_mirror_job, interval=SHEET_SYNC_INTERVAL_SECONDS, first=20)
+    
+    # Configurar la escritura por lotes del consumo de la IA
+    job_queue.run_repeating(flush_usage_job, interval=USAGE_FLUSH_INTERVAL_SECONDS, first=USAGE_FLUSH_INTERVAL_SECONDS)
+    
+    # Configurar la ingesta de telemetría, su escritura por lotes y la purga de datos antiguos
+    start_telemetry_server()
+    job_queue.run_repeating(flush_telemetry_job, interval=TELEMETRY_FLUSH_INTERVAL_SECONDS, first=TELEMETRY_FLUSH_INTERVAL_SECONDS)
+    job_queue.run_repeating(prune_telemetry_job, interval=TELEMETRY_PRUNE_INTERVAL_SECONDS, first=600)
+    job_queue.run_repeating(sensor_alerts_job, interval=ALERT_CHECK_INTERVAL_SECONDS, first=ALERT_CHECK_INTERVAL_SECONDS)
+    
+    # Configurar el resumen periódico del retraso del event loop
+    job_queue.run_repeating(loop_lag_report_job, interval=LOOP_LAG_REPORT_SECONDS, first=LOOP_LAG_REPORT_SECONDS)
+    
+    # Descargar las sesiones inactivas para acotar la memoria
+    job_queue.run_repeating(evict_sessions_job, interval=SESSION_EVICT_INTERVAL_SECONDS, first=SESSION_EVICT_INTERVAL_SECONDS)
+    
+    # Configurar la generación nocturna y la entrega horaria de los resúmenes diarios
+    digest_tz = pytz.timezone(DIGEST_TIMEZONE)
+    job_queue.run_daily(build_digests_job, time=dt_time(hour=DIGEST_BUILD_HOUR, tzinfo=digest_tz))
+    next_hour = (datetime.now(digest_tz) + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+    job_queue.run_repeating(deliver_digests_job, interval=3600, first=next_hour)
+    
     # Usar la función setup_conversation_handler en lugar de crear aquí
     conv_handler = setup_conversation_handler()
     
     # Añadir manejadores
     application.add_handler(conv_handler)
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("clear", clear_context))
-    application.add_handler(CallbackQueryHandler(handle_reminder_menu, pattern='^(reminder_|cancel_reminder_)'))
-    application.add_handler(CallbackQueryHandler(handle_menu))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CommandHandler("help", instrument_handler(help_command)))
+    application.add_handler(CommandHandler("clear", instrument_handler(clear_context)))
+    application.add_handler(CommandHandler("stats", instrument_handler(stats_command)))
+    application.add_handler(CommandHandler("difusion", instrument_handler(broadcast_command)))
+    application.add_handler(CommandHandler("resumen", instrument_handler(digest_command)))
+    application.add_handler(CommandHandler("resumen_hora", instrument_handler(digest_hour_command)))
+    application.add_handler(CommandHandler("zona", instrument_handler(timezone_command)))
+    application.add_handler(CommandHandler("historial", instrument_handler(history_command)))
+    application.add_handler(CommandHandler("consumo", instrument_handler(usage_report_command)))
+    application.add_handler(CommandHandler("plantaciones", instrument_handler(plantations_command)))
+    application.add_handler(CommandHandler("estado", instrument_handler(sensor_status_command)))
+    application.add_handler(CommandHandler("perfil", instrument_handler(profile_command)))
+    application.add_handler(CallbackQueryHandler(route_callback))  # Cada handler enrutado se mide por separado
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler(handle_message)))
     
     # Iniciar el bot
     application.run_polling()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        run_export(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'reshard':
+        run_reshard(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'vacuum':
+        run_vacuum(sys.argv[2:])
+    else:
+        main()
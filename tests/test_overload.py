@@ -0,0 +1,15 @@
+import asyncio
+
+import mainAIGoogle as bot
+
+
+def test_update_backlog_raises_overload_level():
+    controller = bot.OverloadController()
+    controller.update_queue = asyncio.Queue()
+    assert controller.evaluate() == 0
+
+    # Con updates secuenciales la carga se acumula en la cola, no en Gemini
+    for n in range(bot.OVERLOAD_THRESHOLDS[2][0]):
+        controller.update_queue.put_nowait(n)
+    assert controller.evaluate() == 2
+    assert controller.events[-1][2] >= bot.OVERLOAD_THRESHOLDS[2][0]
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import mainAIGoogle as bot
+
+
+def make_text_update(user_id, text, replies):
+    async def reply_text(part, reply_markup=None):
+        replies.append(part)
+    message = SimpleNamespace(text=text, photo=None, media_group_id=None, reply_text=reply_text)
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=message)
+
+
+def setup_bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bot.init_db()
+    monkeypatch.setattr(bot, 'SINGLE_FLIGHT', bot.SingleFlight())
+    calls = []
+
+    def fake_ai_response(prompt, context=None, image_data=None, **kwargs):
+        calls.append(prompt)
+        time.sleep(0.05)
+        return "Mantén el pH entre 5.5 y 6.5 y revisa la conductividad de la solución."
+
+    monkeypatch.setattr(bot, 'get_ai_response', fake_ai_response)
+    return calls
+
+
+def test_repeated_question_makes_single_gemini_call(tmp_path, monkeypatch):
+    calls = setup_bot(tmp_path, monkeypatch)
+    replies = []
+
+    async def scenario():
+        # Los updates llegan de uno en uno: el duplicado se procesa cuando el primero ya terminó
+        await bot.handle_ai_consultation(make_text_update(1, "¿por qué se marchita mi albahaca?", replies), None)
+        await bot.handle_ai_consultation(make_text_update(1, "¿por qué se marchita mi albahaca?", replies), None)
+
+    asyncio.run(scenario())
+    assert len(calls) == 1
+    assert len(replies) == 2 and replies[0] == replies[1]
+
+
+def test_concurrent_question_shares_in_flight_call(tmp_path, monkeypatch):
+    calls = setup_bot(tmp_path, monkeypatch)
+    replies = []
+
+    async def scenario():
+        await asyncio.gather(
+            bot.handle_ai_consultation(make_text_update(2, "¿cada cuánto cambio la solución?", replies), None),
+            bot.handle_ai_consultation(make_text_update(2, "¿cada cuánto cambio la solución?", replies), None),
+        )
+
+    asyncio.run(scenario())
+    assert len(calls) == 1
+    assert len(replies) == 2
+
+
+def test_failed_response_is_not_remembered(tmp_path, monkeypatch):
+    calls = setup_bot(tmp_path, monkeypatch)
+    monkeypatch.setattr(bot, 'get_ai_response', lambda prompt, *args, **kwargs: calls.append(prompt) or "Error: sin respuesta")
+    replies = []
+
+    async def scenario():
+        await bot.handle_ai_consultation(make_text_update(3, "¿qué luz necesita la lechuga?", replies), None)
+        await bot.handle_ai_consultation(make_text_update(3, "¿qué luz necesita la lechuga?", replies), None)
+
+    asyncio.run(scenario())
+    assert len(calls) == 2